@@ -0,0 +1,249 @@
+"""Benchmark LegendBot's handlers against an in-process fake Bot API.
+
+Every scenario drives the real handlers in main.py through
+Application.process_update. Bot API requests never leave the process:
+FakeBotAPI answers them after --latency seconds. State is kept in a
+temporary directory, so a run never touches the bot's real data.
+
+    python benchmark.py --chats 200 --filters 50 --messages 20000 --latency 0.02
+
+Reports throughput, p50/p99 latency per update and peak memory for each
+scenario, so changes to the bot can be compared run against run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from itertools import count
+
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+import main
+
+BOT_USER = {"id": 999, "is_bot": True, "first_name": "LegendBot", "username": "legendbot"}
+ADMIN_RIGHTS = [
+    "can_be_edited", "can_manage_chat", "can_delete_messages", "can_manage_video_chats",
+    "can_restrict_members", "can_promote_members", "can_change_info", "can_invite_users"
+]
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API requests in-process after a fixed delay."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._message_ids = count(1000000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 1)), "type": "supergroup", "title": "Bench"},
+            "from": BOT_USER,
+            "text": params.get("text", "")
+        }
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method in ("sendMessage", "forwardMessage", "editMessageText", "sendPhoto", "sendSticker"):
+            return self._message(params)
+        if api_method == "getChatAdministrators":
+            owner = {"id": main.OWNER_ID, "is_bot": False, "first_name": "Owner"}
+            return [
+                {"status": "creator", "user": owner, "is_anonymous": False},
+                dict({"status": "administrator", "user": BOT_USER, "is_anonymous": False},
+                     **{right: True for right in ADMIN_RIGHTS})
+            ]
+        return True
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        result = self._result(url.rsplit('/', 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+WORDS = "the a to of and in is it you that was for on are with as be at one have this from".split()
+
+
+class Traffic:
+    """Builds synthetic updates for the benchmark chats."""
+
+    def __init__(self, bot, chats, users):
+        self.bot = bot
+        self.chats = chats
+        self.users = users
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+
+    def message(self, chat_id, user_id, text, reply_to_user=None):
+        message_id = next(self._message_ids)
+        chat = {"id": chat_id, "type": "supergroup", "title": "Bench"}
+        data = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text
+        }
+        if text.startswith('/'):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to_user is not None:
+            data["reply_to_message"] = {
+                "message_id": max(1, message_id - 1),
+                "date": int(time.time()),
+                "chat": chat,
+                "from": {"id": reply_to_user, "is_bot": False, "first_name": "Target"},
+                "text": "target"
+            }
+        return Update.de_json({"update_id": next(self._update_ids), "message": data}, self.bot)
+
+    def chat_message(self, keywords):
+        chat_id = random.choice(self.chats)
+        words = random.choices(WORDS, k=8)
+        if keywords and random.random() < 0.2:
+            words.append(random.choice(keywords).rpartition(':')[2])
+        return self.message(chat_id, random.choice(self.users), ' '.join(words))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def drive(application, updates, rate, concurrency):
+    """Process updates at the given rate (0 = as fast as possible); return latencies and elapsed time."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for index, update in enumerate(updates):
+        if rate:
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(update)))
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started
+
+
+def report(name, latencies, elapsed, unit="updates"):
+    print(f"{name:<16} {len(latencies):>7} {unit:<8} {len(latencies) / elapsed:>9.0f}/s  "
+          f"p50 {percentile(latencies, 0.5) * 1000:>7.2f}ms  p99 {percentile(latencies, 0.99) * 1000:>7.2f}ms  "
+          f"peak rss {peak_rss_mb():>6.1f}MB")
+
+
+async def run(args):
+    api = FakeBotAPI(args.latency)
+    bot = ExtBot(main.TOKEN, request=api, get_updates_request=FakeBotAPI(0), rate_limiter=main.send_queue)
+    application = main.build_application(bot)
+    chats = [-1000000000000 - index for index in range(args.chats)]
+    users = list(range(1, args.users + 1))
+    traffic = Traffic(bot, chats, users)
+    # Mostly substring filters with some of every other type
+    keywords = [f"keyword{index}" for index in range(args.filters)]
+    keywords = [random.choice(("", "", "word:", "prefix:", "regex:")) + keyword for keyword in keywords]
+
+    if not args.rate_limits:
+        main.global_send_limiter = main.TokenBucket(float('inf'), float('inf'))
+        main.group_send_limiter = main.ChatRateLimiter(float('inf'), float('inf'))
+        main.private_send_limiter = main.ChatRateLimiter(float('inf'), float('inf'))
+
+    async with application:
+        await main.post_init(application)
+        # Running, so replies handed to Application.create_task are awaited on stop
+        await application.start()
+        owner = main.OWNER_ID
+
+        updates = [traffic.message(chat_id, owner, f"/filter {keyword}", reply_to_user=owner)
+                   for chat_id in chats for keyword in keywords]
+        report("filter_message", *await drive(application, updates, 0, args.concurrency))
+
+        updates = [traffic.chat_message(keywords) for _ in range(args.messages)]
+        report("handle_message", *await drive(application, updates, args.rate, args.concurrency))
+
+        updates = [traffic.message(random.choice(chats), owner, "/warn", reply_to_user=random.choice(users))
+                   for _ in range(args.commands)]
+        report("warn", *await drive(application, updates, 0, args.concurrency))
+
+        updates = [traffic.message(random.choice(chats), owner, "/stats") for _ in range(args.commands)]
+        report("stats", *await drive(application, updates, 0, args.concurrency))
+
+        updates = [traffic.message(random.choice(chats), owner, f"/purge {args.purge}", reply_to_user=owner)
+                   for _ in range(max(1, args.commands // 100))]
+        latencies, elapsed = await drive(application, updates, 0, 1)
+        report("purge", latencies, elapsed, "purges")
+
+        calls = api.calls
+        started = time.perf_counter()
+        await application.process_update(traffic.message(chats[0], owner, "/broadcast benchmark broadcast"))
+        while main._broadcast_job is not None:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        print(f"{'broadcast':<16} {api.calls - calls:>7} {'calls':<8} {(api.calls - calls) / elapsed:>9.0f}/s  "
+              f"took {elapsed:.2f}s  peak rss {peak_rss_mb():>6.1f}MB")
+        await application.stop()
+
+    await main.post_shutdown(application)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=200, help="Synthetic group chats")
+    parser.add_argument('--filters', type=int, default=20, help="Filters per chat")
+    parser.add_argument('--users', type=int, default=5000, help="Distinct message senders")
+    parser.add_argument('--messages', type=int, default=20000, help="Plain messages for handle_message")
+    parser.add_argument('--commands', type=int, default=1000, help="Updates for each command scenario")
+    parser.add_argument('--purge', type=int, default=100, help="Messages deleted by each /purge")
+    parser.add_argument('--rate', type=float, default=0, help="Messages per second to offer (0 = unlimited)")
+    parser.add_argument('--concurrency', type=int, default=main.CONCURRENT_UPDATES, help="Updates in flight")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the fake Bot API takes per call")
+    parser.add_argument('--rate-limits', action='store_true', help="Keep the Bot API send rate limits (20 messages a minute per group)")
+    parser.add_argument('--backend', default=main.STORAGE_BACKEND, help="Storage backend to benchmark")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic traffic")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    main.logger.setLevel(logging.WARNING)
+    # Relative data paths resolve inside the scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='legendbot-bench-'))
+    main.STORAGE_BACKEND = args.backend
+    main.store = main.create_store()
+    main.store.load()
+    print(f"{args.chats} chats x {args.filters} filters, {args.backend} storage, "
+          f"{args.latency * 1000:.0f}ms API latency, data in {os.getcwd()}")
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,93 +1,2504 @@
+import asyncio
+import contextvars
+import cProfile
+import heapq
+import math
 import logging
+import multiprocessing
 import random
+import signal
 import json
 import os
+import pstats
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache, partial, wraps
 from typing import Dict, List, Optional
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, ChatMember
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ChatMemberHandler, MessageHandler, TypeHandler, ContextTypes, filters
+from telegram.request import HTTPXRequest
 import telegram
 
+# The regex parser is only reachable through CPython internals. They moved to re._parser in
+# 3.11, which deprecated the old public sre_parse modules; this is the same parser re.compile
+# uses, so the filter check sees exactly the tree that will run
+try:
+    from re import _constants as sre_constants, _parser as sre_parser
+except ImportError:
+    import sre_constants
+    import sre_parse as sre_parser
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# The scheduler's tick job would otherwise log every run
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+# Configuration
+TOKEN = 'your_bot_token_here'  # Replace with your bot token
+OWNER_ID = 123456789  # Replace with your Telegram user ID
+OWNER_USERNAME = "@yourusername"
+CONCURRENT_UPDATES = 256  # Updates processed at the same time
+
+# Webhook mode receives updates over HTTP instead of long polling
+WEBHOOK_MODE = False
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_SECRET = None  # Compared with the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_URL = None  # Public URL registered with Telegram, e.g. 'https://example.com/telegram'
+
+# Worker processes spread the chats over several cores
+WORKER_PROCESSES = 1  # 1 handles every update in this process; more needs the sharded backend
+
+MUTED_PERMISSIONS = ChatPermissions.no_permissions()
+UNMUTED_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True
+)
+
+# Data storage
+STORAGE_BACKEND = 'sharded'  # 'sharded', 'json' or 'sqlite'
+DATA_FILE = 'legendbot_data.json'
+LOG_FILE = DATA_FILE + '.log'  # Mutations applied since the last snapshot
+COMPACT_THRESHOLD = 1000  # Log records that trigger a background compaction
+LOG_FLUSH_INTERVAL = 0.5  # Seconds buffered log records may wait before being written
+LOG_FLUSH_BATCH = 200  # Buffered log records that force an immediate write
+SQLITE_FILE = 'legendbot_data.db'
+SQLITE_COMMIT_INTERVAL = 0.5  # Seconds a batch of writes may wait before commit
+SQLITE_COMMIT_BATCH = 200  # Pending writes that force an immediate commit
+SHARD_DIR = 'legendbot_data'  # One file per chat plus the bot-wide state
+SHARD_CACHE_SIZE = 2000  # Chats kept in memory before the least recently used is evicted
+SHARD_FLUSH_INTERVAL = 0.5  # Seconds a changed chat may wait before its file is rewritten
+
+class FlushStats:
+    """Counts storage flushes and how long they took."""
+
+    def __init__(self):
+        self.flushes = 0
+        self.records = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, seconds: float, records: int) -> None:
+        self.flushes += 1
+        self.records += records
+        self.total_seconds += seconds
+        self.last_seconds = seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "flushes": self.flushes,
+            "records": self.records,
+            "avg_ms": self.total_seconds / self.flushes * 1000 if self.flushes else 0.0,
+            "last_ms": self.last_seconds * 1000,
+            "max_ms": self.max_seconds * 1000
+        }
+
+class TopCounter:
+    """Per-key counts with a running total and a max-heap for top-N queries.
+
+    Every change pushes the key's new count; outdated heap entries are
+    skipped when read and dropped when the heap grows past twice the
+    number of keys.
+    """
+
+    __slots__ = ('counts', 'total', '_heap')
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self._heap = []
+
+    def add(self, key: int, delta: int) -> None:
+        if not delta:
+            return
+        value = self.counts.get(key, 0) + delta
+        if value:
+            self.counts[key] = value
+        else:
+            self.counts.pop(key, None)
+        self.total += delta
+        if value > 0:
+            heapq.heappush(self._heap, (-value, key))
+        if len(self._heap) > 2 * len(self.counts) + 64:
+            self._heap = [(-value, key) for key, value in self.counts.items() if value > 0]
+            heapq.heapify(self._heap)
+
+    def top(self, limit: int) -> List[tuple]:
+        """Return up to limit (key, count) pairs, highest count first."""
+        result = []
+        seen = set()
+        while self._heap and len(result) < limit:
+            value, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == -value and key not in seen:
+                seen.add(key)
+                result.append((key, -value))
+        for key, value in result:
+            heapq.heappush(self._heap, (-value, key))
+        return result
+
+class StoreStats:
+    """Running totals and per-chat breakdowns, updated on every mutation."""
+
+    KINDS = ('filters', 'warnings', 'messages')
+
+    def __init__(self):
+        self.chats = set()
+        self.filters = TopCounter()
+        self.warnings = TopCounter()
+        self.messages = TopCounter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def scan(cls, chats) -> "StoreStats":
+        """Build the counters from (chat_id, ChatState) pairs."""
+        counters = cls()
+        for chat_id, chat in chats:
+            counters.chat_added(chat_id)
+            counters.filters_changed(chat_id, len(chat.filters))
+            counters.warnings_changed(chat_id, chat.warnings.total())
+        return counters
+
+    def chat_added(self, chat_id: int) -> None:
+        self.chats.add(chat_id)
+
+    def filters_changed(self, chat_id: int, delta: int) -> None:
+        with self._lock:
+            self.filters.add(chat_id, delta)
+
+    def warnings_changed(self, chat_id: int, delta: int) -> None:
+        with self._lock:
+            self.warnings.add(chat_id, delta)
+
+    def message(self, chat_id: int) -> None:
+        with self._lock:
+            self.messages.add(chat_id, 1)
+
+    def totals(self) -> Dict[str, int]:
+        return {
+            "chats": len(self.chats),
+            "filters": self.filters.total,
+            "warnings": self.warnings.total,
+            "messages": self.messages.total
+        }
+
+    def chat_summary(self, chat_id: int) -> Dict[str, int]:
+        return {kind: getattr(self, kind).counts.get(chat_id, 0) for kind in self.KINDS}
+
+    def top(self, kind: str, limit: int) -> List[tuple]:
+        with self._lock:
+            return getattr(self, kind).top(limit)
+
+    def to_json(self, kinds=KINDS) -> dict:
+        data = {kind: {str(chat_id): count for chat_id, count in getattr(self, kind).counts.items()} for kind in kinds}
+        if 'filters' in kinds:
+            data["chats"] = list(self.chats)
+        return data
+
+    def restore(self, data: dict) -> None:
+        """Add counts saved by to_json."""
+        self.chats.update(data.get("chats", []))
+        for kind in self.KINDS:
+            counter = getattr(self, kind)
+            for chat_id, count in data.get(kind, {}).items():
+                counter.add(int(chat_id), count)
+
+class Store(ABC):
+    """Interface every storage backend implements.
+
+    A backend missing one of the abstract methods fails when it is created
+    rather than on the request that first needs the method.
+
+    Backends keep self.counters up to date as they apply mutations, so the
+    statistics below never scan the stored state.
+    """
+
+    flush_stats: FlushStats
+    counters: StoreStats
+    message_counts_key = "message_counts"
+
+    @abstractmethod
+    def load(self) -> None:
+        """Load or open the persisted state."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush(self) -> None:
+        """Make every accepted write durable."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Flush and release resources."""
+        self._save_message_counts()
+        self.flush()
+
+    def _restore_message_counts(self) -> None:
+        """Pick up message counts saved by the previous run."""
+        self.counters.restore({"messages": self.get_meta(self.message_counts_key, {})})
+
+    def _save_message_counts(self) -> None:
+        self.set_meta(self.message_counts_key, self.counters.to_json(('messages',))["messages"])
+
+    @abstractmethod
+    def chat_ids(self) -> List[int]:
+        """Return the ids of all chats with stored state."""
+        raise NotImplementedError
+
+    def prefetch(self, chat_id: int) -> None:
+        """Load a chat's state into memory ahead of the reads handling an update makes."""
+
+    @abstractmethod
+    def get_chat_value(self, chat_id: int, key: str, default=None):
+        """Return a chat setting such as the welcome message or rules."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_chat_value(self, chat_id: int, key: str, value) -> None:
+        """Persist a chat setting."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_warnings(self, chat_id: int, user_id: int) -> List[int]:
+        """Return the times a user was warned in a chat, including decayed warnings."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_warnings(self, chat_id: int, user_id: int, times: List[int]) -> None:
+        """Persist the times of a user's warnings in a chat."""
+        raise NotImplementedError
+
+    def add_warning(self, chat_id: int, user_id: int, at: int, policy: dict) -> int:
+        """Record a warning under a warn policy and return the user's new warning count.
+
+        Decayed warnings are dropped and reaching the last tier starts the
+        count over. Reading and writing in one call on the storage thread
+        keeps concurrent warnings for the same user from overwriting each other.
+        """
+        times = active_warnings(self.get_warnings(chat_id, user_id), policy) + [at]
+        self.set_warnings(chat_id, user_id, [] if len(times) >= policy["tiers"][-1][0] else times)
+        return len(times)
+
+    def remove_warning(self, chat_id: int, user_id: int, policy: dict) -> Optional[int]:
+        """Drop a user's latest active warning and return the count left, or None if there was none."""
+        times = active_warnings(self.get_warnings(chat_id, user_id), policy)
+        if not times:
+            return None
+        times.pop()
+        self.set_warnings(chat_id, user_id, times)
+        return len(times)
+
+    @abstractmethod
+    def get_filters(self, chat_id: int) -> Dict[str, dict]:
+        """Return a copy of a chat's filters in the order they were added.
+
+        A copy, since the storage thread may change the filters while the
+        caller iterates them.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_filter(self, chat_id: int, keyword: str, filter_data: dict) -> None:
+        """Persist a filter reply for a keyword."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_filter(self, chat_id: int, keyword: str) -> bool:
+        """Remove a filter, returning whether it existed."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_gbanned(self, user_id: int) -> bool:
+        """Check if a user is globally banned."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_gban(self, user_id: int) -> bool:
+        """Persist a global ban, returning False if it already existed."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_gbans(self, user_ids: List[int]) -> int:
+        """Persist many global bans at once, returning how many were new."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_gban(self, user_id: int) -> bool:
+        """Lift a global ban, returning whether it existed."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_gbans(self) -> List[int]:
+        """Return all globally banned user IDs."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_sudo_users(self) -> List[int]:
+        """Return all sudo user IDs."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_sudo(self, user_id: int) -> bool:
+        """Persist a new sudo user, returning False if already present."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_sudo(self, user_id: int) -> bool:
+        """Remove a sudo user, returning whether they were present."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Return totals for chats, filters, warnings, messages and gbans."""
+        raise NotImplementedError
+
+    def count_message(self, chat_id: int) -> None:
+        """Count an incoming message towards the chat's activity."""
+        self.counters.message(chat_id)
+
+    def chat_stats(self, chat_id: int) -> Dict[str, int]:
+        """Return a chat's filter, warning and message counts."""
+        return self.counters.chat_summary(chat_id)
+
+    def top_chats(self, kind: str, limit: int) -> List[tuple]:
+        """Return the (chat_id, count) pairs with the most filters, warnings or messages."""
+        return self.counters.top(kind, limit)
+
+    @abstractmethod
+    def get_meta(self, key: str, default=None):
+        """Return bot-wide state that doesn't belong to a chat."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_meta(self, key: str, value) -> None:
+        """Persist bot-wide state; a value of None removes the key."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_scheduled(self) -> Dict[str, dict]:
+        """Return every pending scheduled action keyed by its ID."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_scheduled(self, action_id: str, action: dict) -> None:
+        """Persist a scheduled action, replacing one with the same ID."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_scheduled(self, action_id: str) -> None:
+        """Remove a scheduled action that has fired or been cancelled."""
+        raise NotImplementedError
+
+# CHAT STATE
+def warning_times(count: int, times: Optional[List[int]]) -> List[int]:
+    """Read stored warning times; warnings saved as a bare count have an unknown time of 0."""
+    times = list(times or [])
+    return times + [0] * (count - len(times))
+
+class WarningTable:
+    """Warning times for one chat, in parallel lists sorted by user ID.
+
+    Each user's entry holds the epoch seconds their warnings were issued
+    at. Nothing is removed when warnings decay; readers filter by age.
+    """
+
+    __slots__ = ('user_ids', 'times')
+
+    def __init__(self):
+        self.user_ids = array('q')
+        self.times: List[array] = []
+
+    def get(self, user_id: int) -> List[int]:
+        index = bisect_left(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            return list(self.times[index])
+        return []
+
+    def set(self, user_id: int, times: List[int]) -> None:
+        """Store a user's warning times; an empty list drops the user's entry."""
+        index = bisect_left(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            if times:
+                self.times[index] = array('q', times)
+            else:
+                del self.user_ids[index]
+                del self.times[index]
+        elif times:
+            self.user_ids.insert(index, user_id)
+            self.times.insert(index, array('q', times))
+
+    def items(self):
+        return zip(self.user_ids, self.times)
+
+    def total(self) -> int:
+        return sum(len(times) for times in self.times)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+class FilterSet:
+    """A chat's filter replies keyed by keyword, in the order they were added."""
+
+    __slots__ = ('entries',)
+
+    def __init__(self, entries: Optional[Dict[str, dict]] = None):
+        self.entries = entries if entries is not None else {}
+
+    def put(self, keyword: str, filter_data: dict) -> None:
+        self.entries[keyword] = filter_data
+
+    def delete(self, keyword: str) -> bool:
+        return self.entries.pop(keyword, None) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class ChatState:
+    """Everything stored for one chat.
+
+    The serialized form is the original flat layout, where settings,
+    "filters" and str(user_id) -> {"warnings": n, "at": [times]} entries
+    share one dict.
+    """
+
+    __slots__ = ('settings', 'filters', 'warnings')
+
+    def __init__(self):
+        self.settings = {}
+        self.filters = FilterSet()
+        self.warnings = WarningTable()
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ChatState":
+        chat = cls()
+        for key, value in data.items():
+            if key == "filters":
+                chat.filters = FilterSet(value)
+            elif isinstance(value, dict) and "warnings" in value:
+                chat.warnings.set(int(key), warning_times(value["warnings"], value.get("at")))
+            else:
+                chat.settings[key] = value
+        return chat
+
+    def to_json(self) -> dict:
+        data = dict(self.settings)
+        if self.filters.entries:
+            data["filters"] = self.filters.entries
+        for user_id, times in self.warnings.items():
+            data[str(user_id)] = {"warnings": len(times), "at": list(times)}
+        return data
+
+class JsonStore(Store):
+    """JSON snapshot plus an append-only log of mutations.
+
+    Each write is applied in memory at once and buffered as a log record.
+    Buffered records are appended together after LOG_FLUSH_INTERVAL seconds
+    or LOG_FLUSH_BATCH records, and repeated writes to the same setting,
+    warning count or meta key within that window are coalesced into one.
+    The full snapshot is only rewritten by compaction, which runs in the
+    background.
+    """
+
+    def __init__(self, data_file: str = DATA_FILE, log_file: str = LOG_FILE):
+        self.data_file = data_file
+        self.log_file = log_file
+        self.chats: Dict[int, ChatState] = {}
+        self.gbans = set()
+        self.sudo_users = []
+        self.meta = {}
+        self.scheduled = {}
+        self._lock = threading.RLock()
+        self._log_handle = None
+        self._log_records = 0
+        self._compacting = False
+        self._pending = OrderedDict()  # Buffered log records, keyed for coalescing
+        self._pending_seq = 0
+        self._flush_timer = None
+        self.flush_stats = FlushStats()
+        self.counters = StoreStats()
+
+    def _chat(self, chat_key: str) -> ChatState:
+        chat_id = int(chat_key)
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatState()
+            self.counters.chat_added(chat_id)
+        return chat
+
+    def _apply_record(self, record: dict) -> None:
+        """Apply a single mutation record to the in-memory state."""
+        op = record["op"]
+        if op == "set":
+            self._chat(record["chat"]).settings[record["key"]] = record["value"]
+        elif op == "warn":
+            warnings = self._chat(record["chat"]).warnings
+            user_id = int(record["user"])
+            times = warning_times(record["count"], record.get("at"))
+            self.counters.warnings_changed(int(record["chat"]), len(times) - len(warnings.get(user_id)))
+            warnings.set(user_id, times)
+        elif op == "filter":
+            filters = self._chat(record["chat"]).filters
+            if record["keyword"] not in filters.entries:
+                self.counters.filters_changed(int(record["chat"]), 1)
+            filters.put(record["keyword"], record["value"])
+        elif op == "unfilter":
+            if self._chat(record["chat"]).filters.delete(record["keyword"]):
+                self.counters.filters_changed(int(record["chat"]), -1)
+        elif op == "gban":
+            self.gbans.add(record["user"])
+        elif op == "gban_bulk":
+            self.gbans.update(record["users"])
+        elif op == "ungban":
+            self.gbans.discard(record["user"])
+        elif op == "sudo_add":
+            if record["user"] not in self.sudo_users:
+                self.sudo_users.append(record["user"])
+        elif op == "sudo_remove":
+            if record["user"] in self.sudo_users:
+                self.sudo_users.remove(record["user"])
+        elif op == "meta":
+            if record["value"] is None:
+                self.meta.pop(record["key"], None)
+            else:
+                self.meta[record["key"]] = record["value"]
+        elif op == "schedule":
+            self.scheduled[record["id"]] = record["action"]
+        elif op == "unschedule":
+            self.scheduled.pop(record["id"], None)
+        else:
+            logger.warning(f"Skipping unknown log record: {record}")
+
+    def _replay_log(self, path: str) -> int:
+        """Replay a mutation log on top of the loaded snapshot."""
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        complete = 0  # Bytes up to the end of the last line that was whole or applied
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line means the process died mid-append
+                    logger.warning(f"Ignoring corrupt record in {path}")
+                    if line.endswith(b'\n'):
+                        complete += len(line)
+                    continue
+                self._apply_record(record)
+                replayed += 1
+                complete += len(line)
+        # Records appended after an unterminated line would be glued onto it
+        if complete < os.path.getsize(path):
+            os.truncate(path, complete)
+        elif complete and not line.endswith(b'\n'):
+            with open(path, 'ab') as f:
+                f.write(b'\n')
+        return replayed
+
+    def load(self) -> None:
+        with self._lock:
+            try:
+                if os.path.exists(self.data_file):
+                    with open(self.data_file, 'r') as f:
+                        data = json.load(f)
+                    chats = data.get('user_data', {})
+                    self.sudo_users = data.get('sudo_users', [])
+                    # Older snapshots kept the gban list among the chats
+                    self.gbans = set(data.get('gbans', chats.pop('gban', [])))
+                    self.chats = {int(chat_id): ChatState.from_json(chat) for chat_id, chat in chats.items()}
+                    self.meta = data.get('meta', {})
+                    self.scheduled = data.get('scheduled', {})
+                # A leftover rotated log means a compaction did not finish
+                self._log_records = self._replay_log(self.log_file + '.1') + self._replay_log(self.log_file)
+                self.counters = StoreStats.scan(self.chats.items())
+                self._restore_message_counts()
+                logger.info(f"Data loaded successfully ({self._log_records} log records replayed)")
+            except Exception as e:
+                logger.error(f"Error loading data: {e}")
+            if self._log_handle is not None:
+                self._log_handle.close()
+            self._log_handle = open(self.log_file, 'a')
+
+    def _pending_key(self, record: dict) -> tuple:
+        """Key under which a buffered record replaces an earlier one."""
+        op = record["op"]
+        if op == "set":
+            return (op, record["chat"], record["key"])
+        if op == "warn":
+            return (op, record["chat"], record["user"])
+        if op == "meta":
+            return (op, record["key"])
+        if op in ("schedule", "unschedule"):
+            return ("schedule", record["id"])
+        # Order-sensitive records are never coalesced
+        self._pending_seq += 1
+        return (self._pending_seq,)
+
+    def _commit(self, record: dict) -> None:
+        """Apply a mutation and buffer it for the log."""
+        with self._lock:
+            self._apply_record(record)
+            self._pending[self._pending_key(record)] = record
+            if len(self._pending) >= LOG_FLUSH_BATCH:
+                self._write_pending()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(LOG_FLUSH_INTERVAL, self._write_pending)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _write_pending(self) -> None:
+        """Append every buffered record to the log in one write."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._pending:
+                return
+            started = time.perf_counter()
+            records = list(self._pending.values())
+            self._pending.clear()
+            try:
+                self._log_handle.write(''.join(json.dumps(record) + '\n' for record in records))
+                self._log_handle.flush()
+                self._log_records += len(records)
+            except Exception as e:
+                logger.error(f"Error writing log records: {e}")
+            self.flush_stats.record(time.perf_counter() - started, len(records))
+            if self._log_records >= COMPACT_THRESHOLD and not self._compacting:
+                threading.Thread(target=self.compact, name="compaction", daemon=True).start()
+
+    def compact(self) -> None:
+        """Fold the mutation log into a fresh snapshot."""
+        with self._lock:
+            if self._compacting:
+                return
+            self._write_pending()
+            self._compacting = True
+            try:
+                # Serializing under the lock gives a snapshot consistent with the log rotation
+                snapshot = json.dumps({
+                    'user_data': {str(chat_id): chat.to_json() for chat_id, chat in self.chats.items()},
+                    'gbans': list(self.gbans),
+                    'sudo_users': self.sudo_users,
+                    'meta': self.meta,
+                    'scheduled': self.scheduled
+                })
+                self._log_handle.close()
+                rotated = self.log_file + '.1'
+                if os.path.exists(rotated):
+                    # Previous compaction failed; keep its records until this one succeeds
+                    with open(self.log_file, 'r') as src, open(rotated, 'a') as dst:
+                        dst.write(src.read())
+                    os.remove(self.log_file)
+                elif os.path.exists(self.log_file):
+                    os.replace(self.log_file, rotated)
+                self._log_handle = open(self.log_file, 'a')
+                self._log_records = 0
+            except Exception as e:
+                logger.error(f"Error rotating log: {e}")
+                self._compacting = False
+                return
+        try:
+            tmp_file = self.data_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.data_file)
+            os.remove(self.log_file + '.1')
+            logger.info("Data compacted successfully")
+        except Exception as e:
+            logger.error(f"Error compacting data: {e}")
+        finally:
+            self._compacting = False
+
+    def flush(self) -> None:
+        self._write_pending()
+        self.compact()
+
+    def chat_ids(self) -> List[int]:
+        with self._lock:
+            return list(self.chats)
+
+    def get_chat_value(self, chat_id: int, key: str, default=None):
+        chat = self.chats.get(chat_id)
+        return chat.settings.get(key, default) if chat else default
+
+    def set_chat_value(self, chat_id: int, key: str, value) -> None:
+        self._commit({"op": "set", "chat": str(chat_id), "key": key, "value": value})
+
+    def get_warnings(self, chat_id: int, user_id: int) -> List[int]:
+        chat = self.chats.get(chat_id)
+        return chat.warnings.get(user_id) if chat else []
+
+    def set_warnings(self, chat_id: int, user_id: int, times: List[int]) -> None:
+        self._commit({"op": "warn", "chat": str(chat_id), "user": str(user_id), "count": len(times), "at": times})
+
+    def get_filters(self, chat_id: int) -> Dict[str, dict]:
+        with self._lock:
+            chat = self.chats.get(chat_id)
+            return dict(chat.filters.entries) if chat else {}
+
+    def put_filter(self, chat_id: int, keyword: str, filter_data: dict) -> None:
+        self._commit({"op": "filter", "chat": str(chat_id), "keyword": keyword, "value": filter_data})
+
+    def delete_filter(self, chat_id: int, keyword: str) -> bool:
+        with self._lock:
+            chat = self.chats.get(chat_id)
+            if not chat or keyword not in chat.filters.entries:
+                return False
+            self._commit({"op": "unfilter", "chat": str(chat_id), "keyword": keyword})
+            return True
+
+    def is_gbanned(self, user_id: int) -> bool:
+        return user_id in self.gbans
+
+    def add_gban(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id in self.gbans:
+                return False
+            self._commit({"op": "gban", "user": user_id})
+            return True
+
+    def add_gbans(self, user_ids: List[int]) -> int:
+        with self._lock:
+            new_ids = list(set(user_ids) - self.gbans)
+            if new_ids:
+                self._commit({"op": "gban_bulk", "users": new_ids})
+            return len(new_ids)
+
+    def remove_gban(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id not in self.gbans:
+                return False
+            self._commit({"op": "ungban", "user": user_id})
+            return True
+
+    def get_gbans(self) -> List[int]:
+        with self._lock:
+            return list(self.gbans)
+
+    def get_sudo_users(self) -> List[int]:
+        return list(self.sudo_users)
+
+    def add_sudo(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id in self.sudo_users:
+                return False
+            self._commit({"op": "sudo_add", "user": user_id})
+            return True
+
+    def remove_sudo(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id not in self.sudo_users:
+                return False
+            self._commit({"op": "sudo_remove", "user": user_id})
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters.totals(), gbans=len(self.gbans))
+
+    def get_meta(self, key: str, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key: str, value) -> None:
+        self._commit({"op": "meta", "key": key, "value": value})
+
+    def get_scheduled(self) -> Dict[str, dict]:
+        with self._lock:
+            return dict(self.scheduled)
+
+    def put_scheduled(self, action_id: str, action: dict) -> None:
+        self._commit({"op": "schedule", "id": action_id, "action": action})
+
+    def delete_scheduled(self, action_id: str) -> None:
+        with self._lock:
+            if action_id in self.scheduled:
+                self._commit({"op": "unschedule", "id": action_id})
+
+class ReplicaStore(JsonStore):
+    """A worker process's copy of the bot-wide state the supervisor owns.
+
+    Writes are applied here at once and handed to publish, which sends the
+    record to the supervisor to be logged and relayed to every worker.
+    Nothing is written to disk.
+    """
+
+    def __init__(self, snapshot: dict, publish):
+        super().__init__(os.devnull, os.devnull)
+        self.gbans = set(snapshot["gbans"])
+        self.sudo_users = snapshot["sudo_users"]
+        self.meta = snapshot["meta"]
+        self.publish = publish
+
+    def load(self) -> None:
+        pass
+
+    def _commit(self, record: dict) -> None:
+        with self._lock:
+            self._apply_record(record)
+        self.publish(record)
+
+    def apply(self, record: dict) -> None:
+        """Apply a record relayed by the supervisor."""
+        with self._lock:
+            self._apply_record(record)
+
+    def flush(self) -> None:
+        pass
+
+class SqliteStore(Store):
+    """SQLite database with one indexed table per kind of record.
+
+    Lookups are point reads on the primary keys, so nothing is held in
+    memory. Writes are grouped into batched transactions that commit after
+    SQLITE_COMMIT_BATCH writes or SQLITE_COMMIT_INTERVAL seconds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS warnings (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            at TEXT NOT NULL DEFAULT '[]',
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS filters (
+            chat_id INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (chat_id, keyword)
+        );
+        CREATE TABLE IF NOT EXISTS gbans (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS sudo_users (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS scheduled (
+            action_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str = SQLITE_FILE):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._commit_timer = None
+        self.flush_stats = FlushStats()
+        self.counters = StoreStats()
+        self._gban_count = 0
+
+    def load(self) -> None:
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            # Databases from before warnings were timestamped only have the count
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(warnings)")]
+            if 'at' not in columns:
+                self._conn.execute("ALTER TABLE warnings ADD COLUMN at TEXT NOT NULL DEFAULT '[]'")
+            empty = self._conn.execute("SELECT NOT EXISTS (SELECT 1 FROM chats)").fetchone()[0]
+            if empty and os.path.exists(DATA_FILE):
+                self._import_json()
+            self._load_counters()
+            logger.info("Database opened successfully")
+
+    def _load_counters(self) -> None:
+        """Aggregate the tables once so later statistics are incremental."""
+        self.counters = StoreStats()
+        for (chat_id,) in self._conn.execute("SELECT chat_id FROM chats"):
+            self.counters.chat_added(chat_id)
+        for chat_id, count in self._conn.execute("SELECT chat_id, COUNT(*) FROM filters GROUP BY chat_id"):
+            self.counters.filters_changed(chat_id, count)
+        for chat_id, total in self._conn.execute("SELECT chat_id, SUM(count) FROM warnings GROUP BY chat_id"):
+            self.counters.warnings_changed(chat_id, total)
+        self._gban_count = self._conn.execute("SELECT COUNT(*) FROM gbans").fetchone()[0]
+        self._restore_message_counts()
+
+    def _import_json(self) -> None:
+        """Copy the state of an existing JSON store into the database."""
+        source = JsonStore()
+        source.load()
+        for chat_id, chat in source.chats.items():
+            for key, value in chat.settings.items():
+                self.set_chat_value(chat_id, key, value)
+            for keyword, filter_data in chat.filters.entries.items():
+                self.put_filter(chat_id, keyword, filter_data)
+            for user_id, times in chat.warnings.items():
+                self.set_warnings(chat_id, user_id, list(times))
+        self.add_gbans(list(source.gbans))
+        for user_id in source.sudo_users:
+            self.add_sudo(user_id)
+        for key, value in source.meta.items():
+            self.set_meta(key, value)
+        for action_id, action in source.scheduled.items():
+            self.put_scheduled(action_id, action)
+        self.flush()
+        logger.info(f"Imported {len(source.chats)} chats from {DATA_FILE}")
+
+    def _write(self, sql: str, params: tuple, chat_id: Optional[int] = None) -> int:
+        """Run a write inside the current batch and return the affected row count."""
+        with self._lock:
+            if chat_id is not None:
+                self._conn.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+                self.counters.chat_added(chat_id)
+            rowcount = self._conn.execute(sql, params).rowcount
+            self._pending += 1
+            if self._pending >= SQLITE_COMMIT_BATCH:
+                self.flush()
+            elif self._commit_timer is None:
+                self._commit_timer = threading.Timer(SQLITE_COMMIT_INTERVAL, self.flush)
+                self._commit_timer.daemon = True
+                self._commit_timer.start()
+            return rowcount
+
+    def _write_many(self, sql: str, rows: List[tuple]) -> int:
+        """Run one statement over many rows as a single batch."""
+        with self._lock:
+            rowcount = self._conn.executemany(sql, rows).rowcount
+            self._pending += 1
+            self.flush()
+            return rowcount
+
+    def _read_one(self, sql: str, params: tuple):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self._pending:
+                started = time.perf_counter()
+                try:
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error committing data: {e}")
+                self.flush_stats.record(time.perf_counter() - started, self._pending)
+                self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._save_message_counts()
+            self.flush()
+            self._conn.close()
+
+    def chat_ids(self) -> List[int]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT chat_id FROM chats")]
+
+    def get_chat_value(self, chat_id: int, key: str, default=None):
+        row = self._read_one("SELECT value FROM chat_settings WHERE chat_id = ? AND key = ?", (chat_id, key))
+        return json.loads(row[0]) if row else default
+
+    def set_chat_value(self, chat_id: int, key: str, value) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO chat_settings (chat_id, key, value) VALUES (?, ?, ?)",
+            (chat_id, key, json.dumps(value)), chat_id
+        )
+
+    def get_warnings(self, chat_id: int, user_id: int) -> List[int]:
+        row = self._read_one("SELECT count, at FROM warnings WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        return warning_times(row[0], json.loads(row[1])) if row else []
+
+    def set_warnings(self, chat_id: int, user_id: int, times: List[int]) -> None:
+        with self._lock:
+            self.counters.warnings_changed(chat_id, len(times) - len(self.get_warnings(chat_id, user_id)))
+            self._write(
+                "INSERT OR REPLACE INTO warnings (chat_id, user_id, count, at) VALUES (?, ?, ?, ?)",
+                (chat_id, user_id, len(times), json.dumps(times)), chat_id
+            )
+
+    def get_filters(self, chat_id: int) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT keyword, data FROM filters WHERE chat_id = ? ORDER BY rowid", (chat_id,)
+            ).fetchall()
+        return {keyword: json.loads(data) for keyword, data in rows}
+
+    def put_filter(self, chat_id: int, keyword: str, filter_data: dict) -> None:
+        with self._lock:
+            if self._read_one("SELECT 1 FROM filters WHERE chat_id = ? AND keyword = ?", (chat_id, keyword)) is None:
+                self.counters.filters_changed(chat_id, 1)
+            # Upsert keeps the rowid, so a replaced filter keeps its matching priority
+            self._write(
+                "INSERT INTO filters (chat_id, keyword, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id, keyword) DO UPDATE SET data = excluded.data",
+                (chat_id, keyword, json.dumps(filter_data)), chat_id
+            )
+
+    def delete_filter(self, chat_id: int, keyword: str) -> bool:
+        with self._lock:
+            if self._write("DELETE FROM filters WHERE chat_id = ? AND keyword = ?", (chat_id, keyword)) == 0:
+                return False
+            self.counters.filters_changed(chat_id, -1)
+            return True
+
+    def is_gbanned(self, user_id: int) -> bool:
+        return self._read_one("SELECT 1 FROM gbans WHERE user_id = ?", (user_id,)) is not None
+
+    def add_gban(self, user_id: int) -> bool:
+        return self.add_gbans([user_id]) > 0
+
+    def add_gbans(self, user_ids: List[int]) -> int:
+        with self._lock:
+            added = self._write_many("INSERT OR IGNORE INTO gbans (user_id) VALUES (?)", [(user_id,) for user_id in user_ids])
+            self._gban_count += added
+            return added
+
+    def remove_gban(self, user_id: int) -> bool:
+        with self._lock:
+            if self._write("DELETE FROM gbans WHERE user_id = ?", (user_id,)) == 0:
+                return False
+            self._gban_count -= 1
+            return True
+
+    def get_gbans(self) -> List[int]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT user_id FROM gbans")]
+
+    def get_sudo_users(self) -> List[int]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT user_id FROM sudo_users ORDER BY rowid")]
+
+    def add_sudo(self, user_id: int) -> bool:
+        return self._write("INSERT OR IGNORE INTO sudo_users (user_id) VALUES (?)", (user_id,)) > 0
+
+    def remove_sudo(self, user_id: int) -> bool:
+        return self._write("DELETE FROM sudo_users WHERE user_id = ?", (user_id,)) > 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters.totals(), gbans=self._gban_count)
+
+    def get_meta(self, key: str, default=None):
+        row = self._read_one("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        if value is None:
+            self._write("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self._write("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_scheduled(self) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT action_id, data FROM scheduled").fetchall()
+        return {action_id: json.loads(data) for action_id, data in rows}
+
+    def put_scheduled(self, action_id: str, action: dict) -> None:
+        self._write("INSERT OR REPLACE INTO scheduled (action_id, data) VALUES (?, ?)", (action_id, json.dumps(action)))
+
+    def delete_scheduled(self, action_id: str) -> None:
+        self._write("DELETE FROM scheduled WHERE action_id = ?", (action_id,))
+
+class ShardedStore(Store):
+    """One JSON file per chat, loaded on first access and evicted when idle.
+
+    Chat state lives in SHARD_DIR/chats/<chat_id>.json with the same layout
+    as a JsonStore chat. Only the SHARD_CACHE_SIZE most recently used chats
+    are kept in memory. Changed chats are rewritten whole, through a temp
+    file and a rename, at most every SHARD_FLUSH_INTERVAL seconds. Bot-wide
+    state (gbans, sudo users, meta) is small and is kept in a JsonStore
+    inside the same directory, as are the scheduled actions.
+
+    The statistics counters are saved to stats.json on shutdown and the
+    file is removed once read, so only a run that didn't shut down
+    cleanly has to rebuild them from every shard.
+
+    A worker process passes its index and a ReplicaStore for the bot-wide
+    state; its counters then only cover the chats routed to it and are
+    saved separately from the other workers', as are its scheduled actions.
+    """
+
+    def __init__(self, shard_dir: str = SHARD_DIR, worker: Optional[int] = None,
+                 globals_store: Optional[JsonStore] = None):
+        self.shard_dir = shard_dir
+        self.worker = worker
+        self.chats_dir = os.path.join(shard_dir, 'chats')
+        global_file = os.path.join(shard_dir, 'global.json')
+        self.globals = globals_store or JsonStore(global_file, global_file + '.log')
+        if worker is None:
+            self.stats_file = os.path.join(shard_dir, 'stats.json')
+            timers_file = os.path.join(shard_dir, 'scheduled.json')
+        else:
+            self.stats_file = os.path.join(shard_dir, f'stats-{worker}.json')
+            self.message_counts_key = f"message_counts:{worker}"
+            timers_file = os.path.join(shard_dir, f'scheduled-{worker}.json')
+        self.timers = JsonStore(timers_file, timers_file + '.log')
+        self._chats: "OrderedDict[int, ChatState]" = OrderedDict()  # Least recently used first
+        self._dirty = set()
+        self._unwritten: Dict[int, str] = {}  # Serialized shards not yet on disk
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()  # Keeps flushes writing in the order they were taken
+        self._flush_timer = None
+        self.flush_stats = FlushStats()
+        self.counters = StoreStats()
+
+    def load(self) -> None:
+        with self._lock:
+            self.load_globals()
+            self.timers.load()
+            self._load_counters()
+            logger.info(f"Shard directory {self.shard_dir} opened successfully")
+
+    def load_globals(self) -> None:
+        """Create the shard directory, importing DATA_FILE on first start, and load the bot-wide state."""
+        migrate = not os.path.isdir(self.shard_dir) and os.path.exists(DATA_FILE)
+        os.makedirs(self.chats_dir, exist_ok=True)
+        self.globals.load()
+        if migrate:
+            self._import_json()
+        if self.worker is None:
+            self._rehome()
+
+    def _rehome(self) -> None:
+        """Move per-worker state to where the current WORKER_PROCESSES expects it.
+
+        Scheduled actions, saved statistics and message counts are kept per
+        worker, and which worker owns a chat depends on the number of
+        workers. When that differs from the run that saved them, pending
+        actions and message counts are regrouped by chat and the statistics
+        are dropped, so each process rebuilds them for the chats it now owns.
+        Runs in the process holding the bot-wide state, before any worker
+        opens its files.
+        """
+        if self.globals.get_meta("worker_processes") == WORKER_PROCESSES:
+            return
+        single = WORKER_PROCESSES == 1
+        
+        def timers_name(chat_id: int) -> str:
+            return 'scheduled.json' if single else f'scheduled-{worker_for(chat_id)}.json'
+        
+        def counts_key(chat_id: int) -> str:
+            return 'message_counts' if single else f'message_counts:{worker_for(chat_id)}'
+        
+        timers: Dict[str, JsonStore] = {}
+        def open_timers(name: str) -> JsonStore:
+            if name not in timers:
+                path = os.path.join(self.shard_dir, name)
+                timers[name] = JsonStore(path, path + '.log')
+                timers[name].load()
+            return timers[name]
+        for file_name in sorted(os.listdir(self.shard_dir)):
+            match = re.match(r'(scheduled(?:-\d+)?\.json)(?:\.log(?:\.1)?)?$', file_name)
+            if match:
+                open_timers(match.group(1))
+            elif re.match(r'stats(?:-\d+)?\.json$', file_name):
+                os.remove(os.path.join(self.shard_dir, file_name))
+        moved = 0
+        for name, source in list(timers.items()):
+            for action_id, action in source.get_scheduled().items():
+                target = timers_name(action["chat"])
+                if target != name:
+                    open_timers(target).put_scheduled(action_id, action)
+                    source.delete_scheduled(action_id)
+                    moved += 1
+        # The new files are complete before the old ones are removed
+        layout = {timers_name(chat_id) for chat_id in range(WORKER_PROCESSES)}
+        for name in sorted(timers, key=lambda name: name not in layout):
+            timer_store = timers[name]
+            timer_store.flush()
+            timer_store._log_handle.close()
+            if name not in layout:
+                path = os.path.join(self.shard_dir, name)
+                for leftover in (path, path + '.log', path + '.log.1'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+        
+        with self.globals._lock:
+            keys = [key for key in self.globals.meta if key == 'message_counts' or key.startswith('message_counts:')]
+        counts: Dict[str, dict] = {}
+        for key in keys:
+            for chat_id, count in self.globals.get_meta(key, {}).items():
+                owner = counts.setdefault(counts_key(int(chat_id)), {})
+                owner[chat_id] = owner.get(chat_id, 0) + count
+            self.globals.set_meta(key, None)
+        for key, value in counts.items():
+            self.globals.set_meta(key, value)
+        self.globals.set_meta("worker_processes", WORKER_PROCESSES)
+        self.globals.flush()
+        logger.info(f"Rehomed {moved} scheduled actions for {WORKER_PROCESSES} worker processes")
+
+    def owns(self, chat_id: int) -> bool:
+        """Whether this store's process handles the chat."""
+        return self.worker is None or worker_for(chat_id) == self.worker
+
+    def _load_counters(self) -> None:
+        self.counters = StoreStats()
+        try:
+            with open(self.stats_file, 'r') as f:
+                self.counters.restore(json.load(f))
+            os.remove(self.stats_file)
+        except FileNotFoundError:
+            logger.info("No saved statistics, rebuilding them from the shards")
+            self.counters = StoreStats.scan(
+                (chat_id, self._read_shard(chat_id) or ChatState())
+                for chat_id in self.chat_ids() if self.owns(chat_id)
+            )
+        except Exception as e:
+            logger.error(f"Error loading statistics: {e}")
+        self._restore_message_counts()
+
+    def _save_counters(self) -> None:
+        try:
+            tmp_file = self.stats_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.counters.to_json(('filters', 'warnings')), f)
+            os.replace(tmp_file, self.stats_file)
+        except Exception as e:
+            logger.error(f"Error saving statistics: {e}")
+
+    def _import_json(self) -> None:
+        """Split the state of an existing JSON store into shards."""
+        source = JsonStore()
+        source.load()
+        for chat_id, chat in source.chats.items():
+            self._write_shard(chat_id, json.dumps(chat.to_json()))
+        self.globals.add_gbans(list(source.gbans))
+        for user_id in source.sudo_users:
+            self.globals.add_sudo(user_id)
+        for key, value in source.meta.items():
+            self.globals.set_meta(key, value)
+        self.globals.flush()
+        if source.scheduled:
+            # Imported before load() opens the timers, so open them here
+            self.timers.load()
+            for action_id, action in source.scheduled.items():
+                self.timers.put_scheduled(action_id, action)
+            self.timers.flush()
+        logger.info(f"Imported {len(source.chats)} chats from {DATA_FILE}")
+
+    def _shard_path(self, chat_id: int) -> str:
+        return os.path.join(self.chats_dir, f"{chat_id}.json")
+
+    def _read_shard(self, chat_id: int) -> Optional[ChatState]:
+        path = self._shard_path(chat_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return ChatState.from_json(json.load(f))
+        except Exception as e:
+            logger.error(f"Error loading shard {path}: {e}")
+            return None
+
+    def _write_shard(self, chat_id: int, text: str) -> None:
+        path = self._shard_path(chat_id)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+
+    def prefetch(self, chat_id: int) -> None:
+        self._chat(chat_id)
+
+    def _chat(self, chat_id: int) -> ChatState:
+        """Return a chat's state, loading its shard on first access.
+
+        The shard is read without holding the lock, so a miss doesn't hold
+        up lookups of cached chats.
+        """
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                self._chats.move_to_end(chat_id)
+                return chat
+            text = self._unwritten.get(chat_id)
+        if text is not None:
+            loaded = ChatState.from_json(json.loads(text))
+        else:
+            loaded = self._read_shard(chat_id) or ChatState()
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                # Loaded by another thread in the meantime
+                self._chats.move_to_end(chat_id)
+                return chat
+            self._chats[chat_id] = loaded
+            while len(self._chats) > SHARD_CACHE_SIZE:
+                evicted_id, evicted = self._chats.popitem(last=False)
+                if evicted_id in self._dirty:
+                    # Written by the next flush; read back from here until then
+                    self._dirty.discard(evicted_id)
+                    self._unwritten[evicted_id] = json.dumps(evicted.to_json())
+            return loaded
+
+    def _mark_dirty(self, chat_id: int) -> None:
+        with self._lock:
+            self.counters.chat_added(chat_id)
+            self._dirty.add(chat_id)
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(SHARD_FLUSH_INTERVAL, self._flush_shards)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_shards(self) -> None:
+        """Write changed shards to disk.
+
+        Only serializing them holds the lock; the files are written after
+        it is released, so lookups on the event loop don't wait for the disk.
+        """
+        self._lock.acquire()
+        try:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            for chat_id in self._dirty:
+                self._unwritten[chat_id] = json.dumps(self._chats[chat_id].to_json())
+            self._dirty.clear()
+            pending = dict(self._unwritten)
+            if not pending:
+                return
+            # Taken before the lock is released, so a later flush can't overtake this one
+            self._write_lock.acquire()
+        finally:
+            self._lock.release()
+        written = []
+        try:
+            started = time.perf_counter()
+            for chat_id, text in pending.items():
+                try:
+                    self._write_shard(chat_id, text)
+                    written.append(chat_id)
+                except Exception as e:
+                    logger.error(f"Error saving shard for chat {chat_id}: {e}")
+            self.flush_stats.record(time.perf_counter() - started, len(pending))
+        finally:
+            self._write_lock.release()
+        with self._lock:
+            for chat_id in written:
+                # A newer version may have been queued while this one was written
+                if self._unwritten.get(chat_id) is pending[chat_id]:
+                    del self._unwritten[chat_id]
+            if len(written) < len(pending):
+                self._schedule_flush()
+
+    def flush(self) -> None:
+        self._flush_shards()
+        self.globals.flush()
+        self.timers.flush()
+
+    def close(self) -> None:
+        self._save_message_counts()
+        self._flush_shards()
+        self._save_counters()
+        # Not globals.close(), which would save its own, empty message counts
+        self.globals.flush()
+        self.timers.flush()
+
+    def chat_ids(self) -> List[int]:
+        with self._lock:
+            chat_ids = self._dirty | set(self._unwritten)
+        chat_ids.update(int(name[:-5]) for name in os.listdir(self.chats_dir) if name.endswith('.json'))
+        return list(chat_ids)
+
+    def get_chat_value(self, chat_id: int, key: str, default=None):
+        return self._chat(chat_id).settings.get(key, default)
+
+    @contextmanager
+    def _changing(self, chat_id: int):
+        """Hold the lock over a cached chat's state while it is changed.
+
+        The shard is loaded before the lock is taken, so a cache miss doesn't
+        hold up lookups of other chats while the file is read. If the chat
+        was evicted in between, it is loaded again.
+        """
+        while True:
+            chat = self._chat(chat_id)
+            with self._lock:
+                if self._chats.get(chat_id) is chat:
+                    yield chat
+                    return
+
+    def set_chat_value(self, chat_id: int, key: str, value) -> None:
+        with self._changing(chat_id) as chat:
+            chat.settings[key] = value
+            self._mark_dirty(chat_id)
+
+    def get_warnings(self, chat_id: int, user_id: int) -> List[int]:
+        return self._chat(chat_id).warnings.get(user_id)
+
+    def set_warnings(self, chat_id: int, user_id: int, times: List[int]) -> None:
+        with self._changing(chat_id) as chat:
+            warnings = chat.warnings
+            self.counters.warnings_changed(chat_id, len(times) - len(warnings.get(user_id)))
+            warnings.set(user_id, times)
+            self._mark_dirty(chat_id)
+
+    def get_filters(self, chat_id: int) -> Dict[str, dict]:
+        chat = self._chat(chat_id)
+        with self._lock:
+            return dict(chat.filters.entries)
+
+    def put_filter(self, chat_id: int, keyword: str, filter_data: dict) -> None:
+        with self._changing(chat_id) as chat:
+            filters = chat.filters
+            if keyword not in filters.entries:
+                self.counters.filters_changed(chat_id, 1)
+            filters.put(keyword, filter_data)
+            self._mark_dirty(chat_id)
+
+    def delete_filter(self, chat_id: int, keyword: str) -> bool:
+        with self._changing(chat_id) as chat:
+            if not chat.filters.delete(keyword):
+                return False
+            self.counters.filters_changed(chat_id, -1)
+            self._mark_dirty(chat_id)
+            return True
+
+    def is_gbanned(self, user_id: int) -> bool:
+        return self.globals.is_gbanned(user_id)
+
+    def add_gban(self, user_id: int) -> bool:
+        return self.globals.add_gban(user_id)
+
+    def add_gbans(self, user_ids: List[int]) -> int:
+        return self.globals.add_gbans(user_ids)
+
+    def remove_gban(self, user_id: int) -> bool:
+        return self.globals.remove_gban(user_id)
+
+    def get_gbans(self) -> List[int]:
+        return self.globals.get_gbans()
+
+    def get_sudo_users(self) -> List[int]:
+        return self.globals.get_sudo_users()
+
+    def add_sudo(self, user_id: int) -> bool:
+        return self.globals.add_sudo(user_id)
+
+    def remove_sudo(self, user_id: int) -> bool:
+        return self.globals.remove_sudo(user_id)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters.totals(), gbans=len(self.globals.gbans))
+
+    def get_meta(self, key: str, default=None):
+        return self.globals.get_meta(key, default)
+
+    def set_meta(self, key: str, value) -> None:
+        self.globals.set_meta(key, value)
+
+    def get_scheduled(self) -> Dict[str, dict]:
+        return self.timers.get_scheduled()
+
+    def put_scheduled(self, action_id: str, action: dict) -> None:
+        self.timers.put_scheduled(action_id, action)
+
+    def delete_scheduled(self, action_id: str) -> None:
+        self.timers.delete_scheduled(action_id)
+
+def create_store() -> Store:
+    """Create the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStore()
+    if STORAGE_BACKEND == 'json':
+        return JsonStore()
+    return ShardedStore()
+
+store = create_store()
+
+# Writes run on one background thread so they never block the event loop
+# and are still applied in the order they were issued
+_storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+async def run_storage(func, *args):
+    """Run a blocking store call on the storage thread."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_storage_executor, partial(func, *args))
+    finally:
+        timer = _update_timer.get()
+        if timer is not None:
+            timer.storage += time.perf_counter() - started
+
+# FILTER MATCHING
+FILTER_TYPES = ('substring', 'word', 'prefix', 'regex')
+FILTER_REGEX_MAX_LENGTH = 200
+FILTER_REGEX_MAX_OPTIONAL = 2  # Quantifiers like ? that choose between two lengths
+FILTER_REGEX_PER_CHAT = 20
+# Even a safe pattern such as \d*x is retried from every position, so its cost grows with the square of the text
+FILTER_PATTERN_TEXT_LIMIT = 512  # Characters of a message that word, prefix and regex filters look at
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P[=<]')
+# Possessive repeats and atomic groups only exist from Python 3.11
+REPEATS = tuple(getattr(sre_constants, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                if hasattr(sre_constants, name))
+GROUPS = tuple(getattr(sre_constants, name) for name in ('SUBPATTERN', 'ATOMIC_GROUP') if hasattr(sre_constants, name))
+SINGLE_CHARACTERS = (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN)
+
+def check_regex_backtracking(keyword: str) -> None:
+    """Raise ValueError unless a regex is in the subset that can't backtrack badly.
+
+    Python's re backtracks, so (a+)+b, (a|a)*b and even \\d*\\d*x take
+    exponential or high polynomial time on some inputs. Quantifiers may
+    only apply to a single character or class, groups may not contain |
+    or other groups, and only one quantifier may repeat a variable number
+    of times beyond a few optional ones such as u? in colou?r.
+    """
+    try:
+        parsed = sre_parser.parse(keyword)
+    except re.error as e:
+        raise ValueError(str(e)) from e
+    counts = {"wide": 0, "optional": 0}
+
+    def walk(items, in_group: bool) -> None:
+        for op, av in items:
+            if op in REPEATS:
+                low, high, body = av
+                if len(body) != 1 or body[0][0] not in SINGLE_CHARACTERS:
+                    raise ValueError("quantifiers may only follow a single character or character class")
+                if high - low > 1:
+                    counts["wide"] += 1
+                elif high > low:
+                    counts["optional"] += 1
+            elif op in GROUPS:
+                if in_group:
+                    raise ValueError("groups may not contain other groups")
+                walk(av[-1], True)
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                if in_group:
+                    raise ValueError("groups may not contain other groups")
+                walk(av[1], True)
+            elif op is sre_constants.BRANCH:
+                if in_group:
+                    raise ValueError("groups may not contain |")
+                for branch in av[1]:
+                    walk(branch, in_group)
+            elif op not in SINGLE_CHARACTERS and op is not sre_constants.AT:
+                raise ValueError(f"{str(op).lower()} is not supported in filter patterns")
+
+    walk(parsed, False)
+    if counts["wide"] > 1:
+        raise ValueError("only one +, * or {m,n} quantifier is allowed")
+    if counts["optional"] > FILTER_REGEX_MAX_OPTIONAL:
+        raise ValueError(f"at most {FILTER_REGEX_MAX_OPTIONAL} ? quantifiers are allowed")
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over a list of keywords.
+
+    A message is scanned once regardless of the number of keywords.
+    """
+
+    __slots__ = ('keywords', '_goto', '_fail', '_best')
+
+    def __init__(self, keywords: List[str]):
+        self.keywords = keywords
+        goto = [{}]
+        best = [None]  # Lowest keyword index recognised at each node
+        for index, keyword in enumerate(keywords):
+            node = 0
+            for char in keyword:
+                child = goto[node].get(char)
+                if child is None:
+                    child = len(goto)
+                    goto[node][char] = child
+                    goto.append({})
+                    best.append(None)
+                node = child
+            if best[node] is None:
+                best[node] = index
+
+        # Breadth-first pass to link each node to its longest proper suffix
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                suffix = fail[node]
+                while suffix and char not in goto[suffix]:
+                    suffix = fail[suffix]
+                target = goto[suffix].get(char, 0)
+                fail[child] = target if target != child else 0
+                inherited = best[fail[child]]
+                if inherited is not None and (best[child] is None or inherited < best[child]):
+                    best[child] = inherited
+
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+
+    def first_index(self, text: str) -> Optional[int]:
+        """Return the lowest index of a keyword contained in text, if any."""
+        if not self.keywords:
+            return None
+        goto, fail, best = self._goto, self._fail, self._best
+        found = None
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            index = best[node]
+            if index is not None and (found is None or index < found):
+                found = index
+                if found == 0:
+                    break
+        return found
+
+def filter_pattern(filter_type: str, keyword: str) -> str:
+    """Return the regular expression for a word, prefix or regex filter.
+
+    Raises ValueError for a regex that is invalid or could backtrack badly.
+    """
+    if filter_type == 'word':
+        return r'(?<!\w)' + re.escape(keyword) + r'(?!\w)'
+    if filter_type == 'prefix':
+        return r'\A' + re.escape(keyword)
+    if len(keyword) > FILTER_REGEX_MAX_LENGTH:
+        raise ValueError(f"patterns are limited to {FILTER_REGEX_MAX_LENGTH} characters")
+    if BACKREFERENCE.search(keyword):
+        raise ValueError("backreferences and named groups are not allowed")
+    check_regex_backtracking(keyword)
+    try:
+        # Compiled the way FilterMatcher embeds it, so inline global flags are rejected too
+        re.compile(f"(?P<f0>{keyword})")
+    except re.error as e:
+        raise ValueError(str(e)) from e
+    return keyword
+
+class FilterMatcher:
+    """All of a chat's filters, compiled once and rebuilt when they change.
+
+    Substring filters share one Aho-Corasick automaton and the word, prefix
+    and regex filters share one alternation, so a message costs two scans
+    however many filters the chat has. The alternation only scans the first
+    FILTER_PATTERN_TEXT_LIMIT characters, and only the first
+    FILTER_REGEX_PER_CHAT regex filters are compiled. When several filters
+    match, the one added first wins, matching the order in which filters
+    used to be tested one by one.
+    """
+
+    __slots__ = ('filters', 'keywords', '_substrings', '_substring_ids', '_combined', '_pattern_ids', '_patterns')
+
+    def __init__(self, filters: Dict[str, dict]):
+        self.filters = dict(filters)
+        self.keywords = list(filters)
+        self._substring_ids = []
+        self._pattern_ids = []
+        self._patterns = {}
+        alternatives = []
+        regexes = 0
+        for index, keyword in enumerate(self.keywords):
+            filter_type = filters[keyword].get("type", "substring")
+            if filter_type == 'substring':
+                self._substring_ids.append(index)
+                continue
+            if filter_type == 'regex':
+                regexes += 1
+                if regexes > FILTER_REGEX_PER_CHAT:
+                    logger.warning(f"Skipping filter {keyword!r}: over {FILTER_REGEX_PER_CHAT} regex filters")
+                    continue
+            try:
+                pattern = filter_pattern(filter_type, keyword)
+            except ValueError as e:
+                logger.warning(f"Skipping filter {keyword!r}: {e}")
+                continue
+            self._pattern_ids.append(index)
+            self._patterns[index] = pattern
+            alternatives.append(f"(?P<f{index}>{pattern})")
+        self._substrings = KeywordMatcher([self.keywords[index] for index in self._substring_ids])
+        self._combined = re.compile('|'.join(alternatives), re.IGNORECASE) if alternatives else None
+
+    def first_match(self, text: str) -> Optional[str]:
+        """Return the earliest-added filter keyword matching text, if any."""
+        found = self._substrings.first_index(text)
+        if found is not None:
+            found = self._substring_ids[found]
+        if self._combined is not None:
+            text = text[:FILTER_PATTERN_TEXT_LIMIT]
+            match = self._combined.search(text)
+            if match is not None:
+                candidate = int(match.lastgroup[1:])
+                if found is None or candidate < found:
+                    found = candidate
+                # The combined search stops at the leftmost match; an earlier
+                # filter may still match further right
+                for index in self._pattern_ids:
+                    if index >= found:
+                        break
+                    if self._compiled(index).search(text):
+                        found = index
+                        break
+        return None if found is None else self.keywords[found]
+
+    def _compiled(self, index: int) -> re.Pattern:
+        pattern = self._patterns[index]
+        if isinstance(pattern, str):
+            pattern = self._patterns[index] = re.compile(pattern, re.IGNORECASE)
+        return pattern
+
+# Sized like the shard cache, so matchers are only kept for recently active chats
+_filter_matchers: "OrderedDict[int, FilterMatcher]" = OrderedDict()
+
+def get_filter_matcher(chat_id: int) -> FilterMatcher:
+    """Return the compiled filter matcher for a chat, building it on first use."""
+    matcher = _filter_matchers.get(chat_id)
+    if matcher is None:
+        matcher = FilterMatcher(store.get_filters(chat_id))
+        _filter_matchers[chat_id] = matcher
+        if len(_filter_matchers) > SHARD_CACHE_SIZE:
+            _filter_matchers.popitem(last=False)
+    else:
+        _filter_matchers.move_to_end(chat_id)
+    return matcher
+
+def invalidate_filter_matcher(chat_id: int) -> None:
+    """Drop a chat's compiled matcher after its filters change."""
+    _filter_matchers.pop(chat_id, None)
+
+def is_owner(user_id: int) -> bool:
+    """Check if the user is the bot owner."""
+    return user_id == OWNER_ID
+
+def is_sudo(user_id: int) -> bool:
+    """Check if the user is a sudo user."""
+    return user_id == OWNER_ID or user_id in store.get_sudo_users()
+
+# ADMIN CACHE
+ADMIN_CACHE_TTL = 300  # Seconds before a chat's administrator list is fetched again
+ADMIN_STATUSES = ['creator', 'administrator']
+
+_admin_cache: Dict[int, tuple] = {}  # chat_id -> (expires_at, set of admin user IDs)
+
+async def get_chat_admins(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> Optional[set]:
+    """Return the IDs of a chat's administrators, fetched in bulk and cached."""
+    now = time.monotonic()
+    cached = _admin_cache.get(chat_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    try:
+        admins = {member.user.id for member in await context.bot.get_chat_administrators(chat_id)}
+    except telegram.error.BadRequest as e:
+        # Private chats have no administrators; don't ask again until the entry expires
+        logger.info(f"No administrators for chat {chat_id}: {e}")
+        admins = set()
+    except Exception as e:
+        logger.error(f"Error fetching chat administrators: {e}")
+        return None
+    _admin_cache[chat_id] = (now + ADMIN_CACHE_TTL, admins)
+    return admins
+
+def update_admin_cache(chat_id: int, user_id: int, is_chat_admin: bool) -> None:
+    """Record a promotion or demotion in the cached administrator list."""
+    cached = _admin_cache.get(chat_id)
+    if cached is None:
+        return
+    if is_chat_admin:
+        cached[1].add(user_id)
+    else:
+        cached[1].discard(user_id)
+
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Check if the user is an admin, sudo user, or bot owner."""
+    user_id = update.effective_user.id
+    
+    if is_sudo(user_id):
+        return True
+    
+    admins = await get_chat_admins(context, update.effective_chat.id)
+    return admins is not None and user_id in admins
+
+async def bot_has_admin_rights(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    """Check if the bot has admin rights in the chat."""
+    admins = await get_chat_admins(context, chat_id)
+    return admins is not None and context.bot.id in admins
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep the administrator cache in sync with membership changes."""
+    member_update = update.chat_member or update.my_chat_member
+    update_admin_cache(
+        member_update.chat.id,
+        member_update.new_chat_member.user.id,
+        member_update.new_chat_member.status in ADMIN_STATUSES
+    )
+    # Large groups may hide join and leave service messages, so they are handled here too
+    if not update.chat_member:
+        return
+    old_status = member_update.old_chat_member.status
+    new_status = member_update.new_chat_member.status
+    if old_status in JOIN_FROM_STATUSES and new_status in JOIN_TO_STATUSES:
+        await member_joined(context, member_update.chat, member_update.new_chat_member.user)
+    elif old_status in JOIN_TO_STATUSES and new_status == 'left':
+        await member_left(context, member_update.chat, member_update.new_chat_member.user)
+
+# GLOBAL BANS
+GBAN_BLOOM_THRESHOLD = 200000  # Above this many entries only a Bloom filter is kept in memory
+GBAN_BLOOM_ERROR_RATE = 0.001
+JOIN_FROM_STATUSES = ['left', 'kicked']
+JOIN_TO_STATUSES = ['member', 'restricted']
+
+class GbanIndex:
+    """In-memory membership index over the global ban list.
+
+    Small lists are held in a set. Past GBAN_BLOOM_THRESHOLD entries only a
+    Bloom filter is kept and its positives are confirmed against the store,
+    so the per-update check never touches storage for ordinary users.
+    """
+
+    _MASK = (1 << 64) - 1
+
+    def __init__(self):
+        self._ids = set()
+        self._bloom = None
+        self._size = 0
+        self._hashes = 0
+
+    @property
+    def exact(self) -> bool:
+        """Whether a positive answer can be trusted without confirmation."""
+        return self._bloom is None
+
+    def load(self, user_ids: List[int]) -> None:
+        if len(user_ids) <= GBAN_BLOOM_THRESHOLD:
+            self._ids = set(user_ids)
+            self._bloom = None
+            return
+        # Leave room for the list to double before the error rate degrades
+        capacity = 2 * len(user_ids)
+        self._size = int(-capacity * math.log(GBAN_BLOOM_ERROR_RATE) / math.log(2) ** 2)
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bloom = bytearray(self._size // 8 + 1)
+        self._ids = set()
+        for user_id in user_ids:
+            self.add(user_id)
+
+    def _positions(self, user_id: int):
+        # Double hashing: k probes derived from two 64-bit mixes of the ID
+        h1 = (user_id * 0x9E3779B97F4A7C15) & self._MASK
+        h2 = ((user_id ^ (user_id >> 31)) * 0xBF58476D1CE4E5B9) & self._MASK | 1
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._size
+
+    def add(self, user_id: int) -> None:
+        if self._bloom is None:
+            self._ids.add(user_id)
+            return
+        for position in self._positions(user_id):
+            self._bloom[position >> 3] |= 1 << (position & 7)
+
+    def discard(self, user_id: int) -> None:
+        # Bloom bits can't be cleared; the store confirmation covers lifted bans
+        self._ids.discard(user_id)
+
+    def might_contain(self, user_id: int) -> bool:
+        if self._bloom is None:
+            return user_id in self._ids
+        return all(self._bloom[position >> 3] & (1 << (position & 7)) for position in self._positions(user_id))
+
+gban_index = GbanIndex()
+
+async def is_gbanned(user_id: int) -> bool:
+    """Check the global ban list, only consulting storage on Bloom filter hits."""
+    if not gban_index.might_contain(user_id):
+        return False
+    return gban_index.exact or await run_storage(store.is_gbanned, user_id)
+
+async def ban_if_gbanned(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
+    """Ban a globally banned user from the chat, returning whether they are gbanned."""
+    if not await is_gbanned(user_id):
+        return False
+    if await bot_has_admin_rights(context, chat_id):
+        try:
+            await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+            logger.info(f"Banned globally banned user {user_id} from {chat_id}")
+        except telegram.error.TelegramError as e:
+            logger.error(f"Failed to ban globally banned user {user_id} in {chat_id}: {e}")
+    return True
+
+async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Check and welcome users joining a chat."""
+    for member in update.message.new_chat_members:
+        await member_joined(context, update.effective_chat, member)
+
+async def handle_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Say goodbye to a user who left a chat."""
+    member = update.message.left_chat_member
+    # Removed by someone else rather than leaving
+    if update.effective_user and update.effective_user.id != member.id:
+        return
+    await member_left(context, update.effective_chat, member)
+
+async def member_joined(context: ContextTypes.DEFAULT_TYPE, chat: telegram.Chat, user: telegram.User) -> None:
+    """Run the gban and raid checks on a new member, then welcome them."""
+    if await ban_if_gbanned(context, chat.id, user.id) or await check_raid(context, chat.id, user):
+        return
+    if user.id != context.bot.id:
+        await welcomes.add(context.bot, chat, user)
+
+async def member_left(context: ContextTypes.DEFAULT_TYPE, chat: telegram.Chat, user: telegram.User) -> None:
+    if user.id != context.bot.id:
+        await goodbyes.add(context.bot, chat, user)
+
+# RAID PROTECTION
+RAID_JOINS = 15  # Weighted joins within RAID_SECONDS that trigger a lockdown for /set_antiraid on
+RAID_SECONDS = 60
+RAID_NEW_ACCOUNT_ID = 7000000000  # User IDs from here on belong to recently created accounts, which count double
+RAID_LOCKDOWN_MINUTES = 30  # The chat's permissions are restored after this long
+RAID_MUTE_MINUTES = 24 * 60  # How long members of the burst stay muted
+RAID_RESTRICT_WORKERS = 8  # Restrictions issued at the same time
+RAID_TRACKED_CHATS = 10000  # Chats whose recent joins are kept before the least recently joined is evicted
+RAID_TRACKED_JOINS = 500  # Recent joins kept per chat
+
+class JoinTracker:
+    """Sliding window of recent joins per chat with a running weighted count.
+
+    Recording a join is a dict insertion plus trimming the joins that have
+    left the window, so it is amortized O(1) however large the chat is. A
+    user already in the window counts once, since a join is reported both
+    as a service message and as a chat_member update.
+    """
+
+    def __init__(self, max_chats: int = RAID_TRACKED_CHATS):
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> [weight, OrderedDict(user_id -> (joined_at, weight))]
+
+    def add(self, chat_id: int, user_id: int, weight: int, seconds: float) -> int:
+        """Record a join and return the chat's weighted joins within the last `seconds`."""
+        now = time.monotonic()
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [0, OrderedDict()]
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        joins = entry[1]
+        while joins:
+            joined_at, oldest_weight = next(iter(joins.values()))
+            if now - joined_at <= seconds and len(joins) < RAID_TRACKED_JOINS:
+                break
+            joins.popitem(last=False)
+            entry[0] -= oldest_weight
+        if user_id not in joins:
+            joins[user_id] = (now, weight)
+            entry[0] += weight
+        return entry[0]
+
+    def pop(self, chat_id: int) -> List[int]:
+        """Forget a chat's recent joins and return who they were."""
+        entry = self._chats.pop(chat_id, None)
+        return list(entry[1]) if entry else []
+
+join_tracker = JoinTracker()
+_raid_locking = set()  # Chats whose lockdown is being applied
 
-# Configuration
-TOKEN = 'your_bot_token_here'  # Replace with your bot token
-OWNER_ID = 123456789  # Replace with your Telegram user ID
-OWNER_USERNAME = "@yourusername"
+async def restrict_members(bot: telegram.Bot, chat_id: int, user_ids: List[int]) -> int:
+    """Mute users for RAID_MUTE_MINUTES, a few at a time, and return how many were muted."""
+    slots = asyncio.Semaphore(RAID_RESTRICT_WORKERS)
+    until = datetime.now() + timedelta(minutes=RAID_MUTE_MINUTES)
 
-# Data storage
-user_data = {}
-sudo_users = []  # List of sudo user IDs
-DATA_FILE = 'legendbot_data.json'
+    async def restrict(user_id: int) -> bool:
+        async with slots:
+            try:
+                await call_with_retry(bot.restrict_chat_member, chat_id, user_id, MUTED_PERMISSIONS, until_date=until)
+                return True
+            except telegram.error.TelegramError as e:
+                logger.debug(f"Failed to restrict {user_id} in {chat_id}: {e}")
+                return False
 
-def load_data():
-    """Load data from file."""
-    global user_data, sudo_users
+    return sum(await asyncio.gather(*(restrict(user_id) for user_id in user_ids)))
+
+async def check_raid(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user: telegram.User) -> bool:
+    """Count a join towards the chat's raid limit, locking the chat down when it is reached.
+
+    Returns True if the user was muted as part of a raid.
+    """
+    # Off until an admin turns it on with /set_antiraid
+    settings = store.get_chat_value(chat_id, "antiraid")
+    if not settings or user.id == context.bot.id:
+        return False
+    lockdown = store.get_chat_value(chat_id, "raid_lockdown")
+    if lockdown:
+        if lockdown["until"] <= time.time():
+            # Due but not yet fired by the scheduler
+            await end_lockdown(context.bot, chat_id)
+        else:
+            await restrict_members(context.bot, chat_id, [user.id])
+            return True
+    weight = 2 if user.id >= RAID_NEW_ACCOUNT_ID else 1
+    if join_tracker.add(chat_id, user.id, weight, settings["seconds"]) < settings["joins"] or chat_id in _raid_locking:
+        return False
+    _raid_locking.add(chat_id)
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                user_data = data.get('user_data', {})
-                sudo_users = data.get('sudo_users', [])
-                logger.info("Data loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading data: {e}")
+        if not await bot_has_admin_rights(context, chat_id):
+            return False
+        await start_lockdown(context, chat_id, join_tracker.pop(chat_id))
+        return True
+    finally:
+        _raid_locking.discard(chat_id)
 
-def save_data():
-    """Save data to file."""
+async def start_lockdown(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_ids: List[int]) -> None:
+    """Lock the chat and mute the members of the burst."""
     try:
-        data = {
-            'user_data': user_data,
-            'sudo_users': sudo_users
+        chat = await context.bot.get_chat(chat_id)
+        await call_with_retry(context.bot.set_chat_permissions, chat_id, ChatPermissions.no_permissions())
+    except telegram.error.TelegramError as e:
+        logger.error(f"Failed to lock down {chat_id} during a raid: {e}")
+        return
+    # Saved with the previous permissions, which end_lockdown restores
+    until = time.time() + RAID_LOCKDOWN_MINUTES * 60
+    await run_storage(store.set_chat_value, chat_id, "raid_lockdown", {
+        "until": until,
+        "permissions": chat.permissions.to_dict() if chat.permissions else None
+    })
+    await scheduler.schedule(f"raid_unlock:{chat_id}", RAID_LOCKDOWN_MINUTES * 60, "raid_unlock", chat_id)
+    logger.warning(f"Raid detected in {chat_id}: {len(user_ids)} recent joins")
+    muted = await restrict_members(context.bot, chat_id, user_ids)
+    await context.bot.send_message(
+        chat_id,
+        f"🚨 Raid detected! The chat is locked for {RAID_LOCKDOWN_MINUTES} minutes and "
+        f"{muted} new members have been muted."
+    )
+
+async def end_lockdown(bot: telegram.Bot, chat_id: int) -> None:
+    """Restore the permissions the chat had before its raid lockdown."""
+    lockdown = store.get_chat_value(chat_id, "raid_lockdown")
+    if not lockdown:
+        return
+    await run_storage(store.set_chat_value, chat_id, "raid_lockdown", None)
+    await scheduler.cancel(f"raid_unlock:{chat_id}")
+    permissions = ChatPermissions.de_json(lockdown["permissions"], bot) or ChatPermissions.all_permissions()
+    try:
+        await call_with_retry(bot.set_chat_permissions, chat_id, permissions)
+        await bot.send_message(chat_id, "🔓 Raid lockdown lifted.")
+    except telegram.error.TelegramError as e:
+        logger.error(f"Failed to lift raid lockdown in {chat_id}: {e}")
+
+# MEMBER GREETINGS
+GREETING_BATCH_SECONDS = 5  # Members arriving within this long of a greeting share the next one
+GREETING_MAX_NAMES = 5  # Names listed in a shared greeting before "and N others"
+GREETING_DELETE_PREVIOUS = True  # Delete a chat's previous welcome or goodbye when sending a new one
+PLACEHOLDER = re.compile(r'\{(first|last|fullname|username|id|chat|count)\}')
+
+class GreetingTemplate:
+    """A welcome or goodbye text split once into literal text and placeholders."""
+
+    def __init__(self, text: str):
+        self.parts = []  # (literal, placeholder or None) pairs
+        self.fields = set()
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            self.parts.append((text[position:match.start()], match.group(1)))
+            self.fields.add(match.group(1))
+            position = match.end()
+        self.parts.append((text[position:], None))
+
+    def render(self, values: Dict[str, str]) -> str:
+        return ''.join(literal + (values[field] if field else '') for literal, field in self.parts)
+
+@lru_cache(maxsize=4096)
+def compile_greeting(text: str) -> GreetingTemplate:
+    return GreetingTemplate(text)
+
+def join_names(names: List[str]) -> str:
+    """Join names as "A", "A and B" or "A, B and 3 others"."""
+    if len(names) <= 1:
+        return names[0] if names else ''
+    if len(names) <= GREETING_MAX_NAMES:
+        return ', '.join(names[:-1]) + ' and ' + names[-1]
+    return ', '.join(names[:GREETING_MAX_NAMES]) + f' and {len(names) - GREETING_MAX_NAMES} others'
+
+class MemberGreeter:
+    """Sends a chat's welcome or goodbye message, coalescing bursts into one.
+
+    The first member after a quiet period is greeted at once. Members
+    arriving in the following GREETING_BATCH_SECONDS are collected and
+    greeted together when the window closes, and windows keep following
+    each other while members keep arriving, so a join surge costs one
+    message per window instead of one per member.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind  # Chat setting holding the template: 'welcome' or 'goodbye'
+        self._batches: Dict[int, dict] = {}  # chat_id -> {"users", "seen", "task"}
+
+    async def add(self, bot: telegram.Bot, chat: telegram.Chat, user: telegram.User) -> None:
+        if not store.get_chat_value(chat.id, self.kind):
+            return
+        batch = self._batches.get(chat.id)
+        if batch is not None:
+            # A member can be reported by a service message and a chat_member update
+            if user.id not in batch["seen"]:
+                batch["seen"].add(user.id)
+                batch["users"].append(user)
+            return
+        batch = self._batches[chat.id] = {"users": [], "seen": {user.id}}
+        batch["task"] = asyncio.create_task(self._close_windows(bot, chat))
+        await self._send(bot, chat, [user])
+
+    async def _close_windows(self, bot: telegram.Bot, chat: telegram.Chat) -> None:
+        batch = self._batches[chat.id]
+        try:
+            while True:
+                await asyncio.sleep(GREETING_BATCH_SECONDS)
+                if not batch["users"]:
+                    return
+                users = batch["users"]
+                batch["users"] = []
+                batch["seen"] = {user.id for user in users}
+                await self._send(bot, chat, users)
+        finally:
+            del self._batches[chat.id]
+
+    async def _send(self, bot: telegram.Bot, chat: telegram.Chat, users: List[telegram.User]) -> None:
+        text = store.get_chat_value(chat.id, self.kind)
+        if not text:
+            return
+        template = compile_greeting(text)
+        values = {
+            "first": join_names([user.first_name for user in users]),
+            "last": join_names([user.last_name for user in users if user.last_name]),
+            "fullname": join_names([user.full_name for user in users]),
+            "username": join_names([f"@{user.username}" if user.username else user.first_name for user in users]),
+            "id": join_names([str(user.id) for user in users]),
+            "chat": chat.title or '',
+            "count": ''
         }
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-        logger.info("Data saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving data: {e}")
+        try:
+            # Only templates that show the member count pay for fetching it
+            if "count" in template.fields:
+                values["count"] = str(await bot.get_chat_member_count(chat.id))
+            message = await bot.send_message(chat.id, template.render(values))
+        except telegram.error.TelegramError as e:
+            logger.error(f"Failed to send {self.kind} message in {chat.id}: {e}")
+            return
+        if GREETING_DELETE_PREVIOUS:
+            previous = store.get_chat_value(chat.id, f"last_{self.kind}")
+            await run_storage(store.set_chat_value, chat.id, f"last_{self.kind}", message.message_id)
+            if previous:
+                try:
+                    await bot.delete_message(chat.id, previous)
+                except telegram.error.TelegramError:
+                    pass
 
-# Load data on startup
-load_data()
+welcomes = MemberGreeter('welcome')
+goodbyes = MemberGreeter('goodbye')
 
-def is_owner(user_id: int) -> bool:
-    """Check if the user is the bot owner."""
-    return user_id == OWNER_ID
+# RATE LIMITING
+GLOBAL_SEND_RATE = 30  # Messages per second the Bot API accepts across all chats
+GROUP_SEND_RATE = 20 / 60  # Messages per second the Bot API accepts in one group
+PRIVATE_SEND_RATE = 1  # Messages per second the Bot API accepts in one private chat
+RETRY_ATTEMPTS = 3
 
-def is_sudo(user_id: int) -> bool:
-    """Check if the user is a sudo user."""
-    return user_id in sudo_users or user_id == OWNER_ID
+class TokenBucket:
+    """Token bucket that makes callers wait until a token is available."""
 
-def is_admin(update: Update, context: CallbackContext) -> bool:
-    """Check if the user is an admin, sudo user, or bot owner."""
-    user_id = update.effective_user.id
-    
-    if is_sudo(user_id):
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _take(self) -> float:
+        """Take a token if possible, otherwise return the seconds to wait."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        wait = self._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+class ChatRateLimiter:
+    """One token bucket per chat, dropping the least recently used ones."""
+
+    def __init__(self, rate: float, capacity: float, max_chats: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_chats = max_chats
+        self._buckets = OrderedDict()
+
+    async def acquire(self, chat_id: int) -> None:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[chat_id] = bucket
+            if len(self._buckets) > self.max_chats:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        await bucket.acquire()
+
+global_send_limiter = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+group_send_limiter = ChatRateLimiter(GROUP_SEND_RATE, 20)
+private_send_limiter = ChatRateLimiter(PRIVATE_SEND_RATE, 1)
+
+async def call_with_retry(method, *args, **kwargs):
+    """Call a Bot API method, waiting out flood-control errors."""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await method(*args, **kwargs)
+        except telegram.error.RetryAfter as e:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            logger.warning(f"Flood limit hit, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
+# SEND QUEUE
+SEND_ENDPOINTS = frozenset((
+    'sendMessage', 'sendPhoto', 'sendSticker', 'sendAnimation', 'sendDocument', 'sendVideo',
+    'sendAudio', 'sendVoice', 'sendDice', 'forwardMessage', 'copyMessage'
+))
+SEND_COALESCE_SECONDS = 5  # Identical coalescible sends to a chat within this window go out once
+SEND_CHAT_BACKLOG = 30  # Queued sends per chat beyond which coalescible ones are dropped
+REPLY_PARAMETERS = ('reply_to_message_id', 'allow_sending_without_reply')
+
+class SendDropped(telegram.error.TelegramError):
+    """A send that was shed by the send queue instead of delivered."""
+
+class SendQueue(BaseRateLimiter):
+    """Routes every outgoing message through one queue per chat.
+
+    Messages to a chat leave in the order they were sent, each waiting for
+    the chat's and the bot's send rate, and are retried after flood-control
+    errors. Other Bot API requests pass straight through. A send made with
+    rate_limit_args={"coalesce": True} shares the result of an identical
+    send to the same chat from the last SEND_COALESCE_SECONDS, and is
+    dropped rather than queued while the chat's backlog is full.
+    """
+
+    def __init__(self):
+        self._queues: Dict[object, deque] = {}
+        self._recent = OrderedDict()  # coalesce key -> (expiry, future)
+        self._drains = set()
+        self.coalesced = 0
+        self.dropped = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for task in list(self._drains):
+            task.cancel()
+
+    def backlog(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _shared(self, key: tuple) -> Optional[asyncio.Future]:
+        """Return the pending or recent send with this key, if any."""
+        now = time.monotonic()
+        while self._recent:
+            expiry, _ = next(iter(self._recent.values()))
+            if expiry > now:
+                break
+            self._recent.popitem(last=False)
+        entry = self._recent.get(key)
+        return entry[1] if entry else None
+
+    async def _drain(self, chat_id, queue: deque) -> None:
+        limiter = private_send_limiter if isinstance(chat_id, int) and chat_id > 0 else group_send_limiter
+        try:
+            while queue:
+                callback, args, kwargs, future = queue[0]
+                await limiter.acquire(chat_id)
+                await global_send_limiter.acquire()
+                try:
+                    future.set_result(await call_with_retry(callback, *args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+                queue.popleft()
+        finally:
+            del self._queues[chat_id]
+            # Only reached with sends left over when shutting down
+            for *_, future in queue:
+                if not future.done():
+                    future.set_exception(SendDropped("Send queue shut down"))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if endpoint not in SEND_ENDPOINTS or chat_id is None:
+            return await callback(*args, **kwargs)
+        queue = self._queues.get(chat_id)
+        coalesce = bool(rate_limit_args and rate_limit_args.get("coalesce"))
+        if coalesce:
+            # Filter replies quote the triggering message; duplicates differ only in that
+            key = (endpoint,) + tuple(sorted(
+                (name, str(value)) for name, value in data.items() if name not in REPLY_PARAMETERS
+            ))
+            shared = self._shared(key)
+            if shared is not None:
+                self.coalesced += 1
+                return await asyncio.shield(shared)
+            if queue is not None and len(queue) >= SEND_CHAT_BACKLOG:
+                self.dropped += 1
+                raise SendDropped(f"Send queue for {chat_id} is full")
+        future = asyncio.get_running_loop().create_future()
+        if coalesce:
+            self._recent[key] = (time.monotonic() + SEND_COALESCE_SECONDS, future)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            task = asyncio.create_task(self._drain(chat_id, queue))
+            self._drains.add(task)
+            task.add_done_callback(self._drains.discard)
+        queue.append((callback, args, kwargs, future))
+        # A caller that gives up waiting must not cancel a send others may share
+        return await asyncio.shield(future)
+
+send_queue = SendQueue()
+
+# SCHEDULER
+SCHEDULER_TICK_SECONDS = 1  # How often due actions are looked for
+SCHEDULER_BATCH = 30  # Actions fired per tick; a backlog after downtime drains at this rate
+NOTICE_DELETE_SECONDS = 60  # Bot notices such as purge results are deleted after this long
+
+class Scheduler:
+    """Timed actions such as tempbans, unmutes and unlocks that survive restarts.
+
+    Pending actions are kept in a min-heap of (due, action_id), so adding
+    one is O(log n), and every action is also persisted through the store
+    and reloaded on start. A single repeating JobQueue job pops the due
+    actions and fires at most SCHEDULER_BATCH of them per tick.
+
+    Actions have stable IDs such as "unban:<chat>:<user>", so scheduling
+    the same ID again replaces the pending action. Cancelled and replaced
+    actions leave stale heap entries behind, which are skipped when popped.
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._actions: Dict[str, dict] = {}
+
+    def load(self, actions: Dict[str, dict]) -> None:
+        """Take over the actions persisted by the previous run."""
+        self._actions = dict(actions)
+        self._heap = [(action["due"], action_id) for action_id, action in self._actions.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._actions)
+
+    async def schedule(self, action_id: str, delay: float, kind: str, chat_id: int, **params) -> None:
+        """Run the `kind` action for a chat after `delay` seconds."""
+        action = dict(params, kind=kind, chat=chat_id, due=time.time() + max(0, delay))
+        self._actions[action_id] = action
+        heapq.heappush(self._heap, (action["due"], action_id))
+        # Drop stale entries once they make up most of the heap
+        if len(self._heap) > 2 * len(self._actions) + 1024:
+            self._heap = [(action["due"], action_id) for action_id, action in self._actions.items()]
+            heapq.heapify(self._heap)
+        await run_storage(store.put_scheduled, action_id, action)
+
+    async def cancel(self, action_id: str) -> bool:
+        """Drop a pending action, returning whether there was one."""
+        if self._actions.pop(action_id, None) is None:
+            return False
+        await run_storage(store.delete_scheduled, action_id)
         return True
-    
-    chat_id = update.effective_chat.id
-    try:
-        chat_member = context.bot.get_chat_member(chat_id, user_id)
-        return chat_member.status in ['creator', 'administrator']
-    except Exception as e:
-        logger.error(f"Error checking admin status: {e}")
-        return False
 
-def bot_has_admin_rights(context: CallbackContext, chat_id: int) -> bool:
-    """Check if the bot has admin rights in the chat."""
-    try:
-        bot_member = context.bot.get_chat_member(chat_id, context.bot.id)
-        return bot_member.status in ['creator', 'administrator']
-    except Exception as e:
-        logger.error(f"Error checking bot admin status: {e}")
-        return False
+    def _pop_due(self) -> List[tuple]:
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < SCHEDULER_BATCH:
+            when, action_id = heapq.heappop(self._heap)
+            action = self._actions.get(action_id)
+            if action is None or action["due"] != when:
+                continue
+            del self._actions[action_id]
+            due.append((action_id, action))
+        return due
+
+    async def _fire(self, bot: telegram.Bot, action_id: str, action: dict) -> None:
+        try:
+            await SCHEDULED_ACTIONS[action["kind"]](bot, action)
+        except telegram.error.TelegramError as e:
+            logger.error(f"Scheduled action {action_id} failed: {e}")
+        except Exception as e:
+            logger.error(f"Error running scheduled action {action_id}: {e}")
+        # Removed once it has run, so an action interrupted by a crash runs again on restart;
+        # kept if the same ID was scheduled again while this one ran
+        if action_id not in self._actions:
+            await run_storage(store.delete_scheduled, action_id)
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """JobQueue callback firing the next batch of due actions."""
+        due = self._pop_due()
+        if due:
+            await asyncio.gather(*(self._fire(context.bot, action_id, action) for action_id, action in due))
+
+scheduler = Scheduler()
+
+async def delete_later(message: Optional[telegram.Message], delay: float = NOTICE_DELETE_SECONDS) -> None:
+    """Schedule a bot notice for deletion."""
+    if message is not None:
+        await scheduler.schedule(f"delete:{message.chat_id}:{message.message_id}", delay, "delete",
+                                 message.chat_id, message=message.message_id)
+
+async def _run_unban(bot: telegram.Bot, action: dict) -> None:
+    await call_with_retry(bot.unban_chat_member, action["chat"], action["user"], only_if_banned=True)
+
+async def _run_unmute(bot: telegram.Bot, action: dict) -> None:
+    await call_with_retry(bot.restrict_chat_member, action["chat"], action["user"], UNMUTED_PERMISSIONS)
+
+async def _run_unlock(bot: telegram.Bot, action: dict) -> None:
+    await call_with_retry(bot.set_chat_permissions, action["chat"], ChatPermissions.all_permissions())
+    await bot.send_message(action["chat"], "🔓 The chat has been unlocked.")
+
+async def _run_raid_unlock(bot: telegram.Bot, action: dict) -> None:
+    await end_lockdown(bot, action["chat"])
 
-def start(update: Update, context: CallbackContext) -> None:
+async def _run_delete(bot: telegram.Bot, action: dict) -> None:
+    await call_with_retry(bot.delete_message, action["chat"], action["message"])
+
+SCHEDULED_ACTIONS = {
+    "unban": _run_unban,
+    "unmute": _run_unmute,
+    "unlock": _run_unlock,
+    "raid_unlock": _run_raid_unlock,
+    "delete": _run_delete,
+}
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
     welcome_message = (
@@ -99,10 +2510,10 @@ def start(update: Update, context: CallbackContext) -> None:
         f"🔐 Use /sudohelp for sudo commands\n\n"
         f"Let's build a legendary community together\! 🏆"
     )
-    update.message.reply_markdown_v2(welcome_message)
-    main_menu(update, context)
+    await update.message.reply_markdown_v2(welcome_message)
+    await main_menu(update, context)
 
-def main_menu(update: Update, context: CallbackContext) -> None:
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show the main menu."""
     keyboard = [
         [InlineKeyboardButton("⚔️ Admin Commands", callback_data='admin_commands')],
@@ -113,16 +2524,16 @@ def main_menu(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.message:
-        update.message.reply_text('Please choose a category:', reply_markup=reply_markup)
+        await update.message.reply_text('Please choose a category:', reply_markup=reply_markup)
     else:
         query = update.callback_query
-        query.answer()
-        query.edit_message_text('Please choose a category:', reply_markup=reply_markup)
+        await query.answer()
+        await query.edit_message_text('Please choose a category:', reply_markup=reply_markup)
 
-def sudo_menu(update: Update, context: CallbackContext) -> None:
+async def sudo_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show sudo commands menu."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to access sudo commands.")
+        await update.message.reply_text("🚫 You don't have permission to access sudo commands.")
         return
     
     keyboard = [
@@ -138,63 +2549,60 @@ def sudo_menu(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
-    query.answer()
-    query.edit_message_text('Sudo Commands Menu:', reply_markup=reply_markup)
+    await query.answer()
+    await query.edit_message_text('Sudo Commands Menu:', reply_markup=reply_markup)
 
 # SUDO COMMANDS
 
-def addsudo(update: Update, context: CallbackContext) -> None:
+async def addsudo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Add a user to sudo."""
     if not is_owner(update.effective_user.id):
-        update.message.reply_text("🚫 Only the bot owner can add sudo users.")
+        await update.message.reply_text("🚫 Only the bot owner can add sudo users.")
         return
     
     if not context.args:
-        update.message.reply_text("Please provide a user ID. Usage: /addsudo <user_id>")
+        await update.message.reply_text("Please provide a user ID. Usage: /addsudo <user_id>")
         return
     
     try:
         user_id = int(context.args[0])
-        if user_id in sudo_users:
-            update.message.reply_text(f"User {user_id} is already a sudo user.")
+        if not await run_storage(store.add_sudo, user_id):
+            await update.message.reply_text(f"User {user_id} is already a sudo user.")
         else:
-            sudo_users.append(user_id)
-            save_data()
-            update.message.reply_text(f"✅ User {user_id} has been added to sudo users.")
+            await update.message.reply_text(f"✅ User {user_id} has been added to sudo users.")
     except ValueError:
-        update.message.reply_text("Please provide a valid user ID.")
+        await update.message.reply_text("Please provide a valid user ID.")
 
-def removesudo(update: Update, context: CallbackContext) -> None:
+async def removesudo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Remove a user from sudo."""
     if not is_owner(update.effective_user.id):
-        update.message.reply_text("🚫 Only the bot owner can remove sudo users.")
+        await update.message.reply_text("🚫 Only the bot owner can remove sudo users.")
         return
     
     if not context.args:
-        update.message.reply_text("Please provide a user ID. Usage: /removesudo <user_id>")
+        await update.message.reply_text("Please provide a user ID. Usage: /removesudo <user_id>")
         return
     
     try:
         user_id = int(context.args[0])
         if user_id == OWNER_ID:
-            update.message.reply_text("Cannot remove the bot owner from sudo.")
-        elif user_id in sudo_users:
-            sudo_users.remove(user_id)
-            save_data()
-            update.message.reply_text(f"✅ User {user_id} has been removed from sudo users.")
+            await update.message.reply_text("Cannot remove the bot owner from sudo.")
+        elif await run_storage(store.remove_sudo, user_id):
+            await update.message.reply_text(f"✅ User {user_id} has been removed from sudo users.")
         else:
-            update.message.reply_text(f"User {user_id} is not a sudo user.")
+            await update.message.reply_text(f"User {user_id} is not a sudo user.")
     except ValueError:
-        update.message.reply_text("Please provide a valid user ID.")
+        await update.message.reply_text("Please provide a valid user ID.")
 
-def listsudo(update: Update, context: CallbackContext) -> None:
+async def listsudo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all sudo users."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
+    sudo_users = store.get_sudo_users()
     if not sudo_users:
-        update.message.reply_text("No sudo users configured.")
+        await update.message.reply_text("No sudo users configured.")
         return
     
     sudo_list = "👑 Sudo Users:\n\n"
@@ -202,108 +2610,286 @@ def listsudo(update: Update, context: CallbackContext) -> None:
     for user_id in sudo_users:
         sudo_list += f"• {user_id}\n"
     
-    update.message.reply_text(sudo_list)
+    await update.message.reply_text(sudo_list)
 
-def backup(update: Update, context: CallbackContext) -> None:
+async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Backup bot data."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     try:
-        save_data()
-        update.message.reply_text("✅ Bot data has been backed up successfully.")
+        await run_storage(store.flush)
+        await update.message.reply_text("✅ Bot data has been backed up successfully.")
     except Exception as e:
-        update.message.reply_text(f"❌ Failed to backup data: {str(e)}")
+        await update.message.reply_text(f"❌ Failed to backup data: {str(e)}")
 
-def stats(update: Update, context: CallbackContext) -> None:
+STATS_TOP_CHATS = 5  # Chats listed in each ranking shown by /stats
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show bot statistics."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
-    total_chats = len(user_data)
-    total_filters = 0
-    total_warnings = 0
-    
-    for chat_id in user_data:
-        if "filters" in user_data[chat_id]:
-            total_filters += len(user_data[chat_id]["filters"])
-        
-        for user_id in user_data[chat_id]:
-            if isinstance(user_data[chat_id][user_id], dict):
-                if "warnings" in user_data[chat_id][user_id]:
-                    total_warnings += user_data[chat_id][user_id]["warnings"]
+    totals = cluster_totals()
+    flushes = store.flush_stats.snapshot()
     
     stats_text = (
         f"📊 LegendBot Statistics:\n\n"
-        f"• Total Groups: {total_chats}\n"
-        f"• Total Filters: {total_filters}\n"
-        f"• Total Warnings: {total_warnings}\n"
-        f"• Sudo Users: {len(sudo_users)}\n"
+        f"• Total Groups: {totals['chats']}\n"
+        f"• Total Filters: {totals['filters']}\n"
+        f"• Total Warnings: {totals['warnings']}\n"
+        f"• Messages Seen: {totals['messages']}\n"
+        f"• Global Bans: {totals['gbans']}\n"
+        f"• Sudo Users: {len(store.get_sudo_users())}\n"
+        f"• Storage Flushes: {flushes['flushes']} ({flushes['records']} writes, "
+        f"avg {flushes['avg_ms']:.1f}ms, max {flushes['max_ms']:.1f}ms)\n"
         f"• Bot Owner: {OWNER_ID}\n"
         f"• Version: 2.0"
     )
     
-    update.message.reply_text(stats_text)
+    chat_id = update.effective_chat.id
+    if chat_id < 0:
+        chat_totals = store.chat_stats(chat_id)
+        stats_text += (
+            f"\n\n💬 This Chat:\n"
+            f"• Filters: {chat_totals['filters']}\n"
+            f"• Warnings: {chat_totals['warnings']}\n"
+            f"• Messages: {chat_totals['messages']}"
+        )
+    for kind, title in (('messages', "Most Active Chats"), ('warnings', "Most Warned Chats")):
+        top = cluster_top_chats(kind, STATS_TOP_CHATS)
+        if top:
+            stats_text += f"\n\n🏆 {title}:\n" + "\n".join(f"• {top_chat}: {count}" for top_chat, count in top)
+    
+    await update.message.reply_text(stats_text)
+
+# BROADCAST ENGINE
+BROADCAST_WORKERS = 8
+BROADCAST_PROGRESS_INTERVAL = 5  # Seconds between progress edits and cursor saves
+
+_broadcast_job = None
+
+class BroadcastJob:
+    """Delivers one broadcast to every chat from a background task.
+
+    The target list is saved when the job starts and the cursor (every
+    target before it has been handled) is saved as it advances, so a
+    broadcast interrupted by a restart resumes where it stopped. Chats in
+    flight at the time of the interruption may receive the message twice.
+    """
+
+    def __init__(self, bot: telegram.Bot, state: dict, progress: dict):
+        self.bot = bot
+        self.state = state
+        self.cursor = progress.get("cursor", 0)
+        self.successful = progress.get("successful", 0)
+        self.failed = progress.get("failed", 0)
+        self._done = set()
+        self._last_report = 0.0
+        self._task = None
+
+    @classmethod
+    async def start(cls, bot: telegram.Bot, state: dict) -> bool:
+        """Start a broadcast unless one is already running."""
+        global _broadcast_job
+        if _broadcast_job is not None:
+            return False
+        resuming = store.get_meta("broadcast") == state
+        job = _broadcast_job = cls(bot, state, store.get_meta("broadcast_cursor", {}) if resuming else {})
+        if not resuming:
+            await run_storage(store.set_meta, "broadcast", state)
+            await run_storage(store.set_meta, "broadcast_cursor", None)
+        job._task = asyncio.create_task(job.run())
+        return True
+
+    async def _deliver(self, chat_id: int) -> bool:
+        # The send queue paces and retries the messages
+        try:
+            if self.state.get("message_id"):
+                await self.bot.forward_message(
+                    chat_id=chat_id,
+                    from_chat_id=self.state["from_chat_id"],
+                    message_id=self.state["message_id"]
+                )
+            else:
+                await self.bot.send_message(chat_id=chat_id, text=self.state["text"])
+            return True
+        except telegram.error.TelegramError as e:
+            logger.error(f"Failed to send broadcast to {chat_id}: {e}")
+            return False
+
+    async def _save_progress(self) -> None:
+        await run_storage(store.set_meta, "broadcast_cursor", {
+            "cursor": self.cursor,
+            "successful": self.successful,
+            "failed": self.failed
+        })
+
+    async def _report(self, text: str) -> None:
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=self.state["status_chat_id"],
+                message_id=self.state["status_message_id"]
+            )
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Failed to update broadcast progress: {e}")
+
+    async def _worker(self, indices) -> None:
+        targets = self.state["targets"]
+        # Workers share one iterator, so each target is handed out exactly once
+        for index in indices:
+            if await self._deliver(targets[index]):
+                self.successful += 1
+            else:
+                self.failed += 1
+            self._done.add(index)
+            while self.cursor in self._done:
+                self._done.remove(self.cursor)
+                self.cursor += 1
+            if time.monotonic() - self._last_report >= BROADCAST_PROGRESS_INTERVAL:
+                self._last_report = time.monotonic()
+                await self._save_progress()
+                await self._report(
+                    f"📢 Broadcasting... {self.successful + self.failed}/{len(targets)}\n"
+                    f"✅ Successful: {self.successful}\n"
+                    f"❌ Failed: {self.failed}"
+                )
+
+    async def run(self) -> None:
+        global _broadcast_job
+        try:
+            indices = iter(range(self.cursor, len(self.state["targets"])))
+            await asyncio.gather(*(self._worker(indices) for _ in range(BROADCAST_WORKERS)))
+            await run_storage(store.set_meta, "broadcast", None)
+            await run_storage(store.set_meta, "broadcast_cursor", None)
+            await self._report(
+                f"📢 Broadcast completed!\n"
+                f"✅ Successful: {self.successful}\n"
+                f"❌ Failed: {self.failed}"
+            )
+        except Exception as e:
+            logger.error(f"Broadcast stopped: {e}")
+            await self._save_progress()
+        finally:
+            _broadcast_job = None
 
-def broadcast(update: Update, context: CallbackContext) -> None:
+async def resume_broadcast(bot: telegram.Bot) -> None:
+    """Continue a broadcast that was interrupted by a restart."""
+    state = store.get_meta("broadcast")
+    if state:
+        logger.info("Resuming interrupted broadcast")
+        await BroadcastJob.start(bot, state)
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Broadcast message to all groups."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args and not update.message.reply_to_message:
-        update.message.reply_text("Please provide a message to broadcast or reply to a message.")
+        await update.message.reply_text("Please provide a message to broadcast or reply to a message.")
         return
     
     message_text = ' '.join(context.args) if context.args else None
     reply_message = update.message.reply_to_message
     
     if not message_text and not reply_message:
-        update.message.reply_text("Please provide a message to broadcast.")
+        await update.message.reply_text("Please provide a message to broadcast.")
         return
     
-    update.message.reply_text("Starting broadcast... This may take a while.")
-    
-    successful = 0
-    failed = 0
-    
-    for chat_id in user_data:
+    targets = await run_storage(store.chat_ids)
+    status = await update.message.reply_text(f"📢 Starting broadcast to {len(targets)} chats...")
+    state = {
+        "targets": targets,
+        "text": message_text,
+        "from_chat_id": update.effective_chat.id,
+        "message_id": reply_message.message_id if reply_message else None,
+        "status_chat_id": status.chat_id,
+        "status_message_id": status.message_id
+    }
+    if not await BroadcastJob.start(context.bot, state):
+        await status.edit_text("⚠️ Another broadcast is still running.")
+
+# GBAN SWEEP
+GBAN_SWEEP_WORKERS = 8
+
+_gban_sweeps: Dict[int, "GbanSweep"] = {}  # user_id -> running sweep
+
+class GbanSweep:
+    """Bans one globally banned user in every managed group from a background task.
+
+    The outcome for each chat is saved under the meta key gban_sweep:<user_id>.
+    """
+
+    def __init__(self, bot: telegram.Bot, user_id: int, chat_ids: List[int], status_chat_id: int, status_message_id: int):
+        self.bot = bot
+        self.user_id = user_id
+        self.chat_ids = chat_ids
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        self.results: Dict[str, str] = {}
+        self._task = None
+
+    @classmethod
+    def start(cls, bot: telegram.Bot, user_id: int, chat_ids: List[int], status_chat_id: int, status_message_id: int) -> bool:
+        """Start a sweep unless one is already running for the user."""
+        if user_id in _gban_sweeps:
+            return False
+        sweep = _gban_sweeps[user_id] = cls(bot, user_id, chat_ids, status_chat_id, status_message_id)
+        sweep._task = asyncio.create_task(sweep.run())
+        return True
+
+    async def _ban(self, chat_id: int) -> str:
+        await global_send_limiter.acquire()
         try:
-            if reply_message:
-                context.bot.forward_message(
-                    chat_id=chat_id,
-                    from_chat_id=update.effective_chat.id,
-                    message_id=reply_message.message_id
-                )
-            else:
-                context.bot.send_message(chat_id=chat_id, text=message_text)
-            successful += 1
+            await call_with_retry(self.bot.ban_chat_member, chat_id=chat_id, user_id=self.user_id)
+            return "banned"
+        except telegram.error.TelegramError as e:
+            # Usually missing rights or a chat the bot has left
+            return f"failed: {e}"
+
+    async def _worker(self, chat_ids) -> None:
+        # Workers share one iterator, so each chat is handled exactly once
+        for chat_id in chat_ids:
+            self.results[str(chat_id)] = await self._ban(chat_id)
+
+    async def run(self) -> None:
+        started = time.monotonic()
+        try:
+            chat_ids = iter(self.chat_ids)
+            await asyncio.gather(*(self._worker(chat_ids) for _ in range(GBAN_SWEEP_WORKERS)))
+            await run_storage(store.set_meta, f"gban_sweep:{self.user_id}", self.results)
+            banned = sum(1 for result in self.results.values() if result == "banned")
+            await self.bot.edit_message_text(
+                f"🌐 User {self.user_id} has been globally banned.\n"
+                f"✅ Banned in {banned} chats\n"
+                f"❌ Failed in {len(self.results) - banned} chats\n"
+                f"⏱️ Took {time.monotonic() - started:.1f}s",
+                chat_id=self.status_chat_id,
+                message_id=self.status_message_id
+            )
         except Exception as e:
-            logger.error(f"Failed to send broadcast to {chat_id}: {e}")
-            failed += 1
-    
-    update.message.reply_text(
-        f"📢 Broadcast completed!\n"
-        f"✅ Successful: {successful}\n"
-        f"❌ Failed: {failed}"
-    )
+            logger.error(f"Gban sweep for {self.user_id} stopped: {e}")
+        finally:
+            _gban_sweeps.pop(self.user_id, None)
 
-def maintenance(update: Update, context: CallbackContext) -> None:
+async def maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Toggle maintenance mode."""
     if not is_owner(update.effective_user.id):
-        update.message.reply_text("🚫 Only the bot owner can toggle maintenance mode.")
+        await update.message.reply_text("🚫 Only the bot owner can toggle maintenance mode.")
         return
     
     # This would require persistent storage for maintenance state
     # For now, just show a message
-    update.message.reply_text("⚠️ Maintenance mode is a placeholder feature.")
+    await update.message.reply_text("⚠️ Maintenance mode is a placeholder feature.")
 
-def sudohelp(update: Update, context: CallbackContext) -> None:
+async def sudohelp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show sudo help."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to view sudo commands.")
+        await update.message.reply_text("🚫 You don't have permission to view sudo commands.")
         return
     
     help_text = (
@@ -314,15 +2900,18 @@ def sudohelp(update: Update, context: CallbackContext) -> None:
         "/backup - Backup bot data\n"
         "/stats - Show bot statistics\n"
         "/broadcast <message> - Broadcast to all groups\n"
+        "/gban <user_id> - Globally ban a user (or reply to them)\n"
+        "/ungban <user_id> - Lift a global ban\n"
+        "/gbanimport - Import user IDs from the arguments or a replied file\n"
         "/maintenance - Toggle maintenance mode\n"
         "/sudohelp - Show this help message\n\n"
         f"Bot Owner: {OWNER_USERNAME}"
     )
     
-    update.message.reply_text(help_text)
+    await update.message.reply_text(help_text)
 
 # ADMIN COMMANDS MENU
-def admin_commands(update: Update, context: CallbackContext) -> None:
+async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show admin commands."""
     keyboard = [
         [InlineKeyboardButton("🚫 Ban", callback_data='ban'),
@@ -347,11 +2936,11 @@ def admin_commands(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
-    query.answer()
-    query.edit_message_text('Admin Commands:', reply_markup=reply_markup)
+    await query.answer()
+    await query.edit_message_text('Admin Commands:', reply_markup=reply_markup)
 
 # USER COMMANDS MENU
-def user_commands(update: Update, context: CallbackContext) -> None:
+async def user_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show user commands."""
     keyboard = [
         [InlineKeyboardButton("ℹ️ Info", callback_data='info'),
@@ -362,11 +2951,11 @@ def user_commands(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
-    query.answer()
-    query.edit_message_text('User Commands:', reply_markup=reply_markup)
+    await query.answer()
+    await query.edit_message_text('User Commands:', reply_markup=reply_markup)
 
 # FUN COMMANDS MENU
-def fun_commands(update: Update, context: CallbackContext) -> None:
+async def fun_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show fun commands."""
     keyboard = [
         [InlineKeyboardButton("🎲 Roll Dice", callback_data='roll_dice'),
@@ -379,11 +2968,11 @@ def fun_commands(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
-    query.answer()
-    query.edit_message_text('Fun Commands:', reply_markup=reply_markup)
+    await query.answer()
+    await query.edit_message_text('Fun Commands:', reply_markup=reply_markup)
 
 # SETTINGS MENU
-def settings(update: Update, context: CallbackContext) -> None:
+async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show settings."""
     keyboard = [
         [InlineKeyboardButton("👋 Welcome Message", callback_data='set_welcome'),
@@ -396,94 +2985,156 @@ def settings(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     query = update.callback_query
-    query.answer()
-    query.edit_message_text('Settings:', reply_markup=reply_markup)
+    await query.answer()
+    await query.edit_message_text('Settings:', reply_markup=reply_markup)
+
+# WARN POLICIES
+WARN_TIERS = [(3, 'ban')]  # (warnings, action) pairs, lowest first, unless the chat sets its own
+WARN_DECAY_HOURS = 0  # Warnings older than this stop counting; 0 keeps them forever
+WARN_ACTIONS = ['mute', 'kick', 'ban']
+WARN_MUTE_MINUTES = 24 * 60
+WARN_ACTION_TEXT = {'mute': f"muted for {WARN_MUTE_MINUTES} minutes", 'kick': "kicked", 'ban': "banned"}
+
+def warn_policy(chat_id: int) -> dict:
+    """Return the chat's warn tiers and warning decay in seconds."""
+    return store.get_chat_value(chat_id, "warn_policy") or {"tiers": WARN_TIERS, "decay": WARN_DECAY_HOURS * 3600}
+
+def active_warnings(times: List[int], policy: dict) -> List[int]:
+    """Drop the warnings that have decayed.
+
+    Decay is worked out whenever warnings are read instead of by sweeping
+    every chat, so users who are never warned again cost nothing.
+    """
+    if not policy["decay"]:
+        return times
+    cutoff = time.time() - policy["decay"]
+    return [warned_at for warned_at in times if warned_at > cutoff]
+
+def warn_action(policy: dict, count: int) -> Optional[str]:
+    """Return the action for a user who has just reached `count` warnings."""
+    tiers = policy["tiers"]
+    if count >= tiers[-1][0]:
+        return tiers[-1][1]
+    return next((action for limit, action in tiers if limit == count), None)
+
+async def apply_warn_action(bot: telegram.Bot, chat_id: int, user_id: int, action: str) -> None:
+    if action == 'mute':
+        await bot.restrict_chat_member(
+            chat_id, user_id, MUTED_PERMISSIONS,
+            until_date=datetime.now() + timedelta(minutes=WARN_MUTE_MINUTES)
+        )
+        await scheduler.schedule(f"unmute:{chat_id}:{user_id}", WARN_MUTE_MINUTES * 60, "unmute", chat_id, user=user_id)
+    elif action == 'kick':
+        await bot.ban_chat_member(chat_id, user_id)
+        await bot.unban_chat_member(chat_id, user_id)
+    else:
+        await bot.ban_chat_member(chat_id, user_id)
 
 # ADMIN COMMAND IMPLEMENTATIONS
-def ban(update: Update, context: CallbackContext) -> None:
-    """Ban a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ban a user, for a number of minutes if the first argument is one."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't ban users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't ban users.")
         return
     
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
-        reason = ' '.join(context.args) if context.args else "No reason provided"
+        args = list(context.args or [])
+        duration = int(args.pop(0)) if args and args[0].isdigit() else None
+        reason = ' '.join(args) if args else "No reason provided"
+        if duration == 0:
+            await update.message.reply_text("Please provide the ban duration as a positive number of minutes.")
+            return
+        
+        # Telegram lifts the ban itself too, in case the scheduled unban never runs
+        until_date = None
+        if duration:
+            until_date = datetime.now() + timedelta(minutes=duration)
         
         try:
-            context.bot.ban_chat_member(chat_id, user_id)
-            update.message.reply_text(
-                f"🚫 User {user_id} has been banned.\n"
-                f"Reason: {reason}"
-            )
+            await context.bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+            if duration:
+                await scheduler.schedule(f"unban:{chat_id}:{user_id}", duration * 60, "unban", chat_id, user=user_id)
+                await update.message.reply_text(
+                    f"🚫 User {user_id} has been banned for {duration} minutes.\n"
+                    f"Reason: {reason}"
+                )
+            else:
+                # A permanent ban replaces an earlier temporary one
+                await scheduler.cancel(f"unban:{chat_id}:{user_id}")
+                await update.message.reply_text(
+                    f"🚫 User {user_id} has been banned.\n"
+                    f"Reason: {reason}"
+                )
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to ban user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to ban user: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message to ban the user.")
+        await update.message.reply_text("Please reply to a message to ban the user.")
 
-def unban(update: Update, context: CallbackContext) -> None:
+async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Unban a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't unban users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't unban users.")
         return
     
     if context.args:
         try:
             user_id = int(context.args[0])
-            context.bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
-            update.message.reply_text(f"✅ User {user_id} has been unbanned.")
+            await context.bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+            await scheduler.cancel(f"unban:{chat_id}:{user_id}")
+            await update.message.reply_text(f"✅ User {user_id} has been unbanned.")
         except ValueError:
-            update.message.reply_text("Please provide a valid user ID.")
+            await update.message.reply_text("Please provide a valid user ID.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to unban user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to unban user: {str(e)}")
     else:
-        update.message.reply_text("Please provide a user ID to unban.")
+        await update.message.reply_text("Please provide a user ID to unban.")
 
-def kick(update: Update, context: CallbackContext) -> None:
+async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Kick a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't kick users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't kick users.")
         return
     
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         try:
-            context.bot.kick_chat_member(chat_id, user_id)
-            context.bot.unban_chat_member(chat_id, user_id)
-            update.message.reply_text(f"👢 User {user_id} has been kicked.")
+            await context.bot.ban_chat_member(chat_id, user_id)
+            await context.bot.unban_chat_member(chat_id, user_id)
+            await update.message.reply_text(f"👢 User {user_id} has been kicked.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to kick user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to kick user: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message to kick the user.")
+        await update.message.reply_text("Please reply to a message to kick the user.")
 
-def mute(update: Update, context: CallbackContext) -> None:
+async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Mute a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't mute users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't mute users.")
         return
     
     if update.message.reply_to_message:
@@ -496,107 +3147,113 @@ def mute(update: Update, context: CallbackContext) -> None:
                 duration = int(context.args[0])
             except ValueError:
                 pass
+        if duration is not None and duration <= 0:
+            # Telegram treats an until_date in the past as a permanent mute
+            await update.message.reply_text("Please provide the mute duration as a positive number of minutes.")
+            return
         
         until_date = None
         if duration:
             until_date = datetime.now() + timedelta(minutes=duration)
         
         try:
-            context.bot.restrict_chat_member(
+            await context.bot.restrict_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
-                permissions=ChatPermissions(
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False
-                ),
+                permissions=MUTED_PERMISSIONS,
                 until_date=until_date
             )
             
             if duration:
-                update.message.reply_text(f"🔇 User {user_id} has been muted for {duration} minutes.")
+                # Telegram lifts short mutes itself but treats ones over a year as permanent
+                await scheduler.schedule(f"unmute:{chat_id}:{user_id}", duration * 60, "unmute", chat_id, user=user_id)
+                await update.message.reply_text(f"🔇 User {user_id} has been muted for {duration} minutes.")
             else:
-                update.message.reply_text(f"🔇 User {user_id} has been muted.")
+                await scheduler.cancel(f"unmute:{chat_id}:{user_id}")
+                await update.message.reply_text(f"🔇 User {user_id} has been muted.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to mute user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to mute user: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message to mute the user.")
+        await update.message.reply_text("Please reply to a message to mute the user.")
 
-def unmute(update: Update, context: CallbackContext) -> None:
+async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Unmute a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't unmute users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't unmute users.")
         return
     
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         try:
-            context.bot.restrict_chat_member(
+            await context.bot.restrict_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
-                permissions=ChatPermissions(
-                    can_send_messages=True,
-                    can_send_media_messages=True,
-                    can_send_other_messages=True,
-                    can_add_web_page_previews=True
-                )
+                permissions=UNMUTED_PERMISSIONS
             )
-            update.message.reply_text(f"🔊 User {user_id} has been unmuted.")
+            await scheduler.cancel(f"unmute:{chat_id}:{user_id}")
+            await update.message.reply_text(f"🔊 User {user_id} has been unmuted.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to unmute user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to unmute user: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message to unmute the user.")
+        await update.message.reply_text("Please reply to a message to unmute the user.")
+
+async def issue_warning(context: ContextTypes.DEFAULT_TYPE, chat_id: int, warned_user,
+                        reply_to: Optional[telegram.Message] = None) -> None:
+    """Record a warning and apply the chat's warn policy to the new count.
+
+    Notices reply to `reply_to` when given and still present, or are sent
+    to the chat on their own, since the warned message may be deleted.
+    """
+    user_id = warned_user.id
+    policy = warn_policy(chat_id)
+    limit = policy["tiers"][-1][0]
+    
+    async def notify(text: str, parse_mode: Optional[str] = 'MarkdownV2') -> None:
+        await context.bot.send_message(
+            chat_id, text, parse_mode=parse_mode,
+            reply_to_message_id=reply_to.message_id if reply_to else None,
+            allow_sending_without_reply=True
+        )
+    
+    warn_count = await run_storage(store.add_warning, chat_id, user_id, int(time.time()), policy)
+    
+    await notify(
+        f"⚠️ User {warned_user.mention_markdown_v2()} has been warned\\.\n"
+        f"Warning count: {warn_count}/{limit}"
+    )
+    
+    action = warn_action(policy, warn_count)
+    if action:
+        try:
+            if await bot_has_admin_rights(context, chat_id):
+                await apply_warn_action(context.bot, chat_id, user_id, action)
+                await notify(
+                    f"🚫 User {warned_user.mention_markdown_v2()} has been {WARN_ACTION_TEXT[action]} due to excessive warnings\\."
+                )
+        except telegram.error.TelegramError as e:
+            await notify(f"❌ Failed to {action} user: {str(e)}", parse_mode=None)
 
-def warn(update: Update, context: CallbackContext) -> None:
+async def warn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Warn a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if update.message.reply_to_message:
-        warned_user = update.message.reply_to_message.from_user
-        user_id = warned_user.id
-        chat_id = update.effective_chat.id
-        
-        if str(chat_id) not in user_data:
-            user_data[str(chat_id)] = {}
-        if str(user_id) not in user_data[str(chat_id)]:
-            user_data[str(chat_id)][str(user_id)] = {"warnings": 0}
-        
-        user_data[str(chat_id)][str(user_id)]["warnings"] += 1
-        warn_count = user_data[str(chat_id)][str(user_id)]["warnings"]
-        save_data()
-        
-        update.message.reply_text(
-            f"⚠️ User {warned_user.mention_markdown_v2()} has been warned\.\n"
-            f"Warning count: {warn_count}/3",
-            parse_mode='MarkdownV2'
-        )
-        
-        if warn_count >= 3:
-            try:
-                if bot_has_admin_rights(context, chat_id):
-                    context.bot.kick_chat_member(chat_id, user_id)
-                    update.message.reply_text(
-                        f"🚫 User {warned_user.mention_markdown_v2()} has been banned due to excessive warnings\.",
-                        parse_mode='MarkdownV2'
-                    )
-            except telegram.error.TelegramError as e:
-                update.message.reply_text(f"❌ Failed to ban user: {str(e)}")
+        await issue_warning(context, update.effective_chat.id, update.message.reply_to_message.from_user, update.message)
     else:
-        update.message.reply_text("Please reply to a message to warn the user.")
+        await update.message.reply_text("Please reply to a message to warn the user.")
 
-def unwarn(update: Update, context: CallbackContext) -> None:
+async def unwarn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Remove a warning from a user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if update.message.reply_to_message:
@@ -604,42 +3261,31 @@ def unwarn(update: Update, context: CallbackContext) -> None:
         user_id = user.id
         chat_id = update.effective_chat.id
         
-        chat_id_str = str(chat_id)
-        user_id_str = str(user_id)
-        
-        if chat_id_str in user_data and user_id_str in user_data[chat_id_str]:
-            if user_data[chat_id_str][user_id_str]["warnings"] > 0:
-                user_data[chat_id_str][user_id_str]["warnings"] -= 1
-                warn_count = user_data[chat_id_str][user_id_str]["warnings"]
-                save_data()
-                update.message.reply_text(
-                    f"🔄 One warning has been removed from {user.mention_markdown_v2()}\.\n"
-                    f"Current warning count: {warn_count}",
-                    parse_mode='MarkdownV2'
-                )
-            else:
-                update.message.reply_text(
-                    f"{user.mention_markdown_v2()} has no warnings to remove\.",
-                    parse_mode='MarkdownV2'
-                )
+        remaining = await run_storage(store.remove_warning, chat_id, user_id, warn_policy(chat_id))
+        if remaining is not None:
+            await update.message.reply_text(
+                f"🔄 One warning has been removed from {user.mention_markdown_v2()}\.\n"
+                f"Current warning count: {remaining}",
+                parse_mode='MarkdownV2'
+            )
         else:
-            update.message.reply_text(
-                f"{user.mention_markdown_v2()} has no warnings\.",
+            await update.message.reply_text(
+                f"{user.mention_markdown_v2()} has no warnings to remove\.",
                 parse_mode='MarkdownV2'
             )
     else:
-        update.message.reply_text("Please reply to a message to remove a warning from the user.")
+        await update.message.reply_text("Please reply to a message to remove a warning from the user.")
 
-def promote(update: Update, context: CallbackContext) -> None:
+async def promote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Promote a user to admin."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't promote users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't promote users.")
         return
     
     if update.message.reply_to_message:
@@ -647,7 +3293,7 @@ def promote(update: Update, context: CallbackContext) -> None:
         custom_title = ' '.join(context.args) if context.args else "Admin"
         
         try:
-            context.bot.promote_chat_member(
+            await context.bot.promote_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
                 can_change_info=True,
@@ -659,32 +3305,33 @@ def promote(update: Update, context: CallbackContext) -> None:
             )
             
             try:
-                context.bot.set_chat_administrator_custom_title(chat_id, user_id, custom_title)
+                await context.bot.set_chat_administrator_custom_title(chat_id, user_id, custom_title)
             except:
                 pass  # Some chats don't allow custom titles
             
-            update.message.reply_text(f"🎖️ User {user_id} has been promoted to admin.")
+            update_admin_cache(chat_id, user_id, True)
+            await update.message.reply_text(f"🎖️ User {user_id} has been promoted to admin.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to promote user: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to promote user: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message to promote the user.")
+        await update.message.reply_text("Please reply to a message to promote the user.")
 
-def demote(update: Update, context: CallbackContext) -> None:
+async def demote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Demote an admin to regular user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't demote users.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't demote users.")
         return
     
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         try:
-            context.bot.promote_chat_member(
+            await context.bot.promote_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
                 can_change_info=False,
@@ -694,215 +3341,344 @@ def demote(update: Update, context: CallbackContext) -> None:
                 can_pin_messages=False,
                 can_promote_members=False
             )
-            update.message.reply_text(f"⬇️ User {user_id} has been demoted to regular user.")
+            update_admin_cache(chat_id, user_id, False)
+            await update.message.reply_text(f"⬇️ User {user_id} has been demoted to regular user.")
+        except telegram.error.TelegramError as e:
+            await update.message.reply_text(f"❌ Failed to demote user: {str(e)}")
+    else:
+        await update.message.reply_text("Please reply to a message to demote the user.")
+
+PURGE_LIMIT = 1000
+PURGE_BATCH_SIZE = 100  # Most message IDs a single delete_messages call accepts
+PURGE_WORKERS = 8
+
+async def _delete_one(bot: telegram.Bot, chat_id: int, message_id: int, slots: asyncio.Semaphore) -> bool:
+    async with slots:
+        try:
+            await call_with_retry(bot.delete_message, chat_id, message_id)
+            return True
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to demote user: {str(e)}")
+            logger.debug(f"Failed to delete message {message_id} in {chat_id}: {e}")
+            return False
+
+async def delete_message_ids(bot: telegram.Bot, chat_id: int, message_ids: List[int]) -> tuple:
+    """Delete messages and return the (deleted, failed) counts.
+
+    Uses bulk deletion in chunks of PURGE_BATCH_SIZE when the Bot API
+    client supports it, otherwise issues at most PURGE_WORKERS single
+    deletions at a time.
+    """
+    deleted = 0
+    failed = 0
+    if hasattr(bot, 'delete_messages'):
+        for start in range(0, len(message_ids), PURGE_BATCH_SIZE):
+            chunk = message_ids[start:start + PURGE_BATCH_SIZE]
+            try:
+                # Missing messages are skipped by the API rather than reported
+                await call_with_retry(bot.delete_messages, chat_id, chunk)
+                deleted += len(chunk)
+            except telegram.error.TelegramError as e:
+                logger.error(f"Failed to bulk delete messages in {chat_id}: {e}")
+                failed += len(chunk)
     else:
-        update.message.reply_text("Please reply to a message to demote the user.")
+        slots = asyncio.Semaphore(PURGE_WORKERS)
+        results = await asyncio.gather(
+            *(_delete_one(bot, chat_id, message_id, slots) for message_id in message_ids)
+        )
+        deleted = sum(results)
+        failed = len(results) - deleted
+    return deleted, failed
 
-def purge(update: Update, context: CallbackContext) -> None:
+async def purge(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Purge messages."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
     if not context.args:
-        update.message.reply_text("Please specify the number of messages to purge.")
+        await update.message.reply_text("Please specify the number of messages to purge.")
         return
     
     try:
         num_messages = int(context.args[0])
-        if num_messages < 1 or num_messages > 100:
-            update.message.reply_text("Please specify a number between 1 and 100.")
+        if num_messages < 1 or num_messages > PURGE_LIMIT:
+            await update.message.reply_text(f"Please specify a number between 1 and {PURGE_LIMIT}.")
             return
     except ValueError:
-        update.message.reply_text("Please provide a valid number.")
+        await update.message.reply_text("Please provide a valid number.")
         return
     
     if update.message.reply_to_message:
         start_id = update.message.reply_to_message.message_id
-        deleted = 0
+        message_ids = list(range(start_id, max(start_id - num_messages, 0), -1))
         
-        for i in range(start_id, start_id - num_messages, -1):
-            try:
-                context.bot.delete_message(chat_id, i)
-                deleted += 1
-            except:
-                pass
+        started = time.monotonic()
+        deleted, failed = await delete_message_ids(context.bot, chat_id, message_ids)
+        elapsed = time.monotonic() - started
         
-        update.message.reply_text(f"🧹 Purged {deleted} messages.")
+        notice = await update.message.reply_text(
+            f"🧹 Purged {deleted} messages in {elapsed:.1f}s."
+            + (f"\n❌ Failed: {failed}" if failed else "")
+        )
+        await delete_later(notice)
     else:
-        update.message.reply_text("Please reply to the starting message.")
+        await update.message.reply_text("Please reply to the starting message.")
 
-def filter_message(update: Update, context: CallbackContext) -> None:
+async def filter_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Add a filter."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
     if update.message.reply_to_message:
         if not context.args:
-            update.message.reply_text("Please provide a keyword for the filter.")
+            await update.message.reply_text(
+                "Please provide a keyword for the filter. Usage: /filter [word:|prefix:|regex:]<keyword>"
+            )
             return
         
-        keyword = context.args[0].lower()
+        filter_type, _, keyword = context.args[0].partition(':')
+        if filter_type not in FILTER_TYPES or not keyword:
+            filter_type, keyword = 'substring', context.args[0]
+        if filter_type == 'regex':
+            # Patterns may contain spaces and keep their case, since \S and \s differ
+            keyword = ' '.join([keyword] + context.args[1:])
+            try:
+                filter_pattern(filter_type, keyword)
+            except ValueError as e:
+                await update.message.reply_text(f"❌ Invalid pattern: {e}")
+                return
+            existing = store.get_filters(chat_id)
+            regexes = sum(1 for other, data in existing.items() if data.get("type") == 'regex' and other != keyword)
+            if regexes >= FILTER_REGEX_PER_CHAT:
+                await update.message.reply_text(f"❌ A chat can have at most {FILTER_REGEX_PER_CHAT} regex filters.")
+                return
+        else:
+            keyword = keyword.lower()
         message = update.message.reply_to_message
         
-        if str(chat_id) not in user_data:
-            user_data[str(chat_id)] = {}
-        if "filters" not in user_data[str(chat_id)]:
-            user_data[str(chat_id)]["filters"] = {}
-        
         filter_data = {
+            "type": filter_type,
             "text": message.text if message.text else None,
             "photo": message.photo[-1].file_id if message.photo else None,
             "sticker": message.sticker.file_id if message.sticker else None,
         }
         
-        user_data[str(chat_id)]["filters"][keyword] = filter_data
-        save_data()
+        await run_storage(store.put_filter, chat_id, keyword, filter_data)
+        invalidate_filter_matcher(chat_id)
         
-        update.message.reply_text(f"✅ Filter '{keyword}' has been added.")
+        await update.message.reply_text(f"✅ Filter '{keyword}' ({filter_type}) has been added.")
     else:
-        update.message.reply_text("Please reply to a message to create a filter.")
+        await update.message.reply_text("Please reply to a message to create a filter.")
 
-def stop_filter(update: Update, context: CallbackContext) -> None:
+async def stop_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Remove a filter."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
     if not context.args:
-        update.message.reply_text("Please specify the filter keyword to remove.")
+        await update.message.reply_text("Please specify the filter keyword to remove.")
         return
     
-    keyword = context.args[0].lower()
+    keyword = ' '.join(context.args)
+    filter_type, _, rest = keyword.partition(':')
+    if filter_type in FILTER_TYPES and rest:
+        # Accept the same type prefix /filter takes
+        keyword = rest
+    filters = store.get_filters(chat_id)
+    if keyword not in filters:
+        # Only regex filters keep their case
+        keyword = keyword.lower()
     
-    if str(chat_id) in user_data and "filters" in user_data[str(chat_id)]:
-        if keyword in user_data[str(chat_id)]["filters"]:
-            del user_data[str(chat_id)]["filters"][keyword]
-            save_data()
-            update.message.reply_text(f"✅ Filter '{keyword}' has been removed.")
-        else:
-            update.message.reply_text(f"Filter '{keyword}' not found.")
+    if not filters:
+        await update.message.reply_text("No filters found in this chat.")
+    elif await run_storage(store.delete_filter, chat_id, keyword):
+        invalidate_filter_matcher(chat_id)
+        await update.message.reply_text(f"✅ Filter '{keyword}' has been removed.")
     else:
-        update.message.reply_text("No filters found in this chat.")
+        await update.message.reply_text(f"Filter '{keyword}' not found.")
 
-def filter_list(update: Update, context: CallbackContext) -> None:
+async def filter_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all filters."""
     chat_id = update.effective_chat.id
     
-    if str(chat_id) in user_data and "filters" in user_data[str(chat_id)]:
-        filters = user_data[str(chat_id)]["filters"]
-        if filters:
-            filter_text = "📋 Active Filters:\n\n"
-            for keyword in filters:
-                filter_text += f"• {keyword}\n"
-            update.message.reply_text(filter_text)
-        else:
-            update.message.reply_text("No active filters in this chat.")
+    filters = store.get_filters(chat_id)
+    if filters:
+        filter_text = "📋 Active Filters:\n\n"
+        for keyword, filter_data in filters.items():
+            filter_type = filter_data.get("type", "substring")
+            filter_text += f"• {keyword}\n" if filter_type == 'substring' else f"• {filter_type}: {keyword}\n"
+        await update.message.reply_text(filter_text)
+    else:
+        await update.message.reply_text("No active filters in this chat.")
+
+async def gban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Global ban a user."""
+    if not is_sudo(update.effective_user.id):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
+        return
+    
+    if update.message.reply_to_message:
+        user_id = update.message.reply_to_message.from_user.id
+    elif context.args:
+        try:
+            user_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Please provide a valid user ID.")
+            return
+    else:
+        await update.message.reply_text("Please reply to a message or provide a user ID. Usage: /gban <user_id>")
+        return
+    
+    if is_sudo(user_id):
+        await update.message.reply_text("🚫 Sudo users can't be globally banned.")
+        return
+    
+    if await run_storage(store.add_gban, user_id):
+        gban_index.add(user_id)
+        status_text = f"🌐 User {user_id} has been globally banned. Removing them from all groups..."
+    else:
+        status_text = f"User {user_id} is already globally banned. Removing them from all groups again..."
+    
+    # Private chats have nothing to ban from
+    chat_ids = {chat_id for chat_id in await run_storage(store.chat_ids) if chat_id < 0}
+    if update.effective_chat.id < 0:
+        chat_ids.add(update.effective_chat.id)
+    status = await update.message.reply_text(status_text)
+    if not GbanSweep.start(context.bot, user_id, list(chat_ids), status.chat_id, status.message_id):
+        await status.edit_text(f"⚠️ User {user_id} is already being removed from all groups.")
+
+async def ungban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lift a global ban."""
+    if not is_sudo(update.effective_user.id):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Please provide a user ID. Usage: /ungban <user_id>")
+        return
+    
+    try:
+        user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Please provide a valid user ID.")
+        return
+    
+    if await run_storage(store.remove_gban, user_id):
+        gban_index.discard(user_id)
+        await run_storage(store.set_meta, f"gban_sweep:{user_id}", None)
+        await update.message.reply_text(f"✅ User {user_id} is no longer globally banned.")
     else:
-        update.message.reply_text("No active filters in this chat.")
+        await update.message.reply_text(f"User {user_id} is not globally banned.")
 
-def gban(update: Update, context: CallbackContext) -> None:
-    """Global ban a user."""
+async def gbanimport(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Globally ban every user ID listed in the arguments or a replied-to file."""
     if not is_sudo(update.effective_user.id):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
-    if update.message.reply_to_message:
-        user_id = update.message.reply_to_message.from_user.id
-        
-        # Store globally banned users
-        if "gban" not in user_data:
-            user_data["gban"] = []
-        
-        if user_id not in user_data["gban"]:
-            user_data["gban"].append(user_id)
-            save_data()
-            
-            update.message.reply_text(f"🌐 User {user_id} has been globally banned.")
-        else:
-            update.message.reply_text(f"User {user_id} is already globally banned.")
-    else:
-        update.message.reply_text("Please reply to a message to globally ban the user.")
+    tokens = list(context.args)
+    reply = update.message.reply_to_message
+    if reply and reply.document:
+        try:
+            source = await context.bot.get_file(reply.document.file_id)
+            tokens += bytes(await source.download_as_bytearray()).decode('utf-8', 'replace').replace(',', ' ').split()
+        except telegram.error.TelegramError as e:
+            logger.error(f"Error downloading gban list: {e}")
+            await update.message.reply_text("❌ Failed to download the file.")
+            return
+    elif reply and reply.text:
+        tokens += reply.text.replace(',', ' ').split()
+    
+    user_ids = {int(token) for token in tokens if token.lstrip('-').isdigit()}
+    user_ids = [user_id for user_id in user_ids if not is_sudo(user_id)]
+    if not user_ids:
+        await update.message.reply_text("Please provide user IDs or reply to a file or message listing them.")
+        return
+    
+    added = await run_storage(store.add_gbans, user_ids)
+    for user_id in user_ids:
+        gban_index.add(user_id)
+    await update.message.reply_text(f"🌐 Imported {added} new global bans ({len(user_ids) - added} already banned).")
 
-def lockall(update: Update, context: CallbackContext) -> None:
-    """Lock all permissions."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+async def lockall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lock all permissions, for a number of minutes if one is given."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't lock permissions.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't lock permissions.")
         return
     
+    duration = None
+    if context.args:
+        try:
+            duration = int(context.args[0])
+        except ValueError:
+            duration = 0
+        if duration <= 0:
+            await update.message.reply_text("Please provide the lock duration as a positive number of minutes.")
+            return
+    
     try:
-        context.bot.set_chat_permissions(
+        await context.bot.set_chat_permissions(
             chat_id=chat_id,
-            permissions=ChatPermissions(
-                can_send_messages=False,
-                can_send_media_messages=False,
-                can_send_polls=False,
-                can_send_other_messages=False,
-                can_add_web_page_previews=False,
-                can_change_info=False,
-                can_invite_users=False,
-                can_pin_messages=False
-            )
+            permissions=ChatPermissions.no_permissions()
         )
-        update.message.reply_text("🔒 All permissions have been locked.")
+        if duration:
+            await scheduler.schedule(f"unlock:{chat_id}", duration * 60, "unlock", chat_id)
+            await update.message.reply_text(f"🔒 All permissions have been locked for {duration} minutes.")
+        else:
+            await scheduler.cancel(f"unlock:{chat_id}")
+            await update.message.reply_text("🔒 All permissions have been locked.")
     except telegram.error.TelegramError as e:
-        update.message.reply_text(f"❌ Failed to lock permissions: {str(e)}")
+        await update.message.reply_text(f"❌ Failed to lock permissions: {str(e)}")
 
-def unlockall(update: Update, context: CallbackContext) -> None:
+async def unlockall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Unlock all permissions."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat. I can't unlock permissions.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat. I can't unlock permissions.")
         return
     
     try:
-        context.bot.set_chat_permissions(
+        await context.bot.set_chat_permissions(
             chat_id=chat_id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_polls=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True,
-                can_change_info=True,
-                can_invite_users=True,
-                can_pin_messages=True
-            )
+            permissions=ChatPermissions.all_permissions()
         )
-        update.message.reply_text("🔓 All permissions have been unlocked.")
+        # A manual unlock also ends a timed lock or a raid lockdown
+        await scheduler.cancel(f"unlock:{chat_id}")
+        await scheduler.cancel(f"raid_unlock:{chat_id}")
+        await run_storage(store.set_chat_value, chat_id, "raid_lockdown", None)
+        await update.message.reply_text("🔓 All permissions have been unlocked.")
     except telegram.error.TelegramError as e:
-        update.message.reply_text(f"❌ Failed to unlock permissions: {str(e)}")
+        await update.message.reply_text(f"❌ Failed to unlock permissions: {str(e)}")
 
-def delete_and_warn(update: Update, context: CallbackContext) -> None:
+async def delete_and_warn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Delete message and warn user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat.")
         return
     
     if update.message.reply_to_message:
@@ -910,39 +3686,26 @@ def delete_and_warn(update: Update, context: CallbackContext) -> None:
         user = message.from_user
         
         try:
-            # Delete message
-            context.bot.delete_message(chat_id, message.message_id)
-            
-            # Warn user
-            if str(chat_id) not in user_data:
-                user_data[str(chat_id)] = {}
-            if str(user.id) not in user_data[str(chat_id)]:
-                user_data[str(chat_id)][str(user.id)] = {"warnings": 0}
-            
-            user_data[str(chat_id)][str(user.id)]["warnings"] += 1
-            warn_count = user_data[str(chat_id)][str(user.id)]["warnings"]
-            save_data()
-            
-            update.message.reply_text(
-                f"🗑️⚠️ Message deleted and user warned\.\n"
-                f"Warning count: {warn_count}/3",
-                parse_mode='MarkdownV2'
-            )
+            await context.bot.delete_message(chat_id, message.message_id)
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to delete and warn: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to delete and warn: {str(e)}")
+            return
+        
+        # Warned like /warn, so the chat's warn policy applies
+        await issue_warning(context, chat_id, user, update.message)
     else:
-        update.message.reply_text("Please reply to a message.")
+        await update.message.reply_text("Please reply to a message.")
 
-def delete_and_mute(update: Update, context: CallbackContext) -> None:
+async def delete_and_mute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Delete message and mute user."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     chat_id = update.effective_chat.id
     
-    if not bot_has_admin_rights(context, chat_id):
-        update.message.reply_text("❌ I don't have admin rights in this chat.")
+    if not await bot_has_admin_rights(context, chat_id):
+        await update.message.reply_text("❌ I don't have admin rights in this chat.")
         return
     
     if update.message.reply_to_message:
@@ -951,29 +3714,24 @@ def delete_and_mute(update: Update, context: CallbackContext) -> None:
         
         try:
             # Delete message
-            context.bot.delete_message(chat_id, message.message_id)
+            await context.bot.delete_message(chat_id, message.message_id)
             
             # Mute user
-            context.bot.restrict_chat_member(
+            await context.bot.restrict_chat_member(
                 chat_id=chat_id,
                 user_id=user.id,
-                permissions=ChatPermissions(
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False
-                ),
+                permissions=MUTED_PERMISSIONS,
                 until_date=datetime.now() + timedelta(hours=1)
             )
             
-            update.message.reply_text(f"🗑️🔇 Message deleted and user muted for 1 hour.")
+            await update.message.reply_text(f"🗑️🔇 Message deleted and user muted for 1 hour.")
         except telegram.error.TelegramError as e:
-            update.message.reply_text(f"❌ Failed to delete and mute: {str(e)}")
+            await update.message.reply_text(f"❌ Failed to delete and mute: {str(e)}")
     else:
-        update.message.reply_text("Please reply to a message.")
+        await update.message.reply_text("Please reply to a message.")
 
 # USER COMMANDS
-def info(update: Update, context: CallbackContext) -> None:
+async def info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get user info."""
     user = update.effective_user
     chat = update.effective_chat
@@ -990,16 +3748,14 @@ def info(update: Update, context: CallbackContext) -> None:
         info_text += f"• ID: {chat.id}\n"
     
     # Check warnings
-    chat_id_str = str(chat.id)
-    user_id_str = str(user.id)
-    
-    if chat_id_str in user_data and user_id_str in user_data[chat_id_str]:
-        warnings = user_data[chat_id_str][user_id_str].get("warnings", 0)
-        info_text += f"\n⚠️ Warnings: {warnings}/3"
+    policy = warn_policy(chat.id)
+    warnings = len(active_warnings(store.get_warnings(chat.id, user.id), policy))
+    if warnings:
+        info_text += f"\n⚠️ Warnings: {warnings}/{policy['tiers'][-1][0]}"
     
-    update.message.reply_text(info_text)
+    await update.message.reply_text(info_text)
 
-def id_command(update: Update, context: CallbackContext) -> None:
+async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get user and chat IDs."""
     user = update.effective_user
     chat = update.effective_chat
@@ -1009,33 +3765,34 @@ def id_command(update: Update, context: CallbackContext) -> None:
     if chat.type != 'private':
         id_text += f"💬 Chat ID: `{chat.id}`"
     
-    update.message.reply_text(id_text, parse_mode='Markdown')
+    await update.message.reply_text(id_text, parse_mode='Markdown')
 
-def rules(update: Update, context: CallbackContext) -> None:
+async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show chat rules."""
     chat_id = update.effective_chat.id
     
-    if str(chat_id) in user_data and "rules" in user_data[str(chat_id)]:
-        rules_text = user_data[str(chat_id)]["rules"]
-        update.message.reply_text(f"📜 Chat Rules:\n\n{rules_text}")
+    rules_text = store.get_chat_value(chat_id, "rules")
+    if rules_text:
+        await update.message.reply_text(f"📜 Chat Rules:\n\n{rules_text}")
     else:
-        update.message.reply_text("No rules have been set for this chat.")
+        await update.message.reply_text("No rules have been set for this chat.")
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show help."""
     help_text = (
         "🔥 LegendBot Help\n\n"
         "⚔️ Admin Commands:\n"
-        "/ban - Ban a user\n"
+        "/ban [minutes] - Ban a user\n"
         "/unban - Unban a user\n"
         "/kick - Kick a user\n"
-        "/mute - Mute a user\n"
+        "/mute [minutes] - Mute a user\n"
         "/unmute - Unmute a user\n"
         "/warn - Warn a user\n"
         "/unwarn - Remove warning\n"
         "/purge - Delete messages\n"
-        "/filter - Add auto-reply\n"
-        "/lockall - Lock chat\n\n"
+        "/filter [word:|prefix:|regex:]<keyword> - Add auto-reply\n"
+        "/lockall [minutes] - Lock chat\n"
+        "/set_antiraid on|off|<joins> <seconds> - Lock chat on mass joins (off by default)\n\n"
         
         "👥 User Commands:\n"
         "/info - User info\n"
@@ -1051,37 +3808,37 @@ def help_command(update: Update, context: CallbackContext) -> None:
         f"👑 Owner: {OWNER_USERNAME}"
     )
     
-    update.message.reply_text(help_text)
+    await update.message.reply_text(help_text)
 
 # FUN COMMANDS
-def roll_dice(update: Update, context: CallbackContext) -> None:
+async def roll_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Roll a dice."""
     result = random.randint(1, 6)
-    update.message.reply_text(f"🎲 You rolled: {result}")
+    await update.message.reply_text(f"🎲 You rolled: {result}")
 
-def flip_coin(update: Update, context: CallbackContext) -> None:
+async def flip_coin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Flip a coin."""
     result = random.choice(["Heads", "Tails"])
-    update.message.reply_text(f"🪙 {result}!")
+    await update.message.reply_text(f"🪙 {result}!")
 
-def random_number(update: Update, context: CallbackContext) -> None:
+async def random_number(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate random number."""
     if context.args:
         try:
             max_num = int(context.args[0])
             if max_num < 1:
-                update.message.reply_text("Please provide a positive number.")
+                await update.message.reply_text("Please provide a positive number.")
                 return
             result = random.randint(1, max_num)
         except ValueError:
-            update.message.reply_text("Please provide a valid number.")
+            await update.message.reply_text("Please provide a valid number.")
             return
     else:
         result = random.randint(1, 100)
     
-    update.message.reply_text(f"🔢 Random number: {result}")
+    await update.message.reply_text(f"🔢 Random number: {result}")
 
-def quote(update: Update, context: CallbackContext) -> None:
+async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get a random quote."""
     quotes = [
         "The only way to do great work is to love what you do. - Steve Jobs",
@@ -1095,9 +3852,9 @@ def quote(update: Update, context: CallbackContext) -> None:
     ]
     
     chosen = random.choice(quotes)
-    update.message.reply_text(f"💬 {chosen}")
+    await update.message.reply_text(f"💬 {chosen}")
 
-def trivia(update: Update, context: CallbackContext) -> None:
+async def trivia(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Ask a trivia question."""
     questions = [
         {"q": "What is the capital of France?", "a": "Paris"},
@@ -1108,16 +3865,26 @@ def trivia(update: Update, context: CallbackContext) -> None:
     ]
     
     question = random.choice(questions)
-    update.message.reply_text(f"🎯 Trivia Question:\n\n{question['q']}\n\nAnswer will be revealed in 30 seconds!")
+    await update.message.reply_text(f"🎯 Trivia Question:\n\n{question['q']}\n\nAnswer will be revealed in 30 seconds!")
     
     # Schedule answer
     context.job_queue.run_once(
-        lambda ctx: update.message.reply_text(f"Answer: {question['a']}"),
+        reveal_trivia_answer,
         30,
-        context=update.message.chat_id
+        chat_id=update.message.chat_id,
+        data={"answer": question['a'], "message_id": update.message.message_id}
+    )
+
+async def reveal_trivia_answer(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reply to a trivia question with its answer."""
+    job = context.job
+    await context.bot.send_message(
+        job.chat_id,
+        f"Answer: {job.data['answer']}",
+        reply_to_message_id=job.data["message_id"]
     )
 
-def random_color(update: Update, context: CallbackContext) -> None:
+async def random_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate random color."""
     colors = {
         "🔴 Red": "#FF0000",
@@ -1131,274 +3898,1184 @@ def random_color(update: Update, context: CallbackContext) -> None:
     }
     
     color_name, hex_code = random.choice(list(colors.items()))
-    update.message.reply_text(f"🎨 Random Color: {color_name}\nHex: {hex_code}")
+    await update.message.reply_text(f"🎨 Random Color: {color_name}\nHex: {hex_code}")
 
 # SETTINGS COMMANDS
-def set_welcome(update: Update, context: CallbackContext) -> None:
+async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Set welcome message."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args:
-        update.message.reply_text("Please provide a welcome message.")
+        await update.message.reply_text("Please provide a welcome message.")
         return
     
     chat_id = update.effective_chat.id
     welcome_msg = ' '.join(context.args)
     
-    if str(chat_id) not in user_data:
-        user_data[str(chat_id)] = {}
+    await run_storage(store.set_chat_value, chat_id, "welcome", welcome_msg)
     
-    user_data[str(chat_id)]["welcome"] = welcome_msg
-    save_data()
-    
-    update.message.reply_text("✅ Welcome message set.")
+    await update.message.reply_text(
+        "✅ Welcome message set. Placeholders: {first} {last} {fullname} {username} {id} {chat} {count}"
+    )
 
-def set_goodbye(update: Update, context: CallbackContext) -> None:
+async def set_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Set goodbye message."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args:
-        update.message.reply_text("Please provide a goodbye message.")
+        await update.message.reply_text("Please provide a goodbye message.")
         return
     
     chat_id = update.effective_chat.id
     goodbye_msg = ' '.join(context.args)
     
-    if str(chat_id) not in user_data:
-        user_data[str(chat_id)] = {}
+    await run_storage(store.set_chat_value, chat_id, "goodbye", goodbye_msg)
     
-    user_data[str(chat_id)]["goodbye"] = goodbye_msg
-    save_data()
-    
-    update.message.reply_text("✅ Goodbye message set.")
+    await update.message.reply_text(
+        "✅ Goodbye message set. Placeholders: {first} {last} {fullname} {username} {id} {chat} {count}"
+    )
 
-def set_rules_command(update: Update, context: CallbackContext) -> None:
+async def set_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Set chat rules."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args:
-        update.message.reply_text("Please provide chat rules.")
+        await update.message.reply_text("Please provide chat rules.")
         return
     
     chat_id = update.effective_chat.id
     rules_msg = ' '.join(context.args)
     
-    if str(chat_id) not in user_data:
-        user_data[str(chat_id)] = {}
+    await run_storage(store.set_chat_value, chat_id, "rules", rules_msg)
     
-    user_data[str(chat_id)]["rules"] = rules_msg
-    save_data()
-    
-    update.message.reply_text("✅ Chat rules set.")
+    await update.message.reply_text("✅ Chat rules set.")
 
-def set_antispam(update: Update, context: CallbackContext) -> None:
+async def set_antispam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Set anti-spam settings."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args or len(context.args) != 2:
-        update.message.reply_text("Usage: /set_antispam <messages> <seconds>")
+        await update.message.reply_text("Usage: /set_antispam <messages> <seconds>")
         return
     
     try:
         messages = int(context.args[0])
         seconds = int(context.args[1])
+        if messages < 1 or seconds < 1:
+            await update.message.reply_text("Please provide positive numbers.")
+            return
         
         chat_id = update.effective_chat.id
         
-        if str(chat_id) not in user_data:
-            user_data[str(chat_id)] = {}
-        
-        user_data[str(chat_id)]["antispam"] = {
+        await run_storage(store.set_chat_value, chat_id, "antispam", {
             "messages": messages,
             "seconds": seconds
-        }
-        save_data()
+        })
         
-        update.message.reply_text(
+        await update.message.reply_text(
             f"✅ Anti-spam set: {messages} messages in {seconds} seconds"
         )
     except ValueError:
-        update.message.reply_text("Please provide valid numbers.")
+        await update.message.reply_text("Please provide valid numbers.")
 
-def set_antiflood(update: Update, context: CallbackContext) -> None:
+async def set_antiflood(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Set anti-flood settings."""
-    if not is_admin(update, context):
-        update.message.reply_text("🚫 You don't have permission to use this command.")
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
         return
     
     if not context.args or len(context.args) != 2:
-        update.message.reply_text("Usage: /set_antiflood <messages> <seconds>")
+        await update.message.reply_text("Usage: /set_antiflood <messages> <seconds>")
         return
     
     try:
         messages = int(context.args[0])
         seconds = int(context.args[1])
+        if messages < 1 or seconds < 1:
+            await update.message.reply_text("Please provide positive numbers.")
+            return
         
         chat_id = update.effective_chat.id
         
-        if str(chat_id) not in user_data:
-            user_data[str(chat_id)] = {}
-        
-        user_data[str(chat_id)]["antiflood"] = {
+        await run_storage(store.set_chat_value, chat_id, "antiflood", {
             "messages": messages,
             "seconds": seconds
-        }
-        save_data()
+        })
         
-        update.message.reply_text(
+        await update.message.reply_text(
             f"✅ Anti-flood set: {messages} messages in {seconds} seconds"
         )
     except ValueError:
-        update.message.reply_text("Please provide valid numbers.")
+        await update.message.reply_text("Please provide valid numbers.")
+
+async def set_floodaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set the action taken against flooders and spammers."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
+        return
+    
+    if not context.args or context.args[0].lower() not in FLOOD_ACTIONS:
+        await update.message.reply_text(f"Usage: /set_floodaction <{'|'.join(FLOOD_ACTIONS)}>")
+        return
+    
+    action = context.args[0].lower()
+    await run_storage(store.set_chat_value, update.effective_chat.id, "flood_action", action)
+    
+    await update.message.reply_text(f"✅ Flood action set: {action}")
+
+async def set_antiraid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set the join rate that triggers a raid lockdown."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
+        return
+    
+    chat_id = update.effective_chat.id
+    if context.args == ['off']:
+        await run_storage(store.set_chat_value, chat_id, "antiraid", False)
+        await update.message.reply_text("✅ Anti-raid disabled.")
+        return
+    
+    if context.args == ['on']:
+        args = [str(RAID_JOINS), str(RAID_SECONDS)]
+    else:
+        args = context.args
+    if not args or len(args) != 2:
+        await update.message.reply_text("Usage: /set_antiraid <joins> <seconds>, /set_antiraid on or /set_antiraid off")
+        return
+    
+    try:
+        joins = int(args[0])
+        seconds = int(args[1])
+        if joins < 2 or seconds < 1:
+            await update.message.reply_text("Please provide at least 2 joins and 1 second.")
+            return
+        
+        await run_storage(store.set_chat_value, chat_id, "antiraid", {
+            "joins": joins,
+            "seconds": seconds
+        })
+        
+        await update.message.reply_text(
+            f"✅ Anti-raid set: lockdown after {joins} joins in {seconds} seconds (new accounts count double)"
+        )
+    except ValueError:
+        await update.message.reply_text("Please provide valid numbers.")
+
+async def set_warnpolicy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set the actions taken at each warning count and how long warnings last."""
+    if not await is_admin(update, context):
+        await update.message.reply_text("🚫 You don't have permission to use this command.")
+        return
+    
+    chat_id = update.effective_chat.id
+    usage = (f"Usage: /set_warnpolicy <warnings> <{'|'.join(WARN_ACTIONS)}> [<warnings> <action> ...] [decay <hours>]\n"
+             "Example: /set_warnpolicy 3 mute 5 ban decay 72")
+    args = [arg.lower() for arg in context.args or []]
+    policy = warn_policy(chat_id)
+    
+    try:
+        decay = 0
+        if len(args) >= 2 and args[-2] == 'decay':
+            decay = float(args[-1]) * 3600
+            args = args[:-2]
+            if decay < 0:
+                raise ValueError
+        elif not args:
+            raise ValueError
+        if args:
+            if len(args) % 2:
+                raise ValueError
+            tiers = sorted((int(args[index]), args[index + 1]) for index in range(0, len(args), 2))
+            limits = [limit for limit, _ in tiers]
+            if limits[0] < 1 or len(set(limits)) != len(limits) or any(action not in WARN_ACTIONS for _, action in tiers):
+                raise ValueError
+        else:
+            # Only the decay was given
+            tiers = policy["tiers"]
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    
+    await run_storage(store.set_chat_value, chat_id, "warn_policy", {
+        "tiers": [list(tier) for tier in tiers],
+        "decay": decay
+    })
+    
+    steps = ", ".join(f"{limit} warnings → {action}" for limit, action in tiers)
+    expiry = f"warnings expire after {decay / 3600:g} hours" if decay else "warnings never expire"
+    await update.message.reply_text(f"✅ Warn policy set: {steps}; {expiry}")
+
+# FLOOD CONTROL
+FLOOD_ACTIONS = ['delete', 'mute', 'warn']
+FLOOD_MUTE_MINUTES = 10
+FLOOD_TRACKED_USERS = 100000  # (chat, user) pairs kept before the least active are evicted
+FLOOD_IDLE_SECONDS = 600  # Users silent for this long are forgotten
+
+class RateTracker:
+    """Sliding-window message counter per (chat, user) pair.
+
+    Each pair keeps a ring buffer of its last `limit` message times, so a
+    check is a constant-time comparison against the oldest entry. Pairs are
+    kept in least-recently-active order and evicted once idle or when the
+    tracker is full, which bounds memory regardless of group size.
+    """
+
+    def __init__(self, max_entries: int = FLOOD_TRACKED_USERS, idle_seconds: float = FLOOD_IDLE_SECONDS):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self._windows = OrderedDict()  # (chat_id, user_id) -> [fingerprint, last_seen, deque]
+
+    def hit(self, key: tuple, limit: int, seconds: float, fingerprint=None) -> bool:
+        """Record a message and return True if it exceeds `limit` in `seconds`.
+
+        Messages only count towards the same window while their fingerprint
+        is unchanged, which lets the same tracker detect repeated content.
+        """
+        now = time.monotonic()
+        entry = self._windows.get(key)
+        if entry is None or entry[2].maxlen != limit or entry[0] != fingerprint:
+            entry = [fingerprint, now, deque(maxlen=limit)]
+            self._windows[key] = entry
+        else:
+            entry[1] = now
+        # Replacing an entry keeps its old position, so both cases move it
+        self._windows.move_to_end(key)
+        window = entry[2]
+        window.append(now)
+        self._evict(now)
+        return len(window) == limit and now - window[0] <= seconds
+
+    def reset(self, key: tuple) -> None:
+        """Forget a pair once action has been taken against it."""
+        self._windows.pop(key, None)
+
+    def _evict(self, now: float) -> None:
+        windows = self._windows
+        while windows:
+            oldest = next(iter(windows.values()))
+            if len(windows) <= self.max_entries and now - oldest[1] < self.idle_seconds:
+                break
+            windows.popitem(last=False)
+
+flood_tracker = RateTracker()
+spam_tracker = RateTracker()
+
+async def enforce_flood_limits(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str) -> bool:
+    """Apply the chat's antiflood and antispam limits to an incoming message.
+
+    Antiflood counts every message from a user; antispam counts repeats of
+    the same message. Returns True if the message was acted on.
+    """
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    key = (chat_id, user.id)
+    
+    triggered = None
+    antiflood = store.get_chat_value(chat_id, "antiflood")
+    if antiflood and flood_tracker.hit(key, antiflood["messages"], antiflood["seconds"]):
+        triggered = "flooding"
+    antispam = store.get_chat_value(chat_id, "antispam")
+    if antispam and message_text and spam_tracker.hit(key, antispam["messages"], antispam["seconds"], hash(message_text)):
+        triggered = triggered or "spamming"
+    
+    if triggered is None or await is_admin(update, context) or not await bot_has_admin_rights(context, chat_id):
+        return False
+    
+    flood_tracker.reset(key)
+    spam_tracker.reset(key)
+    action = store.get_chat_value(chat_id, "flood_action", "delete")
+    try:
+        await context.bot.delete_message(chat_id, update.message.message_id)
+        if action == 'mute':
+            await context.bot.restrict_chat_member(
+                chat_id=chat_id,
+                user_id=user.id,
+                permissions=MUTED_PERMISSIONS,
+                until_date=datetime.now() + timedelta(minutes=FLOOD_MUTE_MINUTES)
+            )
+            # The flooding message is gone, so the notice can't reply to it
+            await context.bot.send_message(chat_id, f"🌊 User {user.id} has been muted for {FLOOD_MUTE_MINUTES} minutes for {triggered}.")
+        elif action == 'warn':
+            await issue_warning(context, chat_id, user)
+    except telegram.error.TelegramError as e:
+        logger.error(f"Failed to enforce flood limits in {chat_id}: {e}")
+    return True
 
 # MESSAGE HANDLER
-def handle_message(update: Update, context: CallbackContext) -> None:
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming messages."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     message_text = update.message.text.lower() if update.message.text else ""
+    store.count_message(chat_id)
     
-    # Check filters
-    if str(chat_id) in user_data and "filters" in user_data[str(chat_id)]:
-        for keyword, filter_data in user_data[str(chat_id)]["filters"].items():
-            if keyword in message_text:
-                if filter_data.get("text"):
-                    update.message.reply_text(filter_data["text"])
-                if filter_data.get("photo"):
-                    update.message.reply_photo(filter_data["photo"])
-                if filter_data.get("sticker"):
-                    update.message.reply_sticker(filter_data["sticker"])
-                break
+    if await ban_if_gbanned(context, chat_id, user_id):
+        try:
+            await update.message.delete()
+        except telegram.error.TelegramError:
+            pass
+        return
+    
+    if await enforce_flood_limits(update, context, message_text):
+        return
+    
+    # Check filters; the reply is sent in the background so a busy chat's
+    # send queue doesn't hold up the updates behind it
+    matcher = get_filter_matcher(chat_id)
+    keyword = matcher.first_match(message_text)
+    if keyword is not None:
+        context.application.create_task(
+            send_filter_reply(context.bot, update.message, matcher.filters[keyword]), update=update
+        )
+
+async def send_filter_reply(bot: telegram.Bot, message: telegram.Message, filter_data: dict) -> None:
+    """Reply to a message with a filter's content."""
+    # Same replies to a burst of triggers are coalesced into one
+    options = {
+        "reply_to_message_id": message.message_id if message.chat.type != 'private' else None,
+        "rate_limit_args": {"coalesce": True}
+    }
+    try:
+        if filter_data.get("text"):
+            await bot.send_message(message.chat_id, filter_data["text"], **options)
+        if filter_data.get("photo"):
+            await bot.send_photo(message.chat_id, filter_data["photo"], **options)
+        if filter_data.get("sticker"):
+            await bot.send_sticker(message.chat_id, filter_data["sticker"], **options)
+    except SendDropped:
+        pass
+    except telegram.error.TelegramError as e:
+        logger.error(f"Failed to send filter reply in {message.chat_id}: {e}")
 
 # BUTTON HANDLER
-def button(update: Update, context: CallbackContext) -> None:
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle button presses."""
     query = update.callback_query
-    query.answer()
+    await query.answer()
     
     data = query.data
     
     if data == 'main_menu':
-        main_menu(update, context)
+        await main_menu(update, context)
     elif data == 'admin_commands':
-        admin_commands(update, context)
+        await admin_commands(update, context)
     elif data == 'user_commands':
-        user_commands(update, context)
+        await user_commands(update, context)
     elif data == 'fun_commands':
-        fun_commands(update, context)
+        await fun_commands(update, context)
     elif data == 'settings':
-        settings(update, context)
+        await settings(update, context)
     elif data == 'sudo_menu':
-        sudo_menu(update, context)
+        await sudo_menu(update, context)
     elif data == 'add_sudo':
-        query.edit_message_text("Use /addsudo <user_id> to add a sudo user.")
+        await query.edit_message_text("Use /addsudo <user_id> to add a sudo user.")
     elif data == 'remove_sudo':
-        query.edit_message_text("Use /removesudo <user_id> to remove a sudo user.")
+        await query.edit_message_text("Use /removesudo <user_id> to remove a sudo user.")
     elif data == 'list_sudo':
-        listsudo(update, context)
+        await listsudo(update, context)
     elif data == 'backup_data':
-        backup(update, context)
+        await backup(update, context)
     elif data == 'restore_data':
-        query.edit_message_text("Restore feature coming soon.")
+        await query.edit_message_text("Restore feature coming soon.")
     elif data == 'bot_stats':
-        stats(update, context)
+        await stats(update, context)
     elif data == 'global_broadcast':
-        query.edit_message_text("Use /broadcast <message> to send a global message.")
+        await query.edit_message_text("Use /broadcast <message> to send a global message.")
     elif data == 'maintenance_mode':
-        maintenance(update, context)
+        await maintenance(update, context)
     elif data in ['ban', 'unban', 'kick', 'mute', 'unmute', 'warn', 'unwarn', 
                   'promote', 'demote', 'purge', 'filter', 'stop', 'filterlist', 
                   'gban', 'lockall', 'unlockall', 'dwarn', 'dmute']:
-        query.edit_message_text(f"Use /{data} command to {data.replace('_', ' ')}.")
+        await query.edit_message_text(f"Use /{data} command to {data.replace('_', ' ')}.")
     elif data in ['info', 'id', 'rules', 'help']:
-        query.edit_message_text(f"Use /{data} command to get {data.replace('_', ' ')}.")
+        await query.edit_message_text(f"Use /{data} command to get {data.replace('_', ' ')}.")
     elif data in ['roll_dice', 'flip_coin', 'random_number', 'quote', 'trivia', 'random_color']:
-        query.edit_message_text(f"Use /{data} command for {data.replace('_', ' ')}.")
+        await query.edit_message_text(f"Use /{data} command for {data.replace('_', ' ')}.")
     elif data in ['set_welcome', 'set_goodbye', 'set_rules', 'set_antispam', 'set_antiflood', 'set_blacklist']:
-        query.edit_message_text(f"Use /{data} command to set {data.replace('set_', '').replace('_', ' ')}.")
+        await query.edit_message_text(f"Use /{data} command to set {data.replace('set_', '').replace('_', ' ')}.")
 
-def main():
-    """Start the bot."""
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+# WEBHOOK SERVER
+HTTP_MAX_BODY = 1024 * 1024  # Bytes; Telegram's updates are far smaller
+HTTP_MAX_HEADERS = 100
+HTTP_READ_TIMEOUT = 10  # Seconds to receive the rest of a request once it has started
+HTTP_IDLE_TIMEOUT = 120  # Seconds a keep-alive connection may wait for its next request
+
+class HTTPError(Exception):
+    """A request answered with an error status, after which the connection is closed."""
+
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+async def read_http_head(reader: asyncio.StreamReader) -> Optional[tuple]:
+    """Read a request line and headers as (method, path, headers), or None at end of stream.
+
+    The body is left for read_http_body, so a request can be turned away
+    before it is read.
+    """
+    request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), HTTP_READ_TIMEOUT)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= HTTP_MAX_HEADERS:
+            raise HTTPError('431 Request Header Fields Too Large')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, path.split('?', 1)[0], headers
+
+async def read_http_body(reader: asyncio.StreamReader, headers: dict) -> bytes:
+    """Read the body announced by a request's Content-Length, up to HTTP_MAX_BODY bytes."""
+    length = int(headers.get('content-length', 0))
+    if length < 0:
+        raise HTTPError('400 Bad Request')
+    if length > HTTP_MAX_BODY:
+        raise HTTPError('413 Payload Too Large')
+    return await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT)
+
+async def write_http_response(writer: asyncio.StreamWriter, status: str, headers: dict,
+                              body: bytes = b'', content_type: str = 'text/plain') -> bool:
+    """Send a response and return whether the connection stays open."""
+    keep_alive = headers.get('connection', '').lower() != 'close'
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+    )
+    await writer.drain()
+    return keep_alive
+
+async def enqueue_update(application: Application, data: dict) -> None:
+    """Hand a decoded update to the application's update queue."""
+    await application.update_queue.put(Update.de_json(data, application.bot))
+
+async def write_http_error(writer: asyncio.StreamWriter, status: str) -> None:
+    """Answer a rejected request and close the connection, whose body may be left unread."""
+    try:
+        await write_http_response(writer, status, {'connection': 'close'})
+    except ConnectionError:
+        pass
+
+async def _handle_webhook_connection(deliver, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Serve webhook requests on one keep-alive HTTP connection, passing each update to deliver."""
+    try:
+        while True:
+            request = await read_http_head(reader)
+            if request is None:
+                break
+            method, path, headers = request
+            
+            # Checked before the body is read, so unauthenticated clients can't make the server buffer it
+            if method != 'POST' or path != f"/{WEBHOOK_PATH.lstrip('/')}":
+                raise HTTPError('404 Not Found')
+            if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+                raise HTTPError('403 Forbidden')
+            body = await read_http_body(reader, headers)
+            try:
+                data = json.loads(body)
+                if not isinstance(data, dict):
+                    raise TypeError("update is not a JSON object")
+                await deliver(data)
+                status = '200 OK'
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                logger.warning(f"Rejected malformed webhook update: {e}")
+                status = '400 Bad Request'
+            
+            if not await write_http_response(writer, status, headers):
+                break
+    except HTTPError as e:
+        await write_http_error(writer, e.status)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def run_webhook(application: Application) -> None:
+    """Receive updates on a local HTTP endpoint instead of long polling.
+
+    Updates are handed straight to the application's update queue. When
+    WEBHOOK_URL is set it is registered with Telegram; leave it unset when
+    a reverse proxy or a local replay tool posts to the server directly.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    async with application:
+        await post_init(application)
+        await application.start()
+        await serve_webhook(application.bot, partial(enqueue_update, application), stop)
+        await application.stop()
+    await post_shutdown(application)
+
+async def serve_webhook(bot: telegram.Bot, deliver, stop: asyncio.Event) -> None:
+    """Register the webhook if WEBHOOK_URL is set and serve it until stop is set."""
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    server = await asyncio.start_server(
+        partial(_handle_webhook_connection, deliver), WEBHOOK_LISTEN, WEBHOOK_PORT
+    )
+    logger.info(f"Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH.lstrip('/')}")
+    async with server:
+        await stop.wait()
+
+# WORKER PROCESSES
+WORKER_STATS_INTERVAL = 10  # Seconds between workers sharing their /stats counters
+POLL_TIMEOUT = 30  # Seconds the supervisor's getUpdates long poll waits for updates
+
+worker_index: Optional[int] = None  # Set in worker processes
+_peer_stats: Dict[int, dict] = {}  # worker index -> counters it last shared
+_publish_lock = threading.Lock()
+
+def worker_for(chat_id: int) -> int:
+    """Return the index of the worker process that owns a chat."""
+    return chat_id % WORKER_PROCESSES
+
+def update_chat_id(data: dict) -> int:
+    """Return the chat an update belongs to, or its sender for updates without a chat."""
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        # Callback queries carry the chat on the message their button is attached to
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = payload.get("from") or payload.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+def cluster_totals() -> Dict[str, int]:
+    """Return store.stats() with the counts the other workers last shared added in."""
+    totals = store.stats()
+    for peer in _peer_stats.values():
+        for kind, count in peer["totals"].items():
+            totals[kind] += count
+    return totals
+
+def cluster_top_chats(kind: str, limit: int) -> List[tuple]:
+    """Return the top chats across every worker."""
+    # Workers own disjoint chats, so merging their rankings gives the overall one
+    ranked = store.top_chats(kind, limit)
+    for peer in _peer_stats.values():
+        ranked.extend(tuple(pair) for pair in peer["top"].get(kind, []))
+    return heapq.nlargest(limit, ranked, key=lambda pair: pair[1])
+
+def _publish(connection, message: tuple) -> None:
+    # Called from the storage thread as well as the event loop
+    with _publish_lock:
+        connection.send(message)
+
+def apply_global_record(record: dict) -> None:
+    """Apply a bot-wide change relayed by the supervisor."""
+    store.globals.apply(record)
+    op = record["op"]
+    if op == "gban":
+        gban_index.add(record["user"])
+    elif op == "gban_bulk":
+        for user_id in record["users"]:
+            gban_index.add(user_id)
+    elif op == "ungban":
+        gban_index.discard(record["user"])
+
+async def _share_stats(connection) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(WORKER_STATS_INTERVAL)
+        data = {
+            "totals": store.counters.totals(),
+            "top": {kind: store.top_chats(kind, STATS_TOP_CHATS) for kind in ('messages', 'warnings')}
+        }
+        # Sent off the event loop so a full pipe never stops this worker reading its updates
+        await loop.run_in_executor(None, _publish, connection, ("stats", worker_index, data))
+
+async def _serve_worker(connection) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    application = build_application()
+
+    def receive() -> None:
+        while connection.poll():
+            try:
+                message = connection.recv()
+            except EOFError:
+                # The supervisor is gone
+                loop.remove_reader(connection.fileno())
+                stop.set()
+                return
+            kind = message[0]
+            if kind == "update":
+                application.update_queue.put_nowait(Update.de_json(message[1], application.bot))
+            elif kind == "record":
+                apply_global_record(message[1])
+            elif kind == "stats":
+                if message[1] != worker_index:
+                    _peer_stats[message[1]] = message[2]
+            elif kind == "stop":
+                stop.set()
+
+    async with application:
+        await post_init(application)
+        await application.start()
+        loop.add_reader(connection.fileno(), receive)
+        sharing = asyncio.create_task(_share_stats(connection))
+        await stop.wait()
+        sharing.cancel()
+        await application.stop()
+    await post_shutdown(application)
+
+def run_worker(index: int, connection) -> None:
+    """Entry point of a worker process started by the supervisor."""
+    global worker_index, store, global_send_limiter, METRICS_PORT, PROFILE_DIR
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_index = index
+    _, snapshot = connection.recv()
+    replica = ReplicaStore(snapshot, lambda record: _publish(connection, ("record", record)))
+    store = ShardedStore(worker=index, globals_store=replica)
+    store.load()
+    # The Bot API's bot-wide send rate is shared by every worker
+    global_send_limiter = TokenBucket(GLOBAL_SEND_RATE / WORKER_PROCESSES, GLOBAL_SEND_RATE / WORKER_PROCESSES)
+    if METRICS_PORT is not None:
+        METRICS_PORT += 1 + index
+    PROFILE_DIR = os.path.join(PROFILE_DIR, f"worker-{index}")
+    asyncio.run(_serve_worker(connection))
+
+class Supervisor:
+    """Receives updates and routes each to the worker process that owns its chat.
+
+    Every chat belongs to one worker (chat_id % WORKER_PROCESSES), so its
+    settings, filters, caches and flood counters are only ever touched by
+    that process. The supervisor owns the bot-wide state (sudo users,
+    gbans, meta): workers keep a replica, send their changes here to be
+    logged, and every change is relayed back to all workers in the order
+    it was logged, so the replicas converge. Workers also relay their
+    statistics so /stats can report on every chat. A worker that dies is
+    restarted.
+    """
+
+    def __init__(self):
+        self.shards = ShardedStore()
+        self.context = multiprocessing.get_context('spawn')
+        self.workers: List[Optional[tuple]] = [None] * WORKER_PROCESSES  # (process, connection) per index
+        self.stopping = False
+        self.offset = None  # update_id after the last update handed to a worker
+
+    def _snapshot(self) -> dict:
+        globals_store = self.shards.globals
+        with globals_store._lock:
+            return {
+                "gbans": list(globals_store.gbans),
+                "sudo_users": list(globals_store.sudo_users),
+                "meta": dict(globals_store.meta)
+            }
+
+    def _start_worker(self, index: int) -> None:
+        connection, child = self.context.Pipe()
+        process = self.context.Process(target=run_worker, args=(index, child), name=f"worker-{index}")
+        process.start()
+        child.close()
+        connection.send(("globals", self._snapshot()))
+        self.workers[index] = (process, connection)
+        asyncio.get_running_loop().add_reader(connection.fileno(), self._receive, index)
+
+    def _send(self, index: int, message: tuple) -> None:
+        if self.workers[index] is None:
+            return
+        try:
+            self.workers[index][1].send(message)
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            logger.error(f"Failed to reach worker {index}: {e}")
+
+    def _relay(self, message: tuple) -> None:
+        for index in range(WORKER_PROCESSES):
+            self._send(index, message)
+
+    def _receive(self, index: int) -> None:
+        process, connection = self.workers[index]
+        while True:
+            try:
+                if not connection.poll():
+                    return
+                message = connection.recv()
+            except (EOFError, OSError):
+                asyncio.get_running_loop().remove_reader(connection.fileno())
+                connection.close()
+                process.join()
+                self.workers[index] = None
+                if not self.stopping:
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                    self._start_worker(index)
+                return
+            if message[0] == "record":
+                self.shards.globals._commit(message[1])
+                self._relay(message)
+            elif message[0] == "stats":
+                self._relay(message)
+
+    async def deliver(self, data: dict) -> None:
+        self._send(worker_for(update_chat_id(data)), ("update", data))
+
+    async def poll(self, bot: telegram.Bot) -> None:
+        """Long poll for updates until cancelled."""
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=self.offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES
+                )
+            except telegram.error.RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except telegram.error.TelegramError as e:
+                logger.error(f"Failed to get updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.offset = update.update_id + 1
+                await self.deliver(update.to_dict())
+
+    async def run(self) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        self.shards.load_globals()
+        for index in range(WORKER_PROCESSES):
+            self._start_worker(index)
+        logger.info(f"Started {WORKER_PROCESSES} worker processes")
+        
+        async with telegram.Bot(TOKEN) as bot:
+            if WEBHOOK_MODE:
+                await serve_webhook(bot, self.deliver, stop)
+            else:
+                polling = asyncio.create_task(self.poll(bot))
+                await stop.wait()
+                polling.cancel()
+                if self.offset is not None:
+                    # Confirm the delivered updates so the next start doesn't fetch them again
+                    await bot.get_updates(offset=self.offset, timeout=0)
+        
+        self.stopping = True
+        self._relay(("stop",))
+        # Workers publish their final records while shutting down, so keep receiving until they exit
+        while any(self.workers):
+            await asyncio.sleep(0.1)
+        self.shards.globals.flush()
+
+# METRICS
+METRICS_PORT = None  # Port for the Prometheus /metrics endpoint; None disables it. Worker N uses METRICS_PORT + 1 + N
+METRICS_LISTEN = '127.0.0.1'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+_metrics_server = None
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name + _format_labels(self.labels, label_values), value
+
+class Histogram(Counter):
+    """Distribution of observed durations over LATENCY_BUCKETS."""
+
+    kind = 'histogram'
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            # Per-bucket counts, then the +Inf bucket, then the running sum
+            series = self.values[label_values] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        series[bisect_left(LATENCY_BUCKETS, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), series):
+                cumulative += count
+                yield self.name + '_bucket' + _format_labels(self.labels, label_values, f'le="{bound}"'), cumulative
+            yield self.name + '_sum' + _format_labels(self.labels, label_values), series[-1]
+            yield self.name + '_count' + _format_labels(self.labels, label_values), cumulative
+
+class Gauge(Counter):
+    """Value read from a function when the metrics are scraped."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, function=None, kind: str = 'gauge'):
+        super().__init__(name, help_text)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, self.function()
+
+handler_seconds = Histogram('legendbot_handler_seconds', "Time spent in each update handler", ('handler',))
+handler_errors = Counter('legendbot_handler_errors_total', "Exceptions raised by each update handler", ('handler',))
+api_requests = Counter('legendbot_api_requests_total', "Bot API requests by method and outcome", ('method', 'result'))
+api_seconds = Histogram('legendbot_api_request_seconds', "Bot API request latency", ('method',))
+update_backlog = Gauge('legendbot_update_queue_size', "Updates waiting to be processed")
+Gauge('legendbot_send_queue_size', "Outgoing messages waiting in the send queue", send_queue.backlog)
+Gauge('legendbot_sends_coalesced_total', "Filter replies merged into an identical send",
+      lambda: send_queue.coalesced, 'counter')
+Gauge('legendbot_sends_dropped_total', "Filter replies dropped because the chat's send queue was full",
+      lambda: send_queue.dropped, 'counter')
+Gauge('legendbot_scheduled_actions', "Timed actions waiting to fire", lambda: len(scheduler))
+Gauge('legendbot_storage_flushes_total', "Storage flushes",
+      lambda: store.flush_stats.flushes, 'counter')
+Gauge('legendbot_storage_flush_seconds_total', "Time spent flushing storage",
+      lambda: store.flush_stats.total_seconds, 'counter')
+Gauge('legendbot_storage_flush_max_seconds', "Slowest storage flush",
+      lambda: store.flush_stats.max_seconds)
+
+def render_metrics() -> str:
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+def timed_handler(callback):
+    """Wrap a handler callback to record its latency and exceptions.
+
+    The wrapper also feeds the profiling hooks: it tracks where the update
+    spent its time, samples it through cProfile and logs it when slow.
+    """
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        timer = UpdateTimer()
+        token = _update_timer.set(timer)
+        profiler = start_profile() if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE else None
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_seconds.observe(elapsed, name)
+            _update_timer.reset(token)
+            if profiler is not None:
+                finish_profile(name, profiler)
+            if elapsed >= SLOW_UPDATE_SECONDS:
+                log_slow_update(name, update, elapsed, timer)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPX transport that counts Bot API calls per method and outcome."""
+
+    # Status codes mapped to the exception the library raises for them
+    STATUS_RESULTS = {200: 'ok', 400: 'BadRequest', 401: 'InvalidToken', 403: 'Forbidden',
+                      404: 'InvalidToken', 409: 'Conflict', 429: 'RetryAfter'}
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            api_requests.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            api_seconds.observe(elapsed, api_method)
+            timer = _update_timer.get()
+            if timer is not None:
+                timer.api += elapsed
+        api_requests.inc(api_method, self.STATUS_RESULTS.get(code, f'HTTP{code}'))
+        return code, payload
+
+async def _handle_metrics_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Serve GET /metrics on one keep-alive HTTP connection."""
+    try:
+        while True:
+            request = await read_http_head(reader)
+            if request is None:
+                break
+            method, path, headers = request
+            await read_http_body(reader, headers)
+            if method == 'GET' and path == '/metrics':
+                keep_alive = await write_http_response(
+                    writer, '200 OK', headers, render_metrics().encode(), 'text/plain; version=0.0.4'
+                )
+            else:
+                keep_alive = await write_http_response(writer, '404 Not Found', headers)
+            if not keep_alive:
+                break
+    except HTTPError as e:
+        await write_http_error(writer, e.status)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server() -> None:
+    global _metrics_server
+    if METRICS_PORT is not None and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(_handle_metrics_connection, METRICS_LISTEN, METRICS_PORT)
+        logger.info(f"Serving metrics on {METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+# PROFILING
+PROFILE_SAMPLE_RATE = 0.0  # Fraction of updates run under cProfile; 0 disables profiling
+PROFILE_DIR = 'profiles'  # Aggregated per-handler profiles are written here as <handler>.prof
+PROFILE_DUMP_EVERY = 50  # Profiled updates between writes of the profile files
+SLOW_UPDATE_SECONDS = 1.0  # Updates slower than this are logged with a time breakdown
+
+class UpdateTimer:
+    """Time one update spent waiting on the Bot API and on the storage thread."""
+
+    __slots__ = ('api', 'storage')
+
+    def __init__(self):
+        self.api = 0.0
+        self.storage = 0.0
+
+_update_timer = contextvars.ContextVar('update_timer', default=None)
+_profiles: Dict[str, pstats.Stats] = {}
+_profiled_updates = 0
+_profiler_active = False
+
+def start_profile() -> Optional[cProfile.Profile]:
+    """Start profiling the current update unless another one is being profiled.
+
+    The profiler sees everything the event loop runs meanwhile, so with
+    concurrent updates a sample can include bits of other handlers.
+    """
+    global _profiler_active
+    if _profiler_active:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler (e.g. a debugger) is already installed
+        return None
+    _profiler_active = True
+    return profiler
+
+def finish_profile(name: str, profiler: cProfile.Profile) -> None:
+    """Fold a sampled update's profile into its handler's aggregate."""
+    global _profiler_active, _profiled_updates
+    profiler.disable()
+    _profiler_active = False
+    if name in _profiles:
+        _profiles[name].add(profiler)
+    else:
+        _profiles[name] = pstats.Stats(profiler)
+    _profiled_updates += 1
+    if _profiled_updates % PROFILE_DUMP_EVERY == 0:
+        dump_profiles()
+
+def dump_profiles() -> None:
+    """Write each handler's aggregated profile, readable with pstats or snakeviz."""
+    if not _profiles:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        for name, stats in _profiles.items():
+            stats.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+    except OSError as e:
+        logger.error(f"Error writing profiles: {e}")
+
+def log_slow_update(name: str, update: object, elapsed: float, timer: UpdateTimer) -> None:
+    # API calls and storage waits may overlap, so the remainder is a lower bound
+    python = max(0.0, elapsed - timer.api - timer.storage)
+    chat = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+    update_id = update.update_id if isinstance(update, Update) else None
+    logger.warning(
+        f"Slow update {update_id} in {name} (chat {chat}): {elapsed:.3f}s total, "
+        f"{timer.api:.3f}s Bot API, {timer.storage:.3f}s storage, {python:.3f}s other"
+    )
+
+async def post_init(application: Application) -> None:
+    """Load the gban index and scheduled actions and resume background work once the bot is initialized."""
+    await start_metrics_server()
+    gban_index.load(await run_storage(store.get_gbans))
+    scheduler.load(await run_storage(store.get_scheduled))
+    application.job_queue.run_repeating(scheduler.tick, SCHEDULER_TICK_SECONDS, name="scheduler")
+    # With several workers only the first resumes an interrupted broadcast
+    if not worker_index:
+        await resume_broadcast(application.bot)
+
+async def post_shutdown(application: Application) -> None:
+    """Save data on shutdown."""
+    if _metrics_server is not None:
+        _metrics_server.close()
+    dump_profiles()
+    await run_storage(store.close)
+    _storage_executor.shutdown(wait=True)
+
+async def prefetch_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Load the chat's state off the event loop before the handlers read it."""
+    if update.effective_chat:
+        await run_storage(store.prefetch, update.effective_chat.id)
+
+def build_application(bot: Optional[telegram.Bot] = None) -> Application:
+    """Create the application and register every handler.
+
+    A prebuilt bot can be passed in place of the configured token; it
+    should be an ExtBot using send_queue as its rate limiter.
+    """
+    if bot is not None:
+        builder = Application.builder().bot(bot)
+    else:
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            .request(InstrumentedRequest(connection_pool_size=CONCURRENT_UPDATES))
+            .rate_limiter(send_queue)
+        )
+    application = (
+        builder
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Runs first for every update so a cache miss never reads a shard file on the event loop
+    application.add_handler(TypeHandler(Update, prefetch_chat), group=-1)
     
     # Command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("sudohelp", sudohelp))
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("sudohelp", sudohelp))
     
     # Admin commands
-    dispatcher.add_handler(CommandHandler("ban", ban))
-    dispatcher.add_handler(CommandHandler("unban", unban))
-    dispatcher.add_handler(CommandHandler("kick", kick))
-    dispatcher.add_handler(CommandHandler("mute", mute))
-    dispatcher.add_handler(CommandHandler("unmute", unmute))
-    dispatcher.add_handler(CommandHandler("warn", warn))
-    dispatcher.add_handler(CommandHandler("unwarn", unwarn))
-    dispatcher.add_handler(CommandHandler("promote", promote))
-    dispatcher.add_handler(CommandHandler("demote", demote))
-    dispatcher.add_handler(CommandHandler("purge", purge))
-    dispatcher.add_handler(CommandHandler("filter", filter_message))
-    dispatcher.add_handler(CommandHandler("stop", stop_filter))
-    dispatcher.add_handler(CommandHandler("filterlist", filter_list))
-    dispatcher.add_handler(CommandHandler("gban", gban))
-    dispatcher.add_handler(CommandHandler("lockall", lockall))
-    dispatcher.add_handler(CommandHandler("unlockall", unlockall))
-    dispatcher.add_handler(CommandHandler("dwarn", delete_and_warn))
-    dispatcher.add_handler(CommandHandler("dmute", delete_and_mute))
+    application.add_handler(CommandHandler("ban", ban))
+    application.add_handler(CommandHandler("unban", unban))
+    application.add_handler(CommandHandler("kick", kick))
+    application.add_handler(CommandHandler("mute", mute))
+    application.add_handler(CommandHandler("unmute", unmute))
+    application.add_handler(CommandHandler("warn", warn))
+    application.add_handler(CommandHandler("unwarn", unwarn))
+    application.add_handler(CommandHandler("promote", promote))
+    application.add_handler(CommandHandler("demote", demote))
+    application.add_handler(CommandHandler("purge", purge))
+    application.add_handler(CommandHandler("filter", filter_message))
+    application.add_handler(CommandHandler("stop", stop_filter))
+    application.add_handler(CommandHandler("filterlist", filter_list))
+    application.add_handler(CommandHandler("gban", gban))
+    application.add_handler(CommandHandler("ungban", ungban))
+    application.add_handler(CommandHandler("gbanimport", gbanimport))
+    application.add_handler(CommandHandler("lockall", lockall))
+    application.add_handler(CommandHandler("unlockall", unlockall))
+    application.add_handler(CommandHandler("dwarn", delete_and_warn))
+    application.add_handler(CommandHandler("dmute", delete_and_mute))
     
     # User commands
-    dispatcher.add_handler(CommandHandler("info", info))
-    dispatcher.add_handler(CommandHandler("id", id_command))
-    dispatcher.add_handler(CommandHandler("rules", rules))
+    application.add_handler(CommandHandler("info", info))
+    application.add_handler(CommandHandler("id", id_command))
+    application.add_handler(CommandHandler("rules", rules))
     
     # Fun commands
-    dispatcher.add_handler(CommandHandler("roll", roll_dice))
-    dispatcher.add_handler(CommandHandler("flip", flip_coin))
-    dispatcher.add_handler(CommandHandler("random", random_number))
-    dispatcher.add_handler(CommandHandler("quote", quote))
-    dispatcher.add_handler(CommandHandler("trivia", trivia))
-    dispatcher.add_handler(CommandHandler("color", random_color))
+    application.add_handler(CommandHandler("roll", roll_dice))
+    application.add_handler(CommandHandler("flip", flip_coin))
+    application.add_handler(CommandHandler("random", random_number))
+    application.add_handler(CommandHandler("quote", quote))
+    application.add_handler(CommandHandler("trivia", trivia))
+    application.add_handler(CommandHandler("color", random_color))
     
     # Settings
-    dispatcher.add_handler(CommandHandler("set_welcome", set_welcome))
-    dispatcher.add_handler(CommandHandler("set_goodbye", set_goodbye))
-    dispatcher.add_handler(CommandHandler("set_rules", set_rules_command))
-    dispatcher.add_handler(CommandHandler("set_antispam", set_antispam))
-    dispatcher.add_handler(CommandHandler("set_antiflood", set_antiflood))
+    application.add_handler(CommandHandler("set_welcome", set_welcome))
+    application.add_handler(CommandHandler("set_goodbye", set_goodbye))
+    application.add_handler(CommandHandler("set_rules", set_rules_command))
+    application.add_handler(CommandHandler("set_antispam", set_antispam))
+    application.add_handler(CommandHandler("set_antiflood", set_antiflood))
+    application.add_handler(CommandHandler("set_floodaction", set_floodaction))
+    application.add_handler(CommandHandler("set_antiraid", set_antiraid))
+    application.add_handler(CommandHandler("set_warnpolicy", set_warnpolicy))
     
     # Sudo commands
-    dispatcher.add_handler(CommandHandler("addsudo", addsudo))
-    dispatcher.add_handler(CommandHandler("removesudo", removesudo))
-    dispatcher.add_handler(CommandHandler("listsudo", listsudo))
-    dispatcher.add_handler(CommandHandler("backup", backup))
-    dispatcher.add_handler(CommandHandler("stats", stats))
-    dispatcher.add_handler(CommandHandler("broadcast", broadcast))
-    dispatcher.add_handler(CommandHandler("maintenance", maintenance))
+    application.add_handler(CommandHandler("addsudo", addsudo))
+    application.add_handler(CommandHandler("removesudo", removesudo))
+    application.add_handler(CommandHandler("listsudo", listsudo))
+    application.add_handler(CommandHandler("backup", backup))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("maintenance", maintenance))
     
     # Message handler
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.COMMAND & ~filters.StatusUpdate.ALL, handle_message))
+    
+    # New members are checked against the global ban list and the raid limit, then welcomed
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_members))
+    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, handle_left_member))
     
     # Button handler
-    dispatcher.add_handler(CallbackQueryHandler(button))
+    application.add_handler(CallbackQueryHandler(button))
     
-    # Start bot
-    updater.start_polling()
-    print(f"🔥 LegendBot is now online! Managed by {OWNER_USERNAME}")
+    # Membership changes keep the admin cache fresh
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
+    
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+    update_backlog.function = application.update_queue.qsize
     
-    # Save data on shutdown
-    import atexit
-    atexit.register(save_data)
+    return application
+
+def main():
+    """Start the bot."""
+    if WORKER_PROCESSES > 1:
+        if STORAGE_BACKEND != 'sharded':
+            logger.error("WORKER_PROCESSES > 1 needs STORAGE_BACKEND = 'sharded'")
+            return
+        print(f"🔥 LegendBot is now online with {WORKER_PROCESSES} workers! Managed by {OWNER_USERNAME}")
+        asyncio.run(Supervisor().run())
+        return
+    
+    # Loading here rather than at import keeps importing the module cheap
+    store.load()
+    application = build_application()
     
-    updater.idle()
+    # Start bot; chat_member updates are only delivered when requested explicitly
+    print(f"🔥 LegendBot is now online! Managed by {OWNER_USERNAME}")
+    if WEBHOOK_MODE:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,58 @@
+"""Regex filters must stay out of patterns that backtrack catastrophically."""
+import time
+
+import pytest
+
+import main
+
+BACKTRACKING_PATTERNS = [
+    '((a+))+b',
+    '(a|a)*b',
+    '(a|aa)+b',
+    '(a+)+b',
+    r'\d*\d*x',
+]
+
+
+@pytest.mark.parametrize('pattern', BACKTRACKING_PATTERNS)
+def test_backtracking_pattern_is_rejected(pattern):
+    with pytest.raises(ValueError):
+        main.filter_pattern('regex', pattern)
+
+
+@pytest.mark.parametrize('pattern', BACKTRACKING_PATTERNS)
+def test_backtracking_pattern_is_skipped_by_matcher(pattern):
+    matcher = main.FilterMatcher({pattern: {'type': 'regex'}})
+    started = time.perf_counter()
+    assert matcher.first_match('a' * 24 + 'c') is None
+    assert time.perf_counter() - started < 0.1
+
+
+@pytest.mark.parametrize('pattern', ['colou?r', r'https?://\S+', r'^hi\b', r'\d{3}-\d{4}', r'(?:a|b)*c', 'cat|dog'])
+def test_safe_pattern_is_accepted(pattern):
+    assert main.filter_pattern('regex', pattern) == pattern
+
+
+def test_pattern_scan_is_bounded_on_long_messages():
+    filters = {rf'\w*{char}?{char}?{char}': {'type': 'regex'} for char in '0123456789!@#$%^&*-='}
+    matcher = main.FilterMatcher(filters)
+    started = time.perf_counter()
+    assert matcher.first_match('a' * 4096) is None
+    assert time.perf_counter() - started < 1
+
+
+@pytest.mark.parametrize('store_class', [main.JsonStore, main.ShardedStore])
+def test_matcher_outlives_a_deleted_filter(tmp_path, store_class):
+    if store_class is main.JsonStore:
+        store = main.JsonStore(str(tmp_path / 'data.json'), str(tmp_path / 'data.json.log'))
+    else:
+        store = main.ShardedStore(str(tmp_path))
+    store.load()
+    store.put_filter(-1, 'spam', {'type': 'substring', 'text': 'no spam'})
+    matcher = main.FilterMatcher(store.get_filters(-1))
+    # /stop only invalidates the matcher once the delete has returned
+    assert store.delete_filter(-1, 'spam')
+    keyword = matcher.first_match('buy spam now')
+    assert matcher.filters[keyword]['text'] == 'no spam'
+    assert store.get_filters(-1) == {}
+    store.close()
@@ -0,0 +1,19 @@
+"""Flood and spam tracking must evict the least recently active users first."""
+import main
+
+
+def test_changed_fingerprint_counts_as_activity():
+    tracker = main.RateTracker(max_entries=3, idle_seconds=3600)
+    for user_id in (1, 2, 3):
+        tracker.hit((-1, user_id), 5, 10, fingerprint='a')
+    tracker.hit((-1, 1), 5, 10, fingerprint='b')
+    tracker.hit((-1, 4), 5, 10, fingerprint='a')
+    assert list(tracker._windows) == [(-1, 3), (-1, 1), (-1, 4)]
+
+
+def test_repeats_within_the_window_trigger():
+    tracker = main.RateTracker()
+    assert not tracker.hit((-1, 1), 3, 10, fingerprint='spam')
+    assert not tracker.hit((-1, 1), 3, 10, fingerprint='spam')
+    assert tracker.hit((-1, 1), 3, 10, fingerprint='spam')
+    assert not tracker.hit((-1, 1), 3, 10, fingerprint='other')
@@ -0,0 +1,198 @@
+"""Storage engines must not lose state across restarts, crashes and layout changes."""
+import os
+import threading
+
+import pytest
+
+import main
+
+
+def open_timers(shard_dir, name):
+    path = os.path.join(shard_dir, name)
+    timers = main.JsonStore(path, path + '.log')
+    timers.load()
+    return timers
+
+
+def test_scheduled_actions_follow_their_chat_when_the_worker_count_changes(tmp_path, monkeypatch):
+    shard_dir = str(tmp_path)
+    monkeypatch.setattr(main, 'WORKER_PROCESSES', 4)
+    supervisor = main.ShardedStore(shard_dir)
+    supervisor.load_globals()
+    for index in range(4):
+        timers = open_timers(shard_dir, f'scheduled-{index}.json')
+        chat_id = -100 - index
+        timers.put_scheduled(f"unban:{chat_id}:1", {"kind": "unban", "chat": chat_id, "user": 1, "due": 0})
+        timers.flush()
+        supervisor.globals.set_meta(f"message_counts:{index}", {str(chat_id): 5})
+    supervisor.globals.flush()
+
+    monkeypatch.setattr(main, 'WORKER_PROCESSES', 2)
+    supervisor = main.ShardedStore(shard_dir)
+    supervisor.load_globals()
+    assert not os.path.exists(tmp_path / 'scheduled-3.json')
+    for index in range(2):
+        actions = open_timers(shard_dir, f'scheduled-{index}.json').get_scheduled()
+        assert sorted(action["chat"] for action in actions.values()) == [-102 - index, -100 - index]
+        assert supervisor.globals.get_meta(f"message_counts:{index}") == {str(-100 - index): 5, str(-102 - index): 5}
+
+    # Single-process mode reads scheduled.json
+    monkeypatch.setattr(main, 'WORKER_PROCESSES', 1)
+    single = main.ShardedStore(shard_dir)
+    single.load()
+    assert len(single.get_scheduled()) == 4
+    assert single.counters.messages.total == 20
+    single.close()
+
+
+def test_writes_read_missing_shards_without_holding_the_lock(tmp_path, monkeypatch):
+    store = main.ShardedStore(str(tmp_path))
+    store.load()
+    store.set_chat_value(-1, "rules", "be nice")
+    store.flush()
+    store = main.ShardedStore(str(tmp_path))
+    store.load()
+    read_shard = store._read_shard
+    lock_free = []
+
+    def read_and_check(chat_id):
+        # Another thread must be able to take the lock while the file is read
+        acquired = []
+
+        def try_lock():
+            if store._lock.acquire(timeout=1):
+                store._lock.release()
+                acquired.append(True)
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        lock_free.append(bool(acquired))
+        return read_shard(chat_id)
+
+    monkeypatch.setattr(store, '_read_shard', read_and_check)
+    store.set_chat_value(-1, "welcome", "hi")
+    store.put_filter(-2, "spam", {"type": "substring"})
+    assert lock_free == [True, True]
+    assert store.get_chat_value(-1, "rules") == "be nice"
+    store.close()
+
+
+def open_json_store(tmp_path):
+    store = main.JsonStore(str(tmp_path / 'data.json'), str(tmp_path / 'data.json.log'))
+    store.load()
+    return store
+
+
+def test_log_replay_skips_a_torn_final_record(tmp_path):
+    store = open_json_store(tmp_path)
+    store.set_chat_value(-1, "rules", "be nice")
+    store.put_filter(-1, "spam", {"type": "substring"})
+    store._write_pending()
+    with open(tmp_path / 'data.json.log', 'a') as f:
+        f.write('{"op": "set", "chat": "-1", "key": "welc')
+
+    store = open_json_store(tmp_path)
+    assert store.get_chat_value(-1, "rules") == "be nice"
+    assert list(store.get_filters(-1)) == ["spam"]
+    # A record written after the torn one must not be glued onto it
+    store.set_chat_value(-1, "welcome", "hi")
+    store._write_pending()
+
+    store = open_json_store(tmp_path)
+    assert store.get_chat_value(-1, "welcome") == "hi"
+    assert store.get_chat_value(-1, "rules") == "be nice"
+
+
+def test_unterminated_final_record_is_kept(tmp_path):
+    store = open_json_store(tmp_path)
+    store._write_pending()
+    with open(tmp_path / 'data.json.log', 'a') as f:
+        f.write('{"op": "set", "chat": "-1", "key": "rules", "value": "a"}')
+
+    store = open_json_store(tmp_path)
+    store.set_chat_value(-1, "welcome", "hi")
+    store._write_pending()
+
+    store = open_json_store(tmp_path)
+    assert store.get_chat_value(-1, "rules") == "a"
+    assert store.get_chat_value(-1, "welcome") == "hi"
+
+
+def test_compaction_keeps_a_leftover_rotated_log(tmp_path):
+    store = open_json_store(tmp_path)
+    store.set_chat_value(-1, "rules", "old")
+    store.add_gban(7)
+    store._write_pending()
+    # A compaction that rotated the log and died before writing the snapshot
+    store._log_handle.close()
+    os.replace(tmp_path / 'data.json.log', tmp_path / 'data.json.log.1')
+
+    store = open_json_store(tmp_path)
+    assert store.get_chat_value(-1, "rules") == "old"
+    store.set_chat_value(-1, "welcome", "hi")
+    store.set_chat_value(-1, "rules", "new")
+    store.compact()
+    assert not os.path.exists(tmp_path / 'data.json.log.1')
+
+    store = open_json_store(tmp_path)
+    assert store.get_chat_value(-1, "rules") == "new"
+    assert store.get_chat_value(-1, "welcome") == "hi"
+    assert store.is_gbanned(7)
+
+
+def open_sharded_store(tmp_path):
+    store = main.ShardedStore(str(tmp_path))
+    store.load()
+    return store
+
+
+def test_evicted_shards_are_read_back_before_they_are_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'SHARD_CACHE_SIZE', 2)
+    store = open_sharded_store(tmp_path)
+    for chat_id in range(-1, -6, -1):
+        store.set_chat_value(chat_id, "rules", f"rules {chat_id}")
+    assert sorted(store._unwritten) == [-3, -2, -1]
+    assert not os.listdir(store.chats_dir)
+    assert sorted(store.chat_ids()) == [-5, -4, -3, -2, -1]
+    # Served from the serialized copies, not from the missing files
+    assert [store.get_chat_value(chat_id, "rules") for chat_id in range(-1, -6, -1)] == [
+        f"rules {chat_id}" for chat_id in range(-1, -6, -1)
+    ]
+
+    store.flush()
+    assert store._unwritten == {} and store._dirty == set()
+    store = open_sharded_store(tmp_path)
+    assert store.get_chat_value(-1, "rules") == "rules -1"
+    assert store.get_chat_value(-5, "rules") == "rules -5"
+
+
+def test_statistics_are_rebuilt_after_an_unclean_exit(tmp_path):
+    store = open_sharded_store(tmp_path)
+    store.put_filter(-1, "spam", {"type": "substring"})
+    store.set_warnings(-1, 42, [1, 2])
+    store.close()
+
+    store = open_sharded_store(tmp_path)
+    assert store.stats()["filters"] == 1
+    store.put_filter(-2, "scam", {"type": "substring"})
+    store.set_warnings(-2, 43, [3])
+    # Shards reach the disk, but the process dies before close() saves the statistics
+    store.flush()
+
+    store = open_sharded_store(tmp_path)
+    stats = store.stats()
+    assert (stats["chats"], stats["filters"], stats["warnings"]) == (2, 2, 3)
+
+
+def test_backends_implement_the_whole_interface(tmp_path):
+    main.JsonStore(str(tmp_path / 'data.json'), str(tmp_path / 'data.json.log'))
+    main.SqliteStore(str(tmp_path / 'data.db'))
+    main.ShardedStore(str(tmp_path / 'shards'))
+
+    class PartialStore(main.Store):
+        def load(self) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        PartialStore()
@@ -0,0 +1,72 @@
+"""The webhook server must turn requests away before buffering their bodies."""
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def webhook_secret(monkeypatch):
+    monkeypatch.setattr(main, 'WEBHOOK_SECRET', 's3cret')
+
+
+async def exchange(request: bytes):
+    """Send raw bytes to a webhook server and return (status line, delivered updates)."""
+    delivered = []
+
+    async def deliver(data):
+        delivered.append(data)
+
+    server = await asyncio.start_server(
+        lambda reader, writer: main._handle_webhook_connection(deliver, reader, writer), '127.0.0.1', 0
+    )
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        status = await asyncio.wait_for(reader.readline(), 5)
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    return status.decode().strip(), delivered
+
+
+def post(body: bytes, secret='s3cret', length=None) -> bytes:
+    return (
+        f"POST /{main.WEBHOOK_PATH} HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        f"Content-Length: {len(body) if length is None else length}\r\n\r\n"
+    ).encode() + body
+
+
+def test_update_is_delivered():
+    status, delivered = asyncio.run(exchange(post(b'{"update_id": 1}')))
+    assert status == 'HTTP/1.1 200 OK'
+    assert delivered == [{"update_id": 1}]
+
+
+def test_wrong_secret_is_rejected_before_the_body_is_read():
+    # The announced body is never sent; the answer must not wait for it
+    status, delivered = asyncio.run(exchange(post(b'', secret='wrong', length=10 ** 9)))
+    assert status == 'HTTP/1.1 403 Forbidden'
+    assert delivered == []
+
+
+def test_oversized_body_is_rejected():
+    status, _ = asyncio.run(exchange(post(b'', length=main.HTTP_MAX_BODY + 1)))
+    assert status == 'HTTP/1.1 413 Payload Too Large'
+
+
+@pytest.mark.parametrize('body', [b'5', b'[]', b'"update"', b'not json'])
+def test_non_object_update_is_rejected(body):
+    status, delivered = asyncio.run(exchange(post(body)))
+    assert status == 'HTTP/1.1 400 Bad Request'
+    assert delivered == []
+
+
+def test_stalled_request_is_dropped(monkeypatch):
+    monkeypatch.setattr(main, 'HTTP_READ_TIMEOUT', 0.1)
+    status, _ = asyncio.run(exchange(post(b'{}', length=100)))
+    assert status == ''
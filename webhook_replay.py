@@ -0,0 +1,91 @@
+"""Replay recorded updates against LegendBot's webhook server.
+
+Start the bot with WEBHOOK_MODE = True, then post a file of recorded
+Update JSON objects (one per line) to it:
+
+    python webhook_replay.py updates.jsonl --repeat 100 --concurrency 16
+
+Reports throughput and request latency so webhook ingestion can be
+measured at rates long polling can't reach.
+"""
+import argparse
+import json
+import threading
+import time
+from itertools import count
+
+import requests
+
+
+def load_updates(path):
+    """Read one Update JSON object per line, skipping blank lines."""
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('updates', help="File with one Update JSON object per line")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram', help="Webhook endpoint")
+    parser.add_argument('--secret', default=None, help="Value for X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument('--repeat', type=int, default=1, help="Times to replay the whole file")
+    parser.add_argument('--concurrency', type=int, default=8, help="Parallel connections")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates)
+    total = len(updates) * args.repeat
+    headers = {'Content-Type': 'application/json'}
+    if args.secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = args.secret
+
+    # Each replayed update gets a fresh update_id so none look like duplicates
+    update_ids = count(1)
+    next_index = count()
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next(next_index)
+                update_id = next(update_ids)
+            if index >= total:
+                return
+            payload = dict(updates[index % len(updates)], update_id=update_id)
+            started = time.perf_counter()
+            try:
+                response = session.post(args.url, data=json.dumps(payload), headers=headers, timeout=10)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors.append(index)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"Sent {total} updates in {elapsed:.2f}s ({total / elapsed:.0f} updates/s)")
+    print(f"Errors: {len(errors)}")
+    print(f"Latency p50: {percentile(latencies, 0.5) * 1000:.2f}ms  "
+          f"p99: {percentile(latencies, 0.99) * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()